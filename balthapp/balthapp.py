@@ -14,75 +14,158 @@ Created on January 20th, 2023
 # update the api contract
 # add the architecture design in README.md
 # Fix a storage issue about saving/removing file and updating db
+# Serve the text from the file written by the worker (no more text in the Celery result)
+# Persist the results from a Celery callback (finalizer.py): GET endpoints only read
+# Add a route to upload a batch of PDF files (several files or a zip archive)
+# Add a route to get the metadata of many PDF at once
+# Stream the uploads to the storage before the deduplication (no more full reads in memory)
+# Add a long-poll route to wait for the end of an extraction
+# Cache the terminal results and answer 304 to conditional requests (ETag)
+# Add a route exposing the metrics in the Prometheus format
+# Return the metadata extracted by the worker as a JSON object
+# Route the extractions by size to separate queues, with a priority fair between the clients
+# Read the texts in their sub-folder of storage/files (ab/cd/<uuid>.txt), the public links do not change
+# Serve the texts stored with gzip as they are to the clients which accept it
+# Answer the range requests on every text download, and let the front server send the files (X-Sendfile)
+# Add a route to get a range of pages of a text, read at the offsets indexed by the worker
+# Add a route to search the extracted texts (full-text index of the pages)
+# Add a route to list the documents, filtered and sorted on the typed metadata, with a keyset pagination
+# Refuse the uploads of the contents quarantined by the finalizer (poison PDF)
+# Report the progress of the extractions, and serve the pages published by the worker before the end
 @author: Balthazar Méhus
 @society: CentraleSupélec
 @abstract: Python PDF extraction and storage - API endpoints and controller
 """
 
+import base64
+import gzip
+import hashlib
+import json
 import os
+import time
+import zipfile
 from dataclasses import dataclass
+from datetime import datetime, timezone
 from uuid import uuid4
 
-import service
-from celery import Celery
+import redis
+from celery import Celery, group
 from flask import (Flask, Response, jsonify, request, send_file,
                    send_from_directory)
+from flask.wrappers import Request
 from flask_limiter import Limiter
 from flask_limiter.errors import RateLimitExceeded
 from flask_limiter.util import get_remote_address
 from markupsafe import escape
+from werkzeug.exceptions import RequestEntityTooLarge
 from werkzeug.utils import secure_filename
+from werkzeug.wsgi import FileWrapper
+
+import service
+from cache import ResultCache
+from config import (BROKER_TRANSPORT_OPTIONS, CACHE_MAX_SIZE, CACHE_PREFIX,
+                    CACHE_REDIS, CACHE_TTL, CONTRACT_PATH, FAIRNESS_STEP,
+                    FINALIZE_QUEUE, FINALIZED_CHANNEL, GZIP_EXT, INDEX_EXT,
+                    INFLIGHT_PREFIX, INFLIGHT_TTL, LARGE_FILE_SIZE,
+                    LARGE_QUEUE, LIST_PAGE_SIZE, MAX_BATCH_FILES,
+                    MAX_BATCH_SIZE, MAX_BATCH_SIZE_MB, MAX_BULK_IDS,
+                    MAX_CONTENT_LENGTH, MAX_FILE_SIZE, MAX_FILE_SIZE_MB,
+                    MAX_LIST_PAGE_SIZE, MAX_PRIORITY, MAX_SEARCH_PAGE_SIZE,
+                    MAX_WAIT_TIMEOUT, PDF_EXT, PDF_FOLDER_PATH, REDIS_URI,
+                    SEARCH_HIGHLIGHT, SEARCH_PAGE_SIZE, SEARCH_SNIPPET_WORDS,
+                    SMALL_QUEUE, TXT_EXT, TXT_FOLDER_PATH, USE_X_SENDFILE)
+from metrics import registry
+
+
+class BalthRequest(Request):
+    """The request of the API, whose body is limited by endpoint: a batch upload carries many PDF"""
+
+    @property
+    def max_content_length(self) -> int | None:
+        # The route is matched when the request is pushed, before its body is read
+        if self.url_rule is not None and self.url_rule.endpoint == 'upload_pdf_batch':
+            return MAX_BATCH_SIZE
+        return super().max_content_length
+
 
 # Crate an instance of our Flask API
 flask_app = Flask(__name__)
+flask_app.request_class = BalthRequest
 flask_app.config['JSONIFY_PRETTYPRINT_REGULAR']: bool = True
-
-# Our redis server
-redis_uri = "redis://localhost:6379"
+# A body too large is refused from its Content-Length, before Werkzeug spools its files to the disk
+flask_app.config['MAX_CONTENT_LENGTH'] = MAX_CONTENT_LENGTH
+# Behind Apache or lighttpd, the texts are sent by the front server (X-Sendfile header) instead of the Flask worker
+flask_app.config['USE_X_SENDFILE'] = USE_X_SENDFILE
 
 # Set a limit to unique IP connexions
 limiter = Limiter(
     get_remote_address,
     app=flask_app,
     default_limits=["200 per day", "50 per hour"],
-    storage_uri=redis_uri,
+    storage_uri=REDIS_URI,
     storage_options={"socket_connect_timeout": 30},
     strategy="fixed-window",
 )
 
 # Set Celery queue and connect it to redis workers
 celery_app = Celery('balthworker',
-                    broker=redis_uri,
-                    backend=redis_uri + '/0')
+                    broker=REDIS_URI,
+                    backend=REDIS_URI + '/0')
+# The tasks of a queue are delivered by priority
+celery_app.conf.broker_transport_options = BROKER_TRANSPORT_OPTIONS
 
-# Fixe la taille maximale des PDF téléchargé à 10MO
-MAX_FILE_SIZE_MB = 10
-MAX_FILE_SIZE = MAX_FILE_SIZE_MB * 1024 * 1024
-# The path to the folder where are uploaded the PDFs
-PDF_FOLDER_PATH = "storage/temp"
-TXT_FOLDER_PATH = "storage/files"
-CONTRACT_PATH = "static"
+# Notified by the finalizer when an extraction is persisted
+redis_client = redis.Redis.from_url(REDIS_URI)
 
-PDF_EXT = '.pdf'
-TXT_EXT = '.txt'
+# Celery states after which a task does not change anymore
+TERMINAL_STATES = ("SUCCESS", "FAILURE")
+
+
+def _utc_date(value: str) -> datetime:
+    # An ISO 8601 date, compared to the dates stored in UTC without time zone
+    date = datetime.fromisoformat(value)
+    if date.tzinfo is not None:
+        date = date.astimezone(timezone.utc).replace(tzinfo=None)
+    return date
+
+
+# GET /documents: the columns to sort by, and the filters by query parameter (filter of db_list_pdfs, parser)
+LIST_SORTS = ('created_at', 'creation_date', 'page_count', 'title', 'author', 'producer', 'creator')
+LIST_FILTERS = {
+    'author': ('author', str),
+    'producer': ('producer', str),
+    'creator': ('creator', str),
+    'task_state': ('task_state', str),
+    'batch_id': ('batch_id', str),
+    'uploaded_after': ('min_created_at', _utc_date),
+    'uploaded_before': ('max_created_at', _utc_date),
+    'created_after': ('min_creation_date', _utc_date),
+    'created_before': ('max_creation_date', _utc_date),
+    'min_pages': ('min_page_count', int),
+    'max_pages': ('max_page_count', int),
+}
+
+# The metadata in a terminal state, shared between the API processes through redis if enabled
+result_cache = ResultCache(CACHE_MAX_SIZE, CACHE_TTL, redis_client=redis_client if CACHE_REDIS else None,
+                           prefix=CACHE_PREFIX)
 
 
-# TODO: add a config system
 # TODO: add a logger system
-# TODO: to avoid flooding, add a cron job each hour
-#  to clean balthapp/storage/files and balthapp/storage/temp from oldest files
 
 @dataclass
 class PdfInfos:
     uid: str = ''
     name: str = ''
-    data: str = ''
+    data: dict | str = ''
     link: str = ''
     task_id: str = ''
     task_state: str = ''
     pdf_path: str = ''
     txt_path: str = ''
-    txt: str = ''
+    content_hash: str = ''
+    batch_id: str = ''
+    size: int = 0
+    progress: dict | None = None
 
     def set_uid(self, pdf_id):
         uid = escape(pdf_id)
@@ -92,10 +175,15 @@ class PdfInfos:
         self.name = str(secure_filename(filename))
 
     def set_data(self, metadata):
-        self.data = str(metadata)
+        # Stored as JSON by the finalizer, the documents extracted before stay as text
+        try:
+            self.data = json.loads(metadata)
+        except (TypeError, ValueError):
+            self.data = str(metadata)
 
     def set_link(self, root):
-        self.link = os.path.join(root, self.txt_path)
+        # Served by display_txt, whatever the sub-folder of the file
+        self.link = os.path.join(root, TXT_FOLDER_PATH, self.uid + TXT_EXT)
 
     def set_task_id(self, task_id):
         self.task_id = str(task_id)
@@ -103,15 +191,25 @@ class PdfInfos:
     def set_task_state(self, task_state):
         self.task_state = str(task_state)
 
+    def set_progress(self, progress):
+        # Reported by the worker with the PROGRESS state: {"pages_done": int, "pages": int}
+        self.progress = progress if isinstance(progress, dict) else None
+
     def set_pdf_path(self, uid):
         filename = uid + PDF_EXT
         self.pdf_path = os.path.join(PDF_FOLDER_PATH, filename)
 
     def set_txt_path(self, uid):
-        self.txt_path = os.path.join(TXT_FOLDER_PATH, uid + TXT_EXT)
+        self.txt_path = os.path.join(TXT_FOLDER_PATH, service.fs_shard_name(uid + TXT_EXT))
+
+    def set_content_hash(self, content_hash):
+        self.content_hash = str(content_hash)
 
-    def set_txt(self, text):
-        self.txt = str(text)
+    def set_batch_id(self, batch_id):
+        self.batch_id = str(batch_id)
+
+    def set_size(self, size):
+        self.size = int(size)
 
 
 @flask_app.errorhandler(RateLimitExceeded)
@@ -121,6 +219,24 @@ def handle_rate_limit_exceeded(e):
     return response
 
 
+@flask_app.errorhandler(RequestEntityTooLarge)
+def handle_request_entity_too_large(e):
+    if request.endpoint == 'upload_pdf_batch':
+        response = jsonify(error="Batch size exceeded the maximum limit (" + str(MAX_BATCH_SIZE_MB) + " mb).")
+    else:
+        response = jsonify(error="File size exceeded the maximum limit (" + str(MAX_FILE_SIZE_MB) + " mb).")
+    response.status_code = 413
+    return response
+
+
+@flask_app.after_request
+def count_request(response):
+    # Requests by endpoint and status, the unknown routes are gathered
+    registry.inc('balth_http_requests_total',
+                 labels={'endpoint': request.endpoint or 'none', 'status': response.status_code})
+    return response
+
+
 @flask_app.route('/')
 def hello():
     """Home page : it presents the API
@@ -144,6 +260,23 @@ def download_contract():
     return send_from_directory(CONTRACT_PATH, 'api-contract.yaml'), 200
 
 
+@flask_app.route('/metrics')
+@limiter.exempt
+def get_metrics() -> Response | tuple[dict[str, str], int]:
+    """Expose the counters and histograms of the API, the finalizer and the workers.
+    ---
+    responses:
+        200:
+          summary: The metrics in the Prometheus text format.
+        503:
+          summary: The metrics storage (redis) is not reachable.
+    """
+    try:
+        return Response(registry.render(), mimetype='text/plain; version=0.0.4')
+    except redis.RedisError as err:
+        return {"error": "Metrics not available: " + str(err)}, 503
+
+
 @flask_app.route('/documents', methods=['POST'])
 @limiter.limit("10/minute, 1/second", override_defaults=False)
 def upload_pdf() -> tuple[dict[str, str], int]:
@@ -155,9 +288,15 @@ def upload_pdf() -> tuple[dict[str, str], int]:
         description: The PDF file to upload
         required: true
     responses:
+        200:
+          summary: The same PDF was already uploaded.
+          description: Returns the uuid (str) of the previous upload, whose extraction is reused.
         201:
           summary: PDF uploaded successfully.
           description: Returns an uuid (str) which identifies the uploaded pdf file.
+        422:
+          summary: The content of the PDF is quarantined.
+          description: Its extraction broke the limits of the workers or failed again and again, it is not extracted again.
     """
     pdf_infos = PdfInfos()
     # -------------------- CHECKIN -------------------------
@@ -167,57 +306,154 @@ def upload_pdf() -> tuple[dict[str, str], int]:
         pdf_file = request.files['pdf_file']
     except KeyError:
         return {"error": "Invalid payload, only POST on 'pdf_file' key."}, 422
-
-    # Verify that the document post is not empty
-    if not service.file_provided(file=pdf_file):
-        return {"error": "No pdf file provided."}, 400
-    # Verify that the file has the .pdf extension
-    if not service.file_valid_extension(file=pdf_file, ext=PDF_EXT):
-        return {"error": "Invalid file EXT. Please upload a '" + PDF_EXT + "' file."}, 415
-    # Verify that file is PDF MIMETYPE
-    if not service.file_valid_mimetype(file=pdf_file, mimetype='PDF'):
-        return {"error": "Invalid file type. Please upload a PDF file."}, 415
-    # Verify the document size
-    if not service.file_valid_size(file=pdf_file, max_size=MAX_FILE_SIZE):
-        return {"error": "File size exceeded the maximum limit (" + str(MAX_FILE_SIZE_MB) + " mb)."}, 413
+    error = _check_pdf_file(pdf_file)
+    if error:
+        return error
 
     # -------------------- TREATMENT -------------------------
-    # Create a unique ID to identify the pdf document
-    pdf_id = str(uuid4())
-    pdf_infos.set_uid(pdf_id)
-    pdf_infos.set_pdf_path(pdf_infos.uid)
+    _set_new_pdf_infos(pdf_infos, pdf_file)
+    try:
+        # Temporary save the PDF file in our storage to extract its contents further,
+        # the real size is checked on the way
+        error = _save_temp_pdf(pdf_infos, pdf_file)
+    except Exception as err:
+        _clean_new_pdfs([pdf_infos])
+        return {"error": str(err)}, 500
+    if error:
+        return error
 
     try:
-        # Temporary save the PDF file in our storage to extract its contents further
-        service.fs_save_temp_pdf(pdf_file, pdf_infos.pdf_path)
+        # -------------------- DEDUPLICATION -------------------------
+        # An identical document reuses the extraction already done or in progress
+        pdf_from_db = service.db_get_pdf_by_hash(pdf_infos.content_hash)
+        if pdf_from_db:
+            flask_app.logger.info("Duplicate upload of " + pdf_from_db.id)
+            service.fs_remove_temp_pdf(pdf_infos.pdf_path)
+            return {"_id": pdf_from_db.id}, 200
+        if service.db_get_quarantined_hashes([pdf_infos.content_hash]):
+            service.fs_remove_temp_pdf(pdf_infos.pdf_path)
+            return _quarantined_error()
 
-        flask_app.logger.info("Invoking asynchronous method")
-        # Asynchronous extraction of the metadata and the text of the PDF file
-        async_task = celery_app.send_task('tasks.extract_data', args=[pdf_infos.uid + PDF_EXT])
-        flask_app.logger.info(async_task.backend)
         # -------------------- STORAGE -------------------------
-        pdf_infos.set_name(pdf_file.filename)
-        pdf_infos.set_task_id(async_task.id)
-        # Prepare the data to be stored in the DB
-        data_to_store = {
-            'id': pdf_infos.uid,
-            'name': pdf_infos.name,
-            'task_id': pdf_infos.task_id
-        }
         # Create a new entry in our pdf table
-        service.db_insert_pdf_info(data_to_store)
+        if not service.db_insert_pdf_info(_data_to_store(pdf_infos)):
+            raise RuntimeError("The PDF entry could not be stored.")
+
+        flask_app.logger.info("Invoking asynchronous method")
+        # Asynchronous extraction of the metadata and the text of the PDF file,
+        # the finalizer persists the results as soon as the worker is done
+        priority = _reserve_priorities(1)[0]
+        try:
+            async_task = _extraction_signature(pdf_infos, priority).apply_async()
+        except Exception:
+            # The finalizer will never release a task which was not sent
+            _release_priorities(1)
+            raise
+        flask_app.logger.info(async_task.backend)
     except Exception as err:
         # -------------------- CLEANING -------------------------
-        # Remove the PDF from storage
-        if os.path.exists(pdf_infos.pdf_path):
-            service.fs_remove_temp_pdf(pdf_infos.pdf_path)
+        _clean_new_pdfs([pdf_infos])
         return {"error": str(err)}, 500
     return {"_id": pdf_infos.uid}, 201
 
 
+@flask_app.route('/documents/batch', methods=['POST'])
+@limiter.limit("2/minute, 1/second", override_defaults=False)
+def upload_pdf_batch() -> tuple[dict, int]:
+    """Upload a batch of PDF files for processing, in one request.
+    Post several files on the 'pdf_files' key, or one zip archive on the 'archive' key.
+    ---
+    requestBody:
+        name: pdf_files | archive
+        description: The PDF files, or a zip archive of PDF files, to upload
+        required: true
+    responses:
+        201:
+          summary: Batch uploaded.
+          description: Returns the batch uuid and, for each file, its uuid or the reason of its rejection.
+    """
+    # -------------------- CHECKIN -------------------------
+    pdf_files = request.files.getlist('pdf_files')
+    archive = request.files.get('archive')
+    if not pdf_files and not archive:
+        return {"error": "Invalid payload, only POST on 'pdf_files' or 'archive' keys."}, 422
+    if archive:
+        try:
+            pdf_files = service.zip_members(archive)
+        except zipfile.BadZipFile:
+            return {"error": "Invalid archive. Please upload a '.zip' file."}, 415
+    if len(pdf_files) > MAX_BATCH_FILES:
+        return {"error": "Too many files in the batch (" + str(MAX_BATCH_FILES) + " max)."}, 413
+
+    batch_id = str(uuid4())
+    documents = []
+    saved_pdfs = []
+    try:
+        for pdf_file in pdf_files:
+            document = {"name": pdf_file.filename}
+            documents.append(document)
+            error = _check_pdf_file(pdf_file)
+            if not error:
+                pdf_infos = PdfInfos()
+                _set_new_pdf_infos(pdf_infos, pdf_file)
+                pdf_infos.set_batch_id(batch_id)
+                error = _save_temp_pdf(pdf_infos, pdf_file)
+            if error:
+                document.update(error[0])
+                continue
+            saved_pdfs.append((pdf_infos, document))
+    except Exception as err:
+        _clean_new_pdfs([pdf_infos for pdf_infos, _ in saved_pdfs])
+        return {"error": str(err)}, 500
+
+    if not saved_pdfs:
+        return {"error": "No valid pdf file provided.", "documents": documents}, 400
+
+    to_extract = []
+    try:
+        # -------------------- DEDUPLICATION -------------------------
+        # One query for the whole batch, identical files in the batch share one extraction
+        content_hashes = [pdf_infos.content_hash for pdf_infos, _ in saved_pdfs]
+        known_ids = service.db_get_pdf_ids_by_hashes(content_hashes)
+        quarantined = service.db_get_quarantined_hashes(content_hashes)
+        for pdf_infos, document in saved_pdfs:
+            if pdf_infos.content_hash in known_ids:
+                document["_id"] = known_ids[pdf_infos.content_hash]
+                service.fs_remove_temp_pdf(pdf_infos.pdf_path)
+                continue
+            if pdf_infos.content_hash in quarantined:
+                document.update(_quarantined_error()[0])
+                service.fs_remove_temp_pdf(pdf_infos.pdf_path)
+                continue
+            known_ids[pdf_infos.content_hash] = pdf_infos.uid
+            document["_id"] = pdf_infos.uid
+            to_extract.append(pdf_infos)
+
+        # -------------------- STORAGE -------------------------
+        # All the entries in one transaction, all the tasks in one call to the broker
+        if to_extract:
+            if not service.db_insert_pdf_infos([_data_to_store(pdf_infos) for pdf_infos in to_extract]):
+                raise RuntimeError("The PDF entries could not be stored.")
+            priorities = _reserve_priorities(len(to_extract))
+            try:
+                group([_extraction_signature(pdf_infos, priority)
+                       for pdf_infos, priority in zip(to_extract, priorities)]).apply_async()
+            except Exception:
+                # The entries are deleted, a task sent before the failure fails without releasing its slot
+                _release_priorities(len(to_extract))
+                raise
+    except Exception as err:
+        # -------------------- CLEANING -------------------------
+        # All the PDF saved by the request, whichever step failed: none of them will be extracted
+        _clean_new_pdfs([pdf_infos for pdf_infos, _ in saved_pdfs])
+        return {"error": str(err)}, 500
+    flask_app.logger.info(str(len(to_extract)) + " extractions invoked for the batch " + batch_id)
+    return {"batch_id": batch_id, "documents": documents}, 201
+
+
 @flask_app.route('/metadata/<pdf_id>', methods=['GET'])
 @limiter.limit("20/minute, 1/second", override_defaults=False)
-def get_info(pdf_id: str) -> tuple[dict[str, str], int]:
+def get_info(pdf_id: str) -> Response | tuple[dict[str, str], int]:
     """Get metadata from the pdf file thanks its unique ID métadonnées d'un fichier PDF en utilisant son ID
     ---
     parameters:
@@ -227,30 +463,234 @@ def get_info(pdf_id: str) -> tuple[dict[str, str], int]:
             required: true
     responses:
         200:
-            description: Returns metadata about the document
+            description: Returns metadata about the document, with an ETag
+        304:
+            description: The metadata did not change since the ETag provided in If-None-Match
     """
     pdf_infos = PdfInfos()
-    pdf_infos.set_uid(pdf_id)
-    pdf_infos.set_pdf_path(pdf_infos.uid)
-    pdf_infos.set_txt_path(pdf_infos.uid)
-    # Get pdf info (task_id) in DB with pdf_id
-    pdf_form_db = service.db_get_pdf_info(pdf_infos.uid)
-    # Check if the pdf entry exists in the DB
-    if pdf_form_db:
-        _manage_task(pdf_infos, pdf_id)
-        return {
-            "_id": pdf_infos.uid,
-            "name": pdf_infos.name,
-            "link": pdf_infos.link,
-            "data": pdf_infos.data,
-            "task_state": pdf_infos.task_state,
-            "created_at": str(pdf_form_db.created_at)
-        }, 200
+    # Check if the pdf entry exists in the DB (or in the cache)
+    document = _get_metadata(pdf_infos, pdf_id)
+    if document:
+        response = jsonify(document)
+        response.set_etag(hashlib.sha1(response.get_data()).hexdigest())
+        return response.make_conditional(request)
 
     else:
         return {"error": "PDF not found. Thanks to verify the id."}, 204
 
 
+@flask_app.route('/metadata', methods=['POST'])
+@limiter.limit("30/minute, 1/second", override_defaults=False)
+def get_infos() -> tuple[dict, int]:
+    """Get metadata from many pdf files at once, by their unique IDs or by batch
+    ---
+    requestBody:
+        description: JSON object with 'ids' (list of uuid) and/or 'batch_id', optionally filtered by 'task_state'
+        required: true
+    responses:
+        200:
+            description: Returns the metadata of the found documents and the list of the missing ids
+    """
+    # -------------------- CHECKIN -------------------------
+    payload = request.get_json(silent=True)
+    if not isinstance(payload, dict):
+        return {"error": "Invalid payload, only POST a JSON object with 'ids' or 'batch_id' keys."}, 422
+    pdf_ids = payload.get('ids') or []
+    batch_id = payload.get('batch_id')
+    task_state = payload.get('task_state')
+    if not isinstance(pdf_ids, list) or not isinstance(batch_id, (str, type(None))) or not (pdf_ids or batch_id):
+        return {"error": "Invalid payload, only POST a JSON object with 'ids' or 'batch_id' keys."}, 422
+    if len(pdf_ids) > MAX_BULK_IDS:
+        return {"error": "Too many ids (" + str(MAX_BULK_IDS) + " max)."}, 413
+    pdf_ids = [str(escape(pdf_id)) for pdf_id in pdf_ids]
+    if batch_id:
+        batch_id = str(escape(batch_id))
+
+    # -------------------- LOOKUP -------------------------
+    # One SELECT for the documents, unfiltered: an id filtered out by its state is not missing,
+    # and the state is filtered once resolved, as GET /metadata/<pdf_id> reports it
+    pdfs_from_db = service.db_get_pdf_infos(pdf_ids=pdf_ids, batch_id=batch_id)
+    # One pipelined redis fetch for the states of the others
+    live_states = _live_task_states([pdf_from_db.task_id for pdf_from_db in pdfs_from_db
+                                     if pdf_from_db.task_state not in TERMINAL_STATES])
+    documents = []
+    for pdf_from_db in pdfs_from_db:
+        pdf_infos = PdfInfos()
+        _load_pdf_infos(pdf_infos, pdf_from_db)
+        pdf_infos.set_task_state(live_states.get(pdf_from_db.task_id, pdf_infos.task_state))
+        if task_state and pdf_infos.task_state != task_state:
+            continue
+        documents.append(_metadata(pdf_infos, pdf_from_db))
+    found_ids = {pdf_from_db.id for pdf_from_db in pdfs_from_db}
+    return {
+        "documents": documents,
+        "missing": [pdf_id for pdf_id in pdf_ids if pdf_id not in found_ids]
+    }, 200
+
+
+@flask_app.route('/documents', methods=['GET'])
+@limiter.limit("30/minute, 1/second", override_defaults=False)
+def list_pdfs() -> tuple[dict, int]:
+    """List the documents, filtered and sorted by their main metadata, page after page
+    ---
+    parameters:
+          - name: author, producer, creator, task_state, batch_id
+            in: query
+            description: Only the documents with this value
+            required: false
+          - name: uploaded_after, uploaded_before, created_after, created_before
+            in: query
+            description: Bounds of the upload date and of the creation date of the PDF (ISO 8601)
+            required: false
+          - name: min_pages, max_pages
+            in: query
+            description: Bounds of the number of pages
+            required: false
+          - name: sort
+            in: query
+            description: The column to sort by, descending with a leading '-' (-created_at by default)
+            required: false
+          - name: limit
+            in: query
+            description: The number of documents (50 by default, 500 at most)
+            required: false
+          - name: cursor
+            in: query
+            description: The next_cursor of the previous page
+            required: false
+    responses:
+        200:
+            description: Returns the metadata of the documents and the cursor of the next page
+        400:
+            description: Invalid filter, sort or cursor
+    """
+    # -------------------- CHECKIN -------------------------
+    sort = request.args.get('sort', default='-created_at')
+    descending = sort.startswith('-')
+    sort = sort.lstrip('-')
+    if sort not in LIST_SORTS:
+        return {"error": "Invalid sort ; Sort by " + ", ".join(LIST_SORTS) + "."}, 400
+    limit = min(max(request.args.get('limit', default=LIST_PAGE_SIZE, type=int), 1), MAX_LIST_PAGE_SIZE)
+    filters = {}
+    for name, (column, parse) in LIST_FILTERS.items():
+        if name in request.args:
+            try:
+                filters[column] = parse(request.args[name])
+            except ValueError:
+                return {"error": "Invalid value of " + name + "."}, 400
+    after = None
+    if 'cursor' in request.args:
+        after = _decode_cursor(request.args['cursor'], sort, descending)
+        if after is None:
+            return {"error": "Invalid cursor ; Keep the sort of the previous page."}, 400
+
+    # -------------------- LOOKUP -------------------------
+    # One more document tells whether there is a next page
+    rows = service.db_list_pdfs(filters, sort, descending, limit + 1, after)
+    live_states = _live_task_states([pdf_from_db.task_id for pdf_from_db, _ in rows[:limit]
+                                     if pdf_from_db.task_state not in TERMINAL_STATES])
+    documents = []
+    for pdf_from_db, _ in rows[:limit]:
+        pdf_infos = PdfInfos()
+        _load_pdf_infos(pdf_infos, pdf_from_db)
+        pdf_infos.set_task_state(live_states.get(pdf_from_db.task_id, pdf_infos.task_state))
+        documents.append(_metadata(pdf_infos, pdf_from_db))
+    next_cursor = None
+    if len(rows) > limit:
+        last_pdf, last_key = rows[limit - 1]
+        next_cursor = _encode_cursor(sort, descending, last_key, last_pdf.id)
+    return {"documents": documents, "next_cursor": next_cursor}, 200
+
+
+@flask_app.route('/wait/<pdf_id>', methods=['GET'])
+@limiter.limit("20/minute, 1/second", override_defaults=False)
+def wait_info(pdf_id: str) -> tuple[dict[str, str], int]:
+    """Wait for the end of the extraction of a pdf file, then get its metadata
+    Each call holds a server thread until the end of the extraction or MAX_WAIT_TIMEOUT seconds, limited by the
+    rate limits of the client only: the waiting clients can take all the threads of a pool of sync workers
+    ---
+    parameters:
+          - name: pdf_id
+            in: path
+            description: The provided unique ID of the document to wait for
+            required: true
+          - name: timeout
+            in: query
+            description: The maximum number of seconds to wait (30 by default)
+            required: false
+    responses:
+        200:
+            description: The extraction is over (SUCCESS or FAILURE), returns metadata about the document
+        202:
+            description: The timeout expired before the end of the extraction, returns the current metadata
+    """
+    timeout = min(request.args.get('timeout', default=30, type=float), MAX_WAIT_TIMEOUT)
+    pdf_infos = PdfInfos()
+    pdf_form_db = _manage_task(pdf_infos, pdf_id)
+    if not pdf_form_db:
+        return {"error": "PDF not found. Thanks to verify the id."}, 404
+    if pdf_infos.task_state not in TERMINAL_STATES:
+        # Block on the notification of the finalizer instead of polling the db
+        pubsub = redis_client.pubsub(ignore_subscribe_messages=True)
+        try:
+            pubsub.subscribe(FINALIZED_CHANNEL + pdf_infos.uid)
+            # The finalizer may have published before the subscription
+            pdf_form_db = _manage_task(pdf_infos, pdf_id)
+            deadline = time.monotonic() + timeout
+            while pdf_infos.task_state not in TERMINAL_STATES and time.monotonic() < deadline:
+                if pubsub.get_message(timeout=deadline - time.monotonic()):
+                    pdf_form_db = _manage_task(pdf_infos, pdf_id)
+        except redis.RedisError as err:
+            return {"error": str(err)}, 500
+        finally:
+            pubsub.close()
+    if pdf_infos.task_state in TERMINAL_STATES:
+        return _metadata(pdf_infos, pdf_form_db), 200
+    return _metadata(pdf_infos, pdf_form_db), 202
+
+
+@flask_app.route('/search', methods=['GET'])
+@limiter.limit("20/minute, 1/second", override_defaults=False)
+def search_texts() -> tuple[dict, int]:
+    """Search the pages of the extracted texts, the most relevant first
+    ---
+    parameters:
+          - name: q
+            in: query
+            description: The words to find, with the FTS5 syntax ("a phrase", prefix*, AND, OR, NOT, NEAR(...))
+            required: true
+          - name: limit
+            in: query
+            description: The number of results (20 by default, 100 at most)
+            required: false
+          - name: offset
+            in: query
+            description: The number of results to skip, given by next_offset
+            required: false
+    responses:
+        200:
+            description: Returns the matching pages (document, page, snippet, score) and the offset of the next results
+        400:
+            description: Missing or invalid query
+    """
+    query = request.args.get('q', default='').strip()
+    limit = min(max(request.args.get('limit', default=SEARCH_PAGE_SIZE, type=int), 1), MAX_SEARCH_PAGE_SIZE)
+    offset = max(request.args.get('offset', default=0, type=int), 0)
+    if not query:
+        return {"error": "Invalid query ; Provide the words to find in q."}, 400
+    # One more result tells whether there is a next page, without counting all the matches
+    results = service.db_search_pages(query, limit + 1, offset, SEARCH_SNIPPET_WORDS, SEARCH_HIGHLIGHT)
+    if results is None:
+        return {"error": "Invalid query ; Check the quotes and the operators (AND, OR, NOT, NEAR)."}, 400
+    for result in results:
+        result["link"] = f"{request.url_root}text/{result['_id']}/pages?first={result['page']}"
+    return {
+        "query": query,
+        "results": results[:limit],
+        "next_offset": offset + limit if len(results) > limit else None
+    }, 200
+
+
 @flask_app.route('/text/<pdf_id>')
 @limiter.limit("20/minute, 1/second", override_defaults=False)
 def get_text(pdf_id: str) -> tuple[Response, int] | tuple[dict[str, str], int]:
@@ -263,14 +703,96 @@ def get_text(pdf_id: str) -> tuple[Response, int] | tuple[dict[str, str], int]:
         required: true
     responses:
       200:
-        description: Returns the text content of the document
+        description: Returns the text content of the document, with an ETag
+      202:
+        description: The text is not extracted yet
+      304:
+        description: The text did not change since the ETag provided in If-None-Match
     """
     pdf_infos = PdfInfos()
-    if _manage_task(pdf_infos, pdf_id):
-        return send_file(pdf_infos.txt, as_attachment=True, mimetype='text/plain'), 200
+    document = _get_metadata(pdf_infos, pdf_id)
+    if document:
+        # The text is streamed from the storage where the worker wrote it
+        txt_name = service.fs_find_text(TXT_FOLDER_PATH, pdf_infos.uid + TXT_EXT, GZIP_EXT) \
+            if document["task_state"] == "SUCCESS" else None
+        if txt_name:
+            # The status is left to send_file, which answers 304 to a matching If-None-Match
+            return _send_text(txt_name, pdf_infos.uid + TXT_EXT, as_attachment=True)
+        if document["task_state"] != "FAILURE":
+            return {"error": "Text not extracted yet, please retry later.", "task_state": document["task_state"]}, 202
     return {"error": "Invalid ID ; No text file corresponding."}, 404
 
 
+@flask_app.route('/text/<pdf_id>/pages', methods=['GET'])
+@limiter.limit("20/minute, 1/second", override_defaults=False)
+def get_text_pages(pdf_id: str) -> Response | tuple[dict, int]:
+    """Get the text of a page or of a range of pages of the document with the provided unique ID.
+    ---
+    parameters:
+      - in: path
+        name: pdf_id
+        description: The provided unique ID of the document
+        required: true
+      - in: query
+        name: first
+        description: The number of the first page, from 1
+        required: true
+      - in: query
+        name: last
+        description: The number of the last page, included (the first one by default)
+        required: false
+    responses:
+      200:
+        description: Returns the text of the pages, each of them ended by a form feed, with the number of pages,
+                     as soon as the worker published them
+      202:
+        description: The pages are not extracted yet
+      304:
+        description: The text did not change since the ETag provided in If-None-Match
+      400:
+        description: Invalid page numbers
+      404:
+        description: Invalid ID, or text extracted before the pages were indexed
+      416:
+        description: The first page is beyond the end of the document
+    """
+    first = request.args.get('first', type=int)
+    last = request.args.get('last', default=first, type=int)
+    if first is None or last is None or first < 1 or last < first:
+        return {"error": "Invalid page numbers ; Provide first (from 1) and last >= first."}, 400
+    pdf_infos = PdfInfos()
+    document = _get_metadata(pdf_infos, pdf_id)
+    if not document or document["task_state"] == "FAILURE":
+        return {"error": "Invalid ID ; No text file corresponding."}, 404
+    if document["task_state"] != "SUCCESS":
+        # The worker publishes the pages as it extracts them: the first ones are readable long before the end
+        response = _published_pages_response(pdf_infos.uid, first, last)
+        if response is None:
+            return {"error": "Pages not extracted yet, please retry later.", "task_state": document["task_state"],
+                    "progress": document["progress"]}, 202
+        return response
+    txt_name = service.fs_find_text(TXT_FOLDER_PATH, pdf_infos.uid + TXT_EXT, GZIP_EXT)
+    index_name = service.fs_find_file(TXT_FOLDER_PATH, pdf_infos.uid + TXT_EXT + INDEX_EXT)
+    index = service.fs_load_index(os.path.join(TXT_FOLDER_PATH, index_name)) if index_name else None
+    if not txt_name or not index:
+        return {"error": "No page index for this text ; Download the whole text."}, 404
+    page_count = len(index["text"]) - 1
+    if first > page_count:
+        return {"error": "Page out of range.", "pages": page_count}, 416
+    last = min(last, page_count)
+    txt_path = os.path.join(TXT_FOLDER_PATH, txt_name)
+    try:
+        response = _pages_response(txt_path, index, first, last)
+    except FileNotFoundError:
+        # Purged by the retention since the lookup
+        return {"error": "Invalid ID ; No text file corresponding."}, 404
+    response.headers['X-Page-Count'] = str(page_count)
+    stat = os.stat(txt_path)
+    response.set_etag(f"{stat.st_mtime}-{stat.st_size}-{first}-{last}")
+    response.last_modified = stat.st_mtime
+    return response.make_conditional(request)
+
+
 @flask_app.route('/storage/files/<pdf_name>', methods=['GET'])
 @limiter.limit("20/minute, 1/second", override_defaults=False)
 def display_txt(pdf_name):
@@ -287,12 +809,347 @@ def display_txt(pdf_name):
             content:
                 type: file
         """
-    txt_path = os.path.join(TXT_FOLDER_PATH, pdf_name)
-    if service.file_exists(txt_path):
-        return send_from_directory('storage/files', pdf_name), 200
+    pdf_name = secure_filename(pdf_name)
+    txt_name = service.fs_find_text(TXT_FOLDER_PATH, pdf_name, GZIP_EXT)
+    if txt_name:
+        # The status is left to _send_text (200, 206 or 304)
+        return _send_text(txt_name, pdf_name, as_attachment=False)
     return {"error": "Invalid ID ; No text file corresponding."}, 404
 
 
+def _send_text(txt_name: str, download_name: str, as_attachment: bool) -> Response:
+    """Send a stored text from the disk, with its length, answering the conditional and range requests
+    The compressed bytes are sent as they are when the client accepts gzip
+    :param txt_name: (str) The path of the text relative to the text folder
+    :param download_name: (str) The name of the text for the client
+    :param as_attachment: (bool) Download the text rather than display it
+    :return: (Response) The text (200), a part of it (206), or 304 to a matching If-None-Match
+    """
+    txt_path = os.path.join(TXT_FOLDER_PATH, txt_name)
+    if not txt_name.endswith(GZIP_EXT) or request.accept_encodings['gzip']:
+        # send_file lets the WSGI server (or the front server with USE_X_SENDFILE) copy the file to the socket
+        response = send_file(txt_path, as_attachment=as_attachment, download_name=download_name,
+                             mimetype='text/plain', conditional=True)
+        if txt_name.endswith(GZIP_EXT):
+            response.headers['Content-Encoding'] = 'gzip'
+            response.vary.add('Accept-Encoding')
+        # Tell the clients of a full download that they can read the rest by parts
+        response.accept_ranges = 'bytes'
+        return response
+    # Decompressed on the fly: the representation differs from the stored bytes, and so does its ETag.
+    # werkzeug's FileWrapper, unlike the server's one, never sends the compressed bytes of the descriptor,
+    # and a range request seeks in the text without holding it in memory
+    stat = os.stat(txt_path)
+    response = Response(FileWrapper(gzip.open(txt_path, 'rb'), service.CHUNK_SIZE), mimetype='text/plain',
+                        direct_passthrough=True)
+    if as_attachment:
+        response.headers.set('Content-Disposition', 'attachment', filename=download_name)
+    response.set_etag(f"{stat.st_mtime}-{stat.st_size}-identity")
+    response.last_modified = stat.st_mtime
+    response.vary.add('Accept-Encoding')
+    text_size = service.fs_gzip_size(txt_path)
+    response.content_length = text_size
+    response.accept_ranges = 'bytes'
+    return response.make_conditional(request, accept_ranges=True, complete_length=text_size)
+
+
+def _check_pdf_file(pdf_file) -> tuple[dict[str, str], int] | None:
+    """Verify that an uploaded file is a PDF that can be processed
+    :param pdf_file: (file object) The file object provide by the request
+    :return: The error response, None if the file is valid
+    """
+    with registry.timer('balth_upload_validation_seconds'):
+        return _pdf_file_error(pdf_file)
+
+
+def _pdf_file_error(pdf_file) -> tuple[dict[str, str], int] | None:
+    # Verify that the document post is not empty
+    if not service.file_provided(file=pdf_file):
+        return {"error": "No pdf file provided."}, 400
+    # Verify that the file has the .pdf extension
+    if not service.file_valid_extension(file=pdf_file, ext=PDF_EXT):
+        return {"error": "Invalid file EXT. Please upload a '" + PDF_EXT + "' file."}, 415
+    # Verify that file is PDF MIMETYPE
+    if not service.file_valid_mimetype(file=pdf_file, mimetype='PDF'):
+        return {"error": "Invalid file type. Please upload a PDF file."}, 415
+    # Verify the declared document size, to reject it before reading it
+    if not service.file_valid_size(file=pdf_file, max_size=MAX_FILE_SIZE):
+        return {"error": "File size exceeded the maximum limit (" + str(MAX_FILE_SIZE_MB) + " mb)."}, 413
+    return None
+
+
+def _set_new_pdf_infos(pdf_infos, pdf_file) -> None:
+    # Create a unique ID to identify the pdf document
+    pdf_infos.set_uid(str(uuid4()))
+    pdf_infos.set_pdf_path(pdf_infos.uid)
+    pdf_infos.set_name(pdf_file.filename)
+    # The task id is chosen here to store the entry before the task can be finalized
+    pdf_infos.set_task_id(uuid4())
+
+
+def _save_temp_pdf(pdf_infos, pdf_file) -> tuple[dict[str, str], int] | None:
+    """Stream the uploaded file to the temp folder and keep its content hash
+    :param pdf_infos: (PdfInfos) The new PDF, with its pdf_path
+    :param pdf_file: (file object) The file object provide by the request
+    :return: The error response, None if the file is stored
+    """
+    with registry.timer('balth_temp_write_seconds'):
+        content_hash = service.fs_save_temp_pdf(pdf_file, pdf_infos.pdf_path, max_size=MAX_FILE_SIZE)
+    if content_hash is None:
+        return {"error": "File size exceeded the maximum limit (" + str(MAX_FILE_SIZE_MB) + " mb)."}, 413
+    pdf_infos.set_content_hash(content_hash)
+    pdf_infos.set_size(os.path.getsize(pdf_infos.pdf_path))
+    registry.inc('balth_uploaded_bytes_total', pdf_infos.size)
+    return None
+
+
+def _pages_response(txt_path: str, index: dict, first: int, last: int) -> Response:
+    """Stream the pages [first, last] of a stored text, at the offsets of its index
+    :param txt_path: (str) The path to the stored text
+    :param index: (dict) The offsets of the pages of the text (service.fs_load_index)
+    :param first: (int) The number of the first page in the text, from 1
+    :param last: (int) The number of the last page in the text, included
+    :return: (Response) The text of the pages, with its length
+    """
+    # Only the stored bytes of the pages are read, and decompressed if needed
+    pages = service.fs_read_pages(txt_path, index["stored"][first - 1], index["stored"][last], index["compressed"])
+    response = Response(pages, mimetype='text/plain', direct_passthrough=True)
+    response.content_length = index["text"][last] - index["text"][first - 1]
+    return response
+
+
+def _published_pages_response(uid: str, first: int, last: int) -> Response | None:
+    """Stream the pages [first, last] published by the workers while they extract a document
+    :param uid: (str) The PDF uuid
+    :param first: (int) The number of the first page, from 1
+    :param last: (int) The number of the last page, included
+    :return: (Response) The text of the pages, None if they are not published yet
+    """
+    # The merge of the chunks removes the parts once the whole text is indexed, maybe between the lookup
+    # and the read: the pages are then looked up again, in the whole text
+    for _ in range(2):
+        published = _published_pages(uid, first, last)
+        if published is None:
+            return None
+        txt_name, index, end = published
+        # The parts of the chunks start at their first page
+        offset = index.get("first", 0)
+        try:
+            response = _pages_response(os.path.join(TXT_FOLDER_PATH, txt_name), index, first - offset, end - offset)
+        except FileNotFoundError:
+            continue
+        if index.get("pages"):
+            response.headers['X-Page-Count'] = str(index["pages"])
+        # Not cached: the pages come from a text being written, the whole text replaces it
+        response.cache_control.no_store = True
+        return response
+    return None
+
+
+def _published_pages(uid: str, first: int, last: int) -> tuple[str, dict, int] | None:
+    """Find the pages [first, last] in the texts published by the workers while they extract a document:
+    the text itself, or the parts extracted in parallel until their merge
+    :param uid: (str) The PDF uuid
+    :param first: (int) The number of the first page, from 1
+    :param last: (int) The number of the last page, included
+    :return: (tuple) The path to the text or part relative to the storage, its index and the last page in the
+    document, None if the pages are not published yet
+    """
+    txt_name = uid + TXT_EXT
+    sources = [(index_name[:-len(INDEX_EXT)], index_name)
+               for index_name in service.fs_find_part_indexes(TXT_FOLDER_PATH, txt_name, INDEX_EXT)]
+    index_name = service.fs_find_file(TXT_FOLDER_PATH, txt_name + INDEX_EXT)
+    text_name = service.fs_find_text(TXT_FOLDER_PATH, txt_name, GZIP_EXT)
+    if index_name and text_name:
+        sources.append((text_name, index_name))
+    for text_name, index_name in sources:
+        index = service.fs_load_index(os.path.join(TXT_FOLDER_PATH, index_name))
+        if not index:
+            continue
+        # The last page of the document, when the worker could count them
+        end = min(last, index["pages"]) if index.get("pages") else last
+        start = index.get("first", 0) + 1
+        if start <= first <= end < start + len(index["text"]) - 1:
+            return text_name, index, end
+    return None
+
+
+def _quarantined_error() -> tuple[dict[str, str], int]:
+    # The same poison file would fail the same way, after holding a worker until its limits
+    registry.inc('balth_quarantine_rejections_total')
+    return {"error": "This file cannot be processed: its extraction failed and its content is quarantined."}, 422
+
+
+def _data_to_store(pdf_infos) -> dict[str, str]:
+    # Prepare the data to be stored in the DB
+    data_to_store = {
+        'id': pdf_infos.uid,
+        'name': pdf_infos.name,
+        'task_id': pdf_infos.task_id,
+        'content_hash': pdf_infos.content_hash
+    }
+    if pdf_infos.batch_id:
+        data_to_store['batch_id'] = pdf_infos.batch_id
+    return data_to_store
+
+
+def _extraction_signature(pdf_infos, priority: int = 0):
+    """Prepare the extraction task of one PDF, linked to the finalizer
+    :param pdf_infos: (PdfInfos) The PDF to extract, with its uid, task_id and size
+    :param priority: (int) The priority of the task in its queue, 0 first
+    :return: (Signature) The task, to send with apply_async()
+    """
+    # The finalizer releases the slot of the client in the queues
+    client = {'client': _client_key()}
+    return celery_app.signature(
+        'tasks.extract_data',
+        args=[pdf_infos.uid + PDF_EXT],
+        task_id=pdf_infos.task_id,
+        queue=LARGE_QUEUE if pdf_infos.size >= LARGE_FILE_SIZE else SMALL_QUEUE,
+        priority=priority,
+        # The enqueue time gives the finalizer the time spent in the queue
+        link=celery_app.signature('finalizer.finalize_extraction', args=(pdf_infos.uid, request.url_root, time.time()),
+                                  kwargs=client, queue=FINALIZE_QUEUE),
+        link_error=celery_app.signature('finalizer.finalize_failure',
+                                        args=(pdf_infos.uid,), kwargs=client, queue=FINALIZE_QUEUE))
+
+
+def _client_key() -> str:
+    # The same client identity as the rate limits
+    return get_remote_address()
+
+
+def _reserve_priorities(count: int) -> list[int]:
+    """Count the new tasks of the client in the queues and give each one its priority
+    :param count: (int) The number of tasks the client is sending
+    :return: (list) The priority of each task, lower as the client has more tasks in the queues
+    """
+    key = INFLIGHT_PREFIX + _client_key()
+    try:
+        pipeline = redis_client.pipeline()
+        # The time to live starts with the count and is not extended by the next uploads:
+        # the slots of the tasks lost before their finalizer (purged queues) are forgotten with it
+        pipeline.set(key, 0, ex=INFLIGHT_TTL, nx=True)
+        pipeline.incrby(key, count)
+        inflight = pipeline.execute()[1] - count
+    except redis.RedisError:
+        inflight = 0
+    return [min(MAX_PRIORITY, (inflight + index) // FAIRNESS_STEP) for index in range(count)]
+
+
+def _release_priorities(count: int) -> None:
+    """Give back the slots reserved for tasks which could not be sent, as the finalizer does for the others
+    :param count: (int) The number of tasks not sent
+    :return: None
+    """
+    key = INFLIGHT_PREFIX + _client_key()
+    try:
+        if redis_client.decrby(key, count) <= 0:
+            redis_client.delete(key)
+    except redis.RedisError:
+        pass
+
+
+def _clean_new_pdfs(pdfs_infos: list) -> None:
+    # Remove the entries and the PDF from storage
+    service.db_delete_pdfs([pdf_infos.uid for pdf_infos in pdfs_infos])
+    for pdf_infos in pdfs_infos:
+        if os.path.exists(pdf_infos.pdf_path):
+            service.fs_remove_temp_pdf(pdf_infos.pdf_path)
+
+
+def _metadata(pdf_infos, pdf_from_db) -> dict[str, str]:
+    # The public view of one document
+    return {
+        "_id": pdf_infos.uid,
+        "name": pdf_infos.name,
+        "link": pdf_infos.link,
+        "data": pdf_infos.data,
+        "task_state": pdf_infos.task_state,
+        "pages": pdf_from_db.page_count,
+        "progress": pdf_infos.progress,
+        "created_at": str(pdf_from_db.created_at)
+    }
+
+
+def _get_metadata(pdf_infos, pdf_id: str) -> dict[str, str] | None:
+    """Get the public view of one document, from the cache once it is in a terminal state
+    :param pdf_infos: (PdfInfos) Filled with the uid and the paths of the document
+    :param pdf_id: (str) The PDF uuid
+    :return: (dict) The metadata, None if the document does not exist
+    """
+    pdf_infos.set_uid(str(pdf_id))
+    pdf_infos.set_pdf_path(pdf_infos.uid)
+    pdf_infos.set_txt_path(pdf_infos.uid)
+    document = result_cache.get(pdf_infos.uid)
+    if document is None:
+        pdf_form_db = _manage_task(pdf_infos, pdf_id)
+        if not pdf_form_db:
+            return None
+        document = _metadata(pdf_infos, pdf_form_db)
+        # A terminal result does not change anymore
+        if document["task_state"] in TERMINAL_STATES:
+            result_cache.set(pdf_infos.uid, document)
+    return document
+
+
+def _encode_cursor(sort: str, descending: bool, key, pdf_id: str) -> str:
+    # The position after the last document of a page, opaque for the clients
+    raw = json.dumps([sort, descending, key, pdf_id]).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+
+def _decode_cursor(cursor: str, sort: str, descending: bool) -> tuple | None:
+    """Read the position given by _encode_cursor
+    :param cursor: (str) The cursor received from the client
+    :param sort: (str) The sort column of the request
+    :param descending: (bool) The sort order of the request
+    :return: (tuple) The sort key and the id of the last document, None if the cursor is invalid or of another sort
+    """
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        cursor_sort, cursor_descending, key, pdf_id = json.loads(raw)
+    except (ValueError, TypeError):
+        return None
+    if cursor_sort != sort or cursor_descending != descending or not isinstance(pdf_id, str) \
+            or not isinstance(key, (str, int, float, type(None))):
+        return None
+    return key, pdf_id
+
+
+def _live_task_states(task_ids: list[str]) -> dict[str, str]:
+    """Read the states of many Celery tasks in one round-trip to the result backend
+    :param task_ids: (list) The Celery task ids
+    :return: (dict) The state by task id, for the tasks known by the backend and not terminated
+    """
+    if not task_ids:
+        return {}
+    try:
+        backend = celery_app.backend
+        values = backend.mget([backend.get_key_for_task(task_id) for task_id in task_ids])
+    except Exception:
+        return {}
+    states = {}
+    for task_id, value in zip(task_ids, values):
+        if value:
+            state = backend.decode_result(value)['status']
+            # The result is persisted by the finalizer, do not report it before the db is up to date
+            if state not in TERMINAL_STATES:
+                states[task_id] = state
+    return states
+
+
+def _load_pdf_infos(pdf_infos, pdf_from_db) -> None:
+    # Fill the pdf infos with its entry in the DB
+    pdf_infos.set_uid(pdf_from_db.id)
+    pdf_infos.set_pdf_path(pdf_infos.uid)
+    pdf_infos.set_txt_path(pdf_infos.uid)
+    pdf_infos.set_data(pdf_from_db.data)
+    pdf_infos.set_name(pdf_from_db.name)
+    pdf_infos.set_task_state(pdf_from_db.task_state)
+    pdf_infos.set_link(request.url_root)
+
+
 def _manage_task(pdf_infos, pdf_id: str):
     pdf_infos.set_uid(str(pdf_id))
     pdf_infos.set_pdf_path(pdf_infos.uid)
@@ -301,51 +1158,19 @@ def _manage_task(pdf_infos, pdf_id: str):
     pdf_form_db = service.db_get_pdf_info(pdf_infos.uid)
     # Check if the pdf entry exists in the DB
     if pdf_form_db:
-        pdf_infos.set_data(pdf_form_db.data)
-        pdf_infos.set_txt('')
-        pdf_infos.set_name(pdf_form_db.name)
-        pdf_infos.set_task_state(pdf_form_db.task_state)
-        pdf_infos.set_link(request.url_root)
-        # Get task info in Celery with task_id
-        try:
-            async_task = celery_app.AsyncResult(pdf_form_db.task_id, app=celery_app)
-            pdf_infos.set_task_state(async_task.state)
-            service.db_update_pdf_task_state(pdf_infos.uid, pdf_infos.task_state)
-        except Exception:
-            pass
-        if pdf_infos.task_state == "SUCCESS":
-            # The asynchronous process is definitively achieved
-            # Prepare to return the updated data from Celery to the customer
-            pdf_infos.set_data(async_task.result['data'])
-            pdf_infos.set_txt(async_task.result['text'])
-            # Save the txt extracted from PDF in a file txt
-            if not service.file_exists(pdf_infos.txt_path):
-                service.fs_save_text(pdf_infos.txt, pdf_infos.txt_path)
-            # TODO: just one db access
-            # Update news in DB
-            service.db_update_pdf_metadata(pdf_infos.uid, pdf_infos.data)
-            # Update DB with the link to the file containing the extracted txt from the PDF
-            service.db_update_link(pdf_infos.uid, pdf_infos.link)
-            # Remove the temp PDF file from storage
+        _load_pdf_infos(pdf_infos, pdf_form_db)
+        # The finalizer stores the terminal states, before that Celery tells if the task is started
+        if pdf_infos.task_state not in TERMINAL_STATES:
             try:
-                service.fs_remove_temp_pdf(pdf_infos.pdf_path)
+                async_task = celery_app.AsyncResult(pdf_form_db.task_id, app=celery_app)
+                # The result is persisted by the finalizer, do not report it before the db is up to date
+                if async_task.state not in TERMINAL_STATES:
+                    pdf_infos.set_task_state(async_task.state)
+                    if async_task.state == "PROGRESS":
+                        pdf_infos.set_progress(async_task.info)
             except Exception:
                 pass
-        elif pdf_infos.task_state == "FAILURE":
-            # In case of failure, we prefer to clean our db of this unless PDF entry
-            # The customer needs to retry later
-            try:
-                service.db_delete_pdf(pdf_infos.uid)
-            except Exception:
-                pass
-            # Remove the temp PDF file from storage
-            try:
-                service.fs_remove_temp_pdf(pdf_infos.pdf_path)
-            except Exception:
-                pass
-
-        return True
-    return False
+    return pdf_form_db
 
 
 if __name__ == '__main__':
@@ -0,0 +1,106 @@
+# coding: utf-8
+"""
+Created on January 20th, 2023
+@title: Balth App
+@version: 2.1
+@author: Balthazar Méhus
+@society: CentraleSupélec
+@abstract: Python PDF extraction and storage - Cache of the terminal results read by the API
+"""
+
+import json
+import threading
+import time
+from collections import OrderedDict
+
+
+class TTLCache:
+    """A bounded in-process LRU whose entries expire after a time to live"""
+
+    def __init__(self, max_size: int, ttl: float):
+        self._max_size = max_size
+        self._ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str):
+        """Get a value and mark it as recently used
+        :param key: (str) The key
+        :return: The value, None if it is absent or expired
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires_at, value = entry
+            if expires_at < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key: str, value) -> None:
+        """Store a value, evicting the least recently used ones beyond the maximum size
+        :param key: (str) The key
+        :param value: The value
+        :return: None
+        """
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self._ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self._max_size:
+                self._entries.popitem(last=False)
+
+    def delete(self, key: str) -> None:
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class ResultCache:
+    """The in-process cache, backed by redis when a client is given to share the entries between the API processes"""
+
+    def __init__(self, max_size: int, ttl: int, redis_client=None, prefix: str = 'balth:cache:'):
+        self._local = TTLCache(max_size, ttl)
+        self._ttl = ttl
+        self._redis = redis_client
+        self._prefix = prefix
+
+    def get(self, key: str) -> dict | None:
+        """Get a cached result, from the process first, then from redis
+        :param key: (str) The pdf uuid
+        :return: (dict) The result, None if it is not cached
+        """
+        value = self._local.get(key)
+        if value is None and self._redis is not None:
+            try:
+                raw_value = self._redis.get(self._prefix + key)
+            except Exception:
+                return None
+            if raw_value is not None:
+                value = json.loads(raw_value)
+                self._local.set(key, value)
+        return value
+
+    def set(self, key: str, value: dict) -> None:
+        """Cache a result, which must not change anymore
+        :param key: (str) The pdf uuid
+        :param value: (dict) The result, JSON serializable
+        :return: None
+        """
+        self._local.set(key, value)
+        if self._redis is not None:
+            try:
+                self._redis.setex(self._prefix + key, self._ttl, json.dumps(value))
+            except Exception:
+                pass
+
+    def delete(self, key: str) -> None:
+        self._local.delete(key)
+        if self._redis is not None:
+            try:
+                self._redis.delete(self._prefix + key)
+            except Exception:
+                pass
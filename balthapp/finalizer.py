@@ -0,0 +1,223 @@
+# coding: utf-8
+"""
+Created on January 20th, 2023
+@title: Balth App
+@version: 2.1
+@author: Balthazar Méhus
+@society: CentraleSupélec
+@abstract: Python PDF extraction and storage - Celery callbacks persisting the extraction results (text, metadata, page index, timings) and releasing the queue slots
+Run it from balthapp: celery -A finalizer worker -Q finalize --loglevel=INFO
+and its schedule: celery -A finalizer beat --loglevel=INFO
+"""
+
+import json
+import os
+
+import redis
+import retention
+import service
+from celery import Celery
+from celery.utils.log import get_task_logger
+from config import (CACHE_REDIS, CHUNKS_PREFIX, FINALIZE_MAX_RETRIES,
+                    FINALIZE_QUEUE, FINALIZED_CHANNEL, GZIP_EXT, INFLIGHT_PREFIX, LIMIT_ERRORS,
+                    PDF_EXT, PDF_FOLDER_PATH, QUARANTINE_AFTER, REDIS_URI,
+                    RESULT_EXPIRES, SEARCH_INDEX, SWEEP_INTERVAL,
+                    TXT_FOLDER_PATH)
+from metrics import registry
+
+logger = get_task_logger(__name__)
+
+celery_app = Celery('finalizer',
+                    broker=REDIS_URI,
+                    backend=REDIS_URI + '/0')
+celery_app.conf.task_default_queue = FINALIZE_QUEUE
+celery_app.conf.result_expires = RESULT_EXPIRES
+
+# The storage is swept by the beat of the finalizer, on the finalize queue
+celery_app.conf.beat_schedule = {
+    'sweep-storage': {'task': 'finalizer.sweep_storage', 'schedule': SWEEP_INTERVAL},
+}
+
+# Wakes up the clients waiting on /wait/<pdf_id>
+redis_client = redis.Redis.from_url(REDIS_URI)
+# Held by the running sweep, so that two finalizers never sweep at the same time
+SWEEP_LOCK = 'balth:sweep:lock'
+
+
+class PersistError(Exception):
+    """The result of an extraction could not be written in the db, the callback is retried"""
+
+
+@celery_app.task(ignore_result=True, autoretry_for=(PersistError,), max_retries=FINALIZE_MAX_RETRIES,
+                 retry_backoff=True)
+def finalize_extraction(result: dict, pdf_id: str, url_root: str, enqueued_at: float = None,
+                        client: str = None) -> None:
+    """Linked to tasks.extract_data: persist its result as soon as the worker succeeds
+    :param result: (dict) The descriptor returned by the worker (data, txt_name, size, timings)
+    :param pdf_id: (str) The PDF uuid
+    :param url_root: (str) The root url of the API, used to build the link to the text file
+    :param enqueued_at: (float) The time when the API sent the task
+    :param client: (str) The client who uploaded the PDF
+    :return: None
+    """
+    link = os.path.join(url_root, TXT_FOLDER_PATH, result['txt_name'])
+    # The whole metadata as JSON, the main ones in typed columns to filter and sort the documents
+    pages = result.get('timings', {}).get('pages')
+    # The Celery result expires: a lost update would leave the document PENDING for ever
+    if not service.db_update_pdf(pdf_id, {'task_state': 'SUCCESS', 'data': json.dumps(result['data']),
+                                          'link': link, **service.metadata_columns(result['data'], pages)}):
+        raise PersistError('Cannot store the result of ' + pdf_id)
+    _remove_temp_pdf(pdf_id)
+    if SEARCH_INDEX:
+        # Searchable before the waiting clients are woken up
+        index_text(pdf_id, result['txt_name'])
+    _notify(pdf_id, 'SUCCESS')
+    _release_client(client)
+    _record_timings(result, enqueued_at)
+    logger.info('Extraction of %s finalized', pdf_id)
+
+
+@celery_app.task(ignore_result=True, autoretry_for=(PersistError,), max_retries=FINALIZE_MAX_RETRIES,
+                 retry_backoff=True)
+def finalize_failure(task_id: str, pdf_id: str, client: str = None) -> None:
+    """Linked as error callback to tasks.extract_data: the customer needs to retry later
+    :param task_id: (str) The id of the failed task
+    :param pdf_id: (str) The PDF uuid
+    :param client: (str) The client who uploaded the PDF
+    :return: None
+    """
+    if not service.db_update_pdf(pdf_id, {'task_state': 'FAILURE'}):
+        raise PersistError('Cannot store the failure of ' + pdf_id)
+    # Called even when the worker process was killed: the poison contents are caught here
+    reason = _failure_reason(task_id)
+    quarantine(pdf_id, reason)
+    _remove_temp_pdf(pdf_id)
+    _notify(pdf_id, 'FAILURE')
+    _release_client(client)
+    registry.inc('balth_extractions_total', labels={'state': 'FAILURE'})
+    logger.warning('Extraction of %s failed (task %s): %s', pdf_id, task_id, reason)
+
+
+@celery_app.task(ignore_result=True)
+def sweep_storage() -> None:
+    """Scheduled by celery beat: apply the retention policies to the db and the storage (see retention.py)
+    :return: None
+    """
+    try:
+        if not redis_client.set(SWEEP_LOCK, 1, nx=True, ex=SWEEP_INTERVAL):
+            logger.info('A sweep of the storage is already running')
+            return
+    except redis.RedisError as err:
+        logger.warning('Cannot lock the sweep of the storage: %s', err)
+        return
+    try:
+        report = retention.sweep(redis_client if CACHE_REDIS else None, celery_app, redis_client)
+    finally:
+        redis_client.delete(SWEEP_LOCK)
+    for policy, count in report.items():
+        registry.inc('balth_swept_total', count, labels={'policy': policy})
+    logger.info('Storage swept: %s', report)
+
+
+def index_text(pdf_id: str, txt_name: str) -> bool:
+    """Replace the pages of a document in the full-text search index by the ones of its stored text
+    :param pdf_id: (str) The PDF uuid
+    :param txt_name: (str) The name of the text file
+    :return: (bool) False if the text is not stored or could not be indexed
+    """
+    found = service.fs_find_text(TXT_FOLDER_PATH, txt_name, GZIP_EXT)
+    if found is None:
+        return False
+    with registry.timer('balth_search_index_seconds'):
+        pages = service.fs_iter_pages(os.path.join(TXT_FOLDER_PATH, found), found.endswith(GZIP_EXT))
+        indexed = service.db_index_pages(pdf_id, pages)
+    if not indexed:
+        logger.warning('Cannot index the text of %s for the search', pdf_id)
+    return indexed
+
+
+def quarantine(pdf_id: str, reason: str = None) -> bool:
+    """Quarantine the content of a failed extraction if it broke a limit of the worker, or failed too many times
+    :param pdf_id: (str) The PDF uuid, already in the FAILURE state
+    :param reason: (str) The name of the error which failed the extraction, None if unknown
+    :return: (bool) True if the content is quarantined
+    """
+    if not QUARANTINE_AFTER:
+        return False
+    pdf = service.db_get_pdf_info(pdf_id)
+    if pdf is None or not pdf.content_hash:
+        return False
+    if reason not in LIMIT_ERRORS and service.db_count_failures(pdf.content_hash) < QUARANTINE_AFTER:
+        return False
+    if not service.db_quarantine(pdf.content_hash, reason or 'Failures'):
+        logger.warning('Cannot quarantine the content of %s', pdf_id)
+        return False
+    registry.inc('balth_quarantined_total', labels={'reason': reason or 'Failures'})
+    logger.warning('Content %s of %s quarantined', pdf.content_hash, pdf_id)
+    return True
+
+
+def _failure_reason(task_id: str) -> str | None:
+    # The error stored by the worker, or by its parent process when a limit killed it (TimeLimitExceeded...)
+    try:
+        error = celery_app.AsyncResult(task_id).result
+        if not isinstance(error, BaseException) or type(error).__name__ == 'ChordError':
+            # A large document: the chord calls this callback before it stores its ChordError,
+            # which does not tell the cause anyway
+            error = _chunk_error(task_id) or error
+    except Exception as err:
+        logger.warning('Cannot read the error of the task %s: %s', task_id, err)
+        return None
+    return type(error).__name__ if isinstance(error, BaseException) else None
+
+
+def _chunk_error(task_id: str) -> BaseException | None:
+    # The error of the failed chunk, the one of a limit first: stored before the chord fails
+    chunk_ids = celery_app.backend.client.get(CHUNKS_PREFIX + task_id)
+    if not chunk_ids:
+        return None
+    errors = [result.result for result in map(celery_app.AsyncResult, json.loads(chunk_ids))
+              if result.state == 'FAILURE']
+    errors.sort(key=lambda error: type(error).__name__ not in LIMIT_ERRORS)
+    return errors[0] if errors else None
+
+
+def _record_timings(result: dict, enqueued_at: float = None) -> None:
+    # The workers do not reach the metrics: their results carry the timings of each stage
+    registry.inc('balth_extractions_total', labels={'state': 'SUCCESS'})
+    registry.inc('balth_extracted_bytes_total', result.get('size', 0))
+    timings = result.get('timings')
+    if not timings:
+        return
+    if enqueued_at:
+        registry.observe('balth_queue_wait_seconds', max(0.0, timings['started_at'] - enqueued_at))
+    registry.observe('balth_text_extraction_seconds', timings['text_seconds'])
+    registry.observe('balth_metadata_extraction_seconds', timings['metadata_seconds'])
+    registry.inc('balth_extracted_pages_total', timings['pages'])
+
+
+def _remove_temp_pdf(pdf_id: str) -> None:
+    # Remove the temp PDF file from storage
+    try:
+        service.fs_remove_temp_pdf(os.path.join(PDF_FOLDER_PATH, pdf_id + PDF_EXT))
+    except FileNotFoundError:
+        pass
+
+
+def _release_client(client: str = None) -> None:
+    # One task less in the queues for the client, whose next uploads get a better priority
+    if not client:
+        return
+    try:
+        if redis_client.decr(INFLIGHT_PREFIX + client) <= 0:
+            redis_client.delete(INFLIGHT_PREFIX + client)
+    except redis.RedisError as err:
+        logger.warning('Cannot release a task of %s: %s', client, err)
+
+
+def _notify(pdf_id: str, task_state: str) -> None:
+    # The db is up to date: the waiting clients can read it
+    try:
+        redis_client.publish(FINALIZED_CHANNEL + pdf_id, task_state)
+    except redis.RedisError as err:
+        logger.warning('Cannot notify the end of %s: %s', pdf_id, err)
@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+# coding: utf-8
+"""
+Created on January 20th, 2023
+@title: Balth App
+@version: 2.1
+@author: Balthazar Méhus
+@society: CentraleSupélec
+@abstract: Python PDF extraction and storage - Maintenance commands
+Run it from balthapp: python manage.py migrate [--status]
+                      python manage.py migrate-storage [--dry-run]
+                      python manage.py index-texts
+                      python manage.py normalize-metadata
+                      python manage.py quarantine [--release <hash>]
+"""
+
+import argparse
+import json
+import os
+
+import finalizer
+import migrations
+import model
+import service
+from config import SWEEP_BATCH_SIZE, TXT_EXT, TXT_FOLDER_PATH
+
+
+def migrate_db(status: bool = False) -> str:
+    """Apply the pending migrations of the db schema (BALTH_DB_URL), or tell the version
+    :param status: (bool) Only tell the version of the db and the latest one
+    :return: (str) The report to print
+    """
+    if status:
+        return f"Version {migrations.current_version(model.engine)} of {migrations.latest_version()}."
+    applied = migrations.migrate(model.engine)
+    if not applied:
+        return "The schema is up to date."
+    return "Migrations applied: " + ", ".join(str(version) for version in applied) + "."
+
+
+def migrate_storage(folder: str = TXT_FOLDER_PATH, dry_run: bool = False) -> int:
+    """Move the texts stored at the root of the folder to their sub-folder (ab/cd/<uuid>.txt)
+    The API and the worker read both layouts: the migration can run while they serve, and again after a failure
+    :param folder: (str) The storage folder of the texts
+    :param dry_run: (bool) Only count the files to move
+    :return: (int) The number of files moved
+    """
+    moved = 0
+    with os.scandir(folder) as entries:
+        for entry in entries:
+            if not entry.is_file() or entry.name.startswith('.'):
+                continue
+            if not dry_run:
+                target = os.path.join(folder, service.fs_shard_name(entry.name))
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                # A rename in the same file system: the text is never missing nor partial
+                os.replace(entry.path, target)
+            moved += 1
+    return moved
+
+
+def index_texts(batch_size: int = SWEEP_BATCH_SIZE) -> int:
+    """Index for the full-text search the texts extracted before it, or while it was disabled (BALTH_SEARCH_INDEX=0)
+    :param batch_size: (int) The number of documents looked up at once
+    :return: (int) The number of documents indexed
+    """
+    indexed = 0
+    last_id = ''
+    # The texts without any word get no page: the uuids are walked through once, in order
+    while pdf_ids := service.db_get_unindexed_pdf_ids(batch_size, after=last_id):
+        indexed += sum(finalizer.index_text(pdf_id, pdf_id + TXT_EXT) for pdf_id in pdf_ids)
+        last_id = pdf_ids[-1]
+    return indexed
+
+
+def normalize_metadata(batch_size: int = SWEEP_BATCH_SIZE) -> int:
+    """Fill the typed columns (title, author, creation_date...) of the documents extracted before them
+    The number of pages was not kept: it stays unknown for these documents
+    :param batch_size: (int) The number of documents read at once
+    :return: (int) The number of documents updated
+    """
+    updated = 0
+    last_id = ''
+    while pdfs := service.db_get_extracted_pdfs(batch_size, after=last_id):
+        for pdf in pdfs:
+            try:
+                data = json.loads(pdf.data)
+            except ValueError:
+                # The metadata stored as text by the first versions cannot be read back
+                continue
+            if isinstance(data, dict) and service.db_update_pdf(pdf.id, service.metadata_columns(data)):
+                updated += 1
+        last_id = pdfs[-1].id
+    return updated
+
+
+def list_quarantine() -> str:
+    """List the quarantined contents, whose uploads are refused
+    :return: (str) The report to print, one content by line
+    """
+    quarantined = service.db_get_quarantine()
+    if not quarantined:
+        return "No content in quarantine."
+    return "\n".join(f"{entry.content_hash} {entry.reason} {entry.created_at}" for entry in quarantined)
+
+
+def _parse_args():
+    parser = argparse.ArgumentParser(description="Maintenance commands of the balthapp storage.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    migrate_db_parser = commands.add_parser("migrate", help="Apply the pending migrations of the db schema")
+    migrate_db_parser.add_argument("--status", action="store_true", help="Only tell the version of the schema")
+    migrate = commands.add_parser("migrate-storage",
+                                  help="Move the texts of storage/files to the sub-folders layout (ab/cd/<uuid>.txt)")
+    migrate.add_argument("--dry-run", action="store_true", help="Only count the files to move")
+    commands.add_parser("index-texts", help="Index for the full-text search the texts which are not indexed yet")
+    commands.add_parser("normalize-metadata",
+                        help="Fill the typed metadata columns of the documents extracted before them")
+    quarantine = commands.add_parser("quarantine", help="List the quarantined contents, or release one")
+    quarantine.add_argument("--release", metavar="HASH", help="Accept again the uploads of this content")
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = _parse_args()
+    if args.command == "migrate":
+        print(migrate_db(status=args.status))
+    elif args.command == "migrate-storage":
+        count = migrate_storage(dry_run=args.dry_run)
+        print(str(count) + (" files to move." if args.dry_run else " files moved."))
+    elif args.command == "index-texts":
+        print(str(index_texts()) + " texts indexed.")
+    elif args.command == "normalize-metadata":
+        print(str(normalize_metadata()) + " documents updated.")
+    elif args.command == "quarantine":
+        if args.release:
+            released = service.db_release_quarantine(args.release)
+            print("Content released." if released else "This content is not in quarantine.")
+        else:
+            print(list_quarantine())
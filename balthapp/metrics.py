@@ -0,0 +1,170 @@
+# coding: utf-8
+"""
+Created on January 20th, 2023
+@title: Balth App
+@version: 2.1
+@author: Balthazar Méhus
+@society: CentraleSupélec
+@abstract: Python PDF extraction and storage - Counters and histograms shared in redis, exposed in the Prometheus format
+# Aggregated in the process and flushed to redis every METRICS_FLUSH_INTERVAL seconds by a background thread,
+# the requests and the db sessions do not wait for redis anymore
+"""
+
+import atexit
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+import redis
+from config import METRICS_FLUSH_INTERVAL, METRICS_SOCKET_TIMEOUT, REDIS_URI
+
+# Upper bounds (seconds) of the histogram buckets
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300)
+
+# The exposed metrics: name -> (type, help)
+METRICS = {
+    'balth_http_requests_total': ('counter', 'Requests answered by the API, by endpoint and status'),
+    'balth_uploaded_bytes_total': ('counter', 'Bytes of the PDF files written in the temp storage'),
+    'balth_upload_validation_seconds': ('histogram', 'Checks of an uploaded file (extension, type, size)'),
+    'balth_temp_write_seconds': ('histogram', 'Streaming of an uploaded file to the temp storage'),
+    'balth_db_seconds': ('histogram', 'Duration of the db sessions'),
+    'balth_queue_wait_seconds': ('histogram', 'Time between the upload and the start of the extraction'),
+    'balth_text_extraction_seconds': ('histogram', 'pdfminer text extraction of a document by the worker'),
+    'balth_metadata_extraction_seconds': ('histogram', 'Metadata extraction of a document by the worker'),
+    'balth_extractions_total': ('counter', 'Finished extractions by state'),
+    'balth_extracted_pages_total': ('counter', 'Pages extracted by the workers (rate() gives the pages per second)'),
+    'balth_extracted_bytes_total': ('counter', 'Bytes of text written by the workers'),
+    'balth_search_index_seconds': ('histogram', 'Indexing of the text of a document for the full-text search'),
+    'balth_quarantined_total': ('counter', 'Contents quarantined after a failed extraction, by error'),
+    'balth_quarantine_rejections_total': ('counter', 'Uploads refused because their content is quarantined'),
+    'balth_swept_total': ('counter', 'Files and documents deleted by the retention sweeper, by policy'),
+}
+
+
+class Metrics:
+    """Counters and histograms aggregated in redis, so that every API process, the finalizer
+    and the workers' results feed the same values"""
+
+    def __init__(self, redis_client, prefix: str = 'balth:metrics:', flush_interval: float = METRICS_FLUSH_INTERVAL):
+        self._redis = redis_client
+        self._counters_key = prefix + 'counters'
+        self._histograms_key = prefix + 'histograms'
+        self._flush_interval = flush_interval
+        # The increments not yet flushed to redis, by field of the counters and histograms hashes
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._histograms = {}
+        self._pid = None
+
+    def inc(self, name: str, value: float = 1, labels: dict = None) -> None:
+        """Increment a counter, in memory until the next flush
+        :param name: (str) The name of the metric, declared in METRICS
+        :param value: (float) The increment
+        :param labels: (dict) The labels of the serie
+        :return: None
+        """
+        serie = _serie(name, labels)
+        with self._lock:
+            self._start_flusher()
+            self._counters[serie] = self._counters.get(serie, 0) + value
+
+    def observe(self, name: str, value: float, buckets: tuple = DEFAULT_BUCKETS) -> None:
+        """Add an observation to a histogram, in memory until the next flush
+        :param name: (str) The name of the metric, declared in METRICS
+        :param value: (float) The observed value
+        :param buckets: (tuple) The upper bounds of the buckets
+        :return: None
+        """
+        fields = [name + '|' + str(bound) for bound in buckets if value <= bound] + [name + '|+Inf']
+        with self._lock:
+            self._start_flusher()
+            for field in fields:
+                self._histograms[field] = self._histograms.get(field, 0) + 1
+            self._histograms[name + '|sum'] = self._histograms.get(name + '|sum', 0) + value
+
+    def flush(self) -> None:
+        """Add the increments aggregated in the process to redis, in one round-trip
+        :return: None
+        """
+        with self._lock:
+            counters, self._counters = self._counters, {}
+            histograms, self._histograms = self._histograms, {}
+        if not counters and not histograms:
+            return
+        try:
+            pipeline = self._redis.pipeline(transaction=False)
+            for field, value in counters.items():
+                pipeline.hincrbyfloat(self._counters_key, field, value)
+            for field, value in histograms.items():
+                pipeline.hincrbyfloat(self._histograms_key, field, value)
+            pipeline.execute()
+        except redis.RedisError:
+            # Without redis the metrics are dropped, not kept to grow in memory
+            pass
+
+    def _start_flusher(self) -> None:
+        # One flushing thread by process, started again in the children forked by gunicorn or celery:
+        # the increments inherited from the parent are its own to flush
+        if self._pid == os.getpid():
+            return
+        self._pid = os.getpid()
+        self._counters, self._histograms = {}, {}
+        threading.Thread(target=self._flush_forever, name='metrics-flush', daemon=True).start()
+
+    def _flush_forever(self) -> None:
+        while True:
+            time.sleep(self._flush_interval)
+            self.flush()
+
+    @contextmanager
+    def timer(self, name: str):
+        """Observe the duration of a block in a histogram"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start)
+
+    def render(self) -> str:
+        """Write all the metrics in the Prometheus text exposition format
+        :return: (str) The exposition
+        """
+        self.flush()
+        pipeline = self._redis.pipeline(transaction=False)
+        pipeline.hgetall(self._counters_key)
+        pipeline.hgetall(self._histograms_key)
+        raw_counters, raw_histograms = pipeline.execute()
+        counters = {field.decode(): float(value) for field, value in raw_counters.items()}
+        histograms = {field.decode(): float(value) for field, value in raw_histograms.items()}
+        lines = []
+        for name, (metric_type, description) in METRICS.items():
+            lines.append(f'# HELP {name} {description}')
+            lines.append(f'# TYPE {name} {metric_type}')
+            if metric_type == 'counter':
+                series = {serie: value for serie, value in counters.items()
+                          if serie == name or serie.startswith(name + '{')}
+                for serie, value in sorted(series.items()) or [(name, 0)]:
+                    lines.append(f'{serie} {_format(value)}')
+            else:
+                for bound in DEFAULT_BUCKETS + ('+Inf',):
+                    lines.append(f'{name}_bucket{{le="{bound}"}} {_format(histograms.get(name + "|" + str(bound), 0))}')
+                lines.append(f'{name}_sum {_format(histograms.get(name + "|sum", 0))}')
+                lines.append(f'{name}_count {_format(histograms.get(name + "|+Inf", 0))}')
+        return '\n'.join(lines) + '\n'
+
+
+def _serie(name: str, labels: dict = None) -> str:
+    if not labels:
+        return name
+    return name + '{' + ','.join(f'{key}="{value}"' for key, value in sorted(labels.items())) + '}'
+
+
+def _format(value: float) -> str:
+    return str(int(value)) if float(value).is_integer() else str(value)
+
+
+# The registry of the process, its last increments are flushed when it exits
+registry = Metrics(redis.Redis.from_url(REDIS_URI, socket_timeout=METRICS_SOCKET_TIMEOUT,
+                                        socket_connect_timeout=METRICS_SOCKET_TIMEOUT))
+atexit.register(registry.flush)
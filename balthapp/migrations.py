@@ -0,0 +1,165 @@
+# coding: utf-8
+"""
+Created on January 20th, 2023
+@title: Balth App
+@version: 2.1
+@author: Balthazar Méhus
+@society: CentraleSupélec
+@abstract: Python PDF extraction and storage - Versioned migrations of the database schema (SQLite and PostgreSQL)
+Applied when a process starts with BALTH_DB_AUTO_MIGRATE=1 (the default with SQLite),
+else once before a deployment, from balthapp: python manage.py migrate
+"""
+
+from sqlalchemy import (Column, DateTime, Integer, MetaData, String, Table,
+                        Text, func, inspect, select, text)
+
+# The text search configuration of PostgreSQL: the queries use the same expression as the index
+TEXT_SEARCH_CONFIG = 'simple'
+
+# The advisory lock taken by the migrations with PostgreSQL
+_LOCK_KEY = 0x62616c7468
+
+# The versions applied to the db, one row each
+_versions = Table('schema_version', MetaData(),
+                  Column('version', Integer, primary_key=True, autoincrement=False),
+                  Column('description', String(255), nullable=False),
+                  Column('applied_at', DateTime(timezone=True), server_default=func.now()))
+
+
+def migrate(bind) -> list[int]:
+    """Apply the migrations newer than the version of the db, each one in its own transaction
+    The migrations are idempotent: the dbs created before the versions (create_all) are upgraded too
+    :param bind: (Engine) The engine connected to the db
+    :return: (list) The versions applied
+    """
+    with bind.begin() as connection:
+        _lock(connection)
+        _versions.create(connection, checkfirst=True)
+    applied = []
+    for version, description, upgrade in MIGRATIONS:
+        if version <= current_version(bind):
+            continue
+        with bind.begin() as connection:
+            _lock(connection)
+            # Several processes starting together: the first one applies the migration, the others skip it
+            if _read_version(connection) >= version:
+                continue
+            upgrade(connection)
+            connection.execute(_versions.insert().values(version=version, description=description))
+        applied.append(version)
+    return applied
+
+
+def current_version(bind) -> int:
+    """Read the version of the schema
+    :param bind: (Engine) The engine connected to the db
+    :return: (int) The last version applied, 0 for a db without versions
+    """
+    with bind.connect() as connection:
+        if not inspect(connection).has_table(_versions.name):
+            return 0
+        return _read_version(connection)
+
+
+def latest_version() -> int:
+    return MIGRATIONS[-1][0]
+
+
+# --------------------------------------- MIGRATIONS ----------------------------------------
+def _create_metadata(connection) -> None:
+    # The table of the first version
+    Table('metadata', MetaData(),
+          Column('id', String(255), primary_key=True),
+          Column('data', String(), nullable=False),
+          Column('name', String(255), nullable=False),
+          Column('link', String(), nullable=False),
+          Column('task_id', String(255), nullable=False),
+          Column('task_state', String(255), nullable=False),
+          Column('created_at', DateTime(timezone=True), server_default=func.now())) \
+        .create(connection, checkfirst=True)
+
+
+def _add_deduplication(connection) -> None:
+    # The hash of the uploaded bytes and the batch of the upload
+    _add_column(connection, 'metadata', Column('content_hash', String(64)))
+    _add_column(connection, 'metadata', Column('batch_id', String(36)))
+    _create_index(connection, 'ix_metadata_content_hash', 'metadata', 'content_hash')
+    _create_index(connection, 'ix_metadata_batch_id', 'metadata', 'batch_id')
+
+
+def _create_search_index(connection) -> None:
+    # The text of the pages, indexed by FTS5 with SQLite, by a GIN index on their tsvector with PostgreSQL
+    Table('text_pages', MetaData(),
+          Column('id', Integer, primary_key=True),
+          Column('pdf_id', String(36), nullable=False),
+          Column('page', Integer, nullable=False),
+          Column('content', Text, nullable=False)) \
+        .create(connection, checkfirst=True)
+    _create_index(connection, 'ix_text_pages_pdf_id', 'text_pages', 'pdf_id')
+    if connection.dialect.name == 'postgresql':
+        connection.execute(text("CREATE INDEX IF NOT EXISTS ix_text_pages_content ON text_pages "
+                                f"USING GIN (to_tsvector('{TEXT_SEARCH_CONFIG}', content))"))
+        return
+    # An external content index: the text is stored once in text_pages, the triggers keep the index in sync
+    connection.execute(text("CREATE VIRTUAL TABLE IF NOT EXISTS text_pages_fts USING fts5(content, "
+                            "content='text_pages', content_rowid='id', tokenize='unicode61 remove_diacritics 2')"))
+    connection.execute(text("CREATE TRIGGER IF NOT EXISTS text_pages_ai AFTER INSERT ON text_pages BEGIN "
+                            "INSERT INTO text_pages_fts(rowid, content) VALUES (new.id, new.content); END"))
+    connection.execute(text("CREATE TRIGGER IF NOT EXISTS text_pages_ad AFTER DELETE ON text_pages BEGIN "
+                            "INSERT INTO text_pages_fts(text_pages_fts, rowid, content) "
+                            "VALUES ('delete', old.id, old.content); END"))
+
+
+def _add_metadata_columns(connection) -> None:
+    # The main metadata in typed columns, indexed with the id for the keyset pagination of GET /documents
+    for column in (Column('title', String(255)), Column('author', String(255)), Column('producer', String(255)),
+                   Column('creator', String(255)), Column('creation_date', DateTime),
+                   Column('page_count', Integer)):
+        _add_column(connection, 'metadata', column)
+    for name in ('created_at', 'title', 'author', 'producer', 'creator', 'creation_date', 'page_count'):
+        _create_index(connection, f'ix_metadata_{name}_id', 'metadata', name, 'id')
+
+
+def _create_quarantine(connection) -> None:
+    # The contents whose extraction breaks the limits of the workers, refused by the API
+    Table('quarantine', MetaData(),
+          Column('content_hash', String(64), primary_key=True),
+          Column('reason', String(255), nullable=False),
+          Column('created_at', DateTime(timezone=True), server_default=func.now())) \
+        .create(connection, checkfirst=True)
+
+
+# (version, description, upgrade): append the new ones, never change the applied ones
+MIGRATIONS = [
+    (1, 'Create the metadata table', _create_metadata),
+    (2, 'Add the content hash and the batch of the uploads', _add_deduplication),
+    (3, 'Add the text of the pages and their full-text search index', _create_search_index),
+    (4, 'Add the typed columns of the main metadata', _add_metadata_columns),
+    (5, 'Create the quarantine of the poison contents', _create_quarantine),
+]
+
+
+# --------------------------------------- HELPERS ----------------------------------------
+def _lock(connection) -> None:
+    # One process migrates at a time, until the end of the transaction
+    if connection.dialect.name == 'sqlite':
+        # pysqlite opens the transactions before the DML only: the DDL would be committed one by one
+        connection.exec_driver_sql('BEGIN IMMEDIATE')
+    elif connection.dialect.name == 'postgresql':
+        connection.execute(text('SELECT pg_advisory_xact_lock(:key)'), {'key': _LOCK_KEY})
+
+
+def _read_version(connection) -> int:
+    return connection.execute(select(func.max(_versions.c.version))).scalar() or 0
+
+
+def _add_column(connection, table: str, column: Column) -> None:
+    # ALTER TABLE does not take IF NOT EXISTS in SQLite
+    if column.name in {existing['name'] for existing in inspect(connection).get_columns(table)}:
+        return
+    column_type = column.type.compile(dialect=connection.dialect)
+    connection.execute(text(f'ALTER TABLE {table} ADD COLUMN {column.name} {column_type}'))
+
+
+def _create_index(connection, name: str, table: str, *columns: str) -> None:
+    connection.execute(text(f'CREATE INDEX IF NOT EXISTS {name} ON {table} ({", ".join(columns)})'))
@@ -4,22 +4,58 @@ Created on January 20th, 2023
 @title: Balth App
 @version: 2.1
 # Add Updated_at field in infos_db/metadata
+# One engine shared with service.py, SQLite tuned for concurrent readers
+# Add the text of the pages and their full-text search index (SQLite FTS5)
+# Add typed and indexed columns for the main metadata, to filter and sort the documents
+# Configurable database (SQLite or PostgreSQL) and pool, the schema is upgraded by migrations.py
+# Add the quarantine of the poison contents
 @author: Balthazar Méhus
 @society: CentraleSupélec
 @abstract: Python PDF extraction and storage - Database model.
 """
-from sqlalchemy import Column, DateTime, String, create_engine
+import os
+
+import migrations
+from config import (DB_AUTO_MIGRATE, DB_MAX_OVERFLOW, DB_POOL_RECYCLE,
+                    DB_POOL_SIZE, DB_TIMEOUT, DB_URL)
+from sqlalchemy import (Column, DateTime, Index, Integer, String, Text,
+                        create_engine, event)
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy.sql import func
 
-# Config SQLAlchemy to store in a database
-__DB_NAME = 'storage/db/pdf_infos.db'
-engine = create_engine('sqlite:///' + __DB_NAME, echo=True)
-Session = sessionmaker(bind=engine)
-session = Session()
+# The engine shared by service.py, the finalizer and the maintenance commands of the process
+if DB_URL.startswith('sqlite'):
+    __CONNECT_ARGS = {'timeout': DB_TIMEOUT, 'check_same_thread': False}
+else:
+    __CONNECT_ARGS = {'connect_timeout': DB_TIMEOUT}
+engine = create_engine(DB_URL,
+                       echo=False,
+                       pool_size=DB_POOL_SIZE,
+                       max_overflow=DB_MAX_OVERFLOW,
+                       pool_recycle=DB_POOL_RECYCLE,
+                       pool_pre_ping=True,
+                       connect_args=__CONNECT_ARGS)
+# The objects stay readable once their session is closed
+Session = sessionmaker(bind=engine, expire_on_commit=False)
 Base = declarative_base()
 
+# The prefork workers of Celery and gunicorn open their own connections, never the ones of the parent process
+os.register_at_fork(after_in_child=lambda: engine.dispose(close=False))
+
+
+def _set_sqlite_pragma(dbapi_connection, connection_record):
+    # WAL lets the readers work while one process writes
+    cursor = dbapi_connection.cursor()
+    cursor.execute('PRAGMA journal_mode=WAL')
+    cursor.execute('PRAGMA synchronous=NORMAL')
+    cursor.execute(f'PRAGMA busy_timeout={DB_TIMEOUT * 1000}')
+    cursor.close()
+
+
+if engine.dialect.name == 'sqlite':
+    event.listen(engine, 'connect', _set_sqlite_pragma)
+
 default_value: str = 'default'
 
 
@@ -32,7 +68,45 @@ class PdfData(Base):
     link = Column(String(), default=default_value, nullable=False)
     task_id = Column(String(255), default=default_value, nullable=False)
     task_state = Column(String(255), default='PENDING', nullable=False)
+    # SHA-256 of the uploaded bytes, used to deduplicate identical uploads
+    content_hash = Column(String(64), index=True)
+    # The uuid of the batch upload which created the entry
+    batch_id = Column(String(36), index=True)
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+    # Normalized from data by the finalizer: NULL when the PDF does not tell
+    title = Column(String(255))
+    author = Column(String(255))
+    producer = Column(String(255))
+    creator = Column(String(255))
+    # The CreationDate of the PDF, in UTC
+    creation_date = Column(DateTime)
+    page_count = Column(Integer)
+    # The documents are listed by these columns, the id breaks the ties of the keyset pagination
+    __table_args__ = tuple(Index(f'ix_metadata_{name}_id', name, 'id')
+                           for name in ('created_at', 'title', 'author', 'producer', 'creator',
+                                        'creation_date', 'page_count'))
+
+
+class TextPage(Base):
+    # The text of each page of the extracted documents, indexed for the full-text search (migrations.py)
+    __tablename__ = 'text_pages'
+    id = Column(Integer, primary_key=True)
+    pdf_id = Column(String(36), index=True, nullable=False)
+    # From 1, as in GET /text/<pdf_id>/pages
+    page = Column(Integer, nullable=False)
+    content = Column(Text, nullable=False)
+
+
+class Quarantine(Base):
+    # The contents whose extraction broke the limits of the workers (or failed again and again): uploads refused
+    __tablename__ = 'quarantine'
+    # SHA-256 of the uploaded bytes, as metadata.content_hash
+    content_hash = Column(String(64), primary_key=True)
+    # The name of the last error, ex: TimeLimitExceeded
+    reason = Column(String(255), nullable=False)
     created_at = Column(DateTime(timezone=True), server_default=func.now())
 
 
-Base.metadata.create_all(engine)
+# The schema is created and upgraded by the versioned migrations (migrations.py), not by create_all()
+if DB_AUTO_MIGRATE:
+    migrations.migrate(engine)
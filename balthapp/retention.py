@@ -0,0 +1,276 @@
+# coding: utf-8
+"""
+Created on January 20th, 2023
+@title: Balth App
+@version: 2.1
+@author: Balthazar Méhus
+@society: CentraleSupélec
+@abstract: Python PDF extraction and storage - Retention of the storage: TTL, quota and orphan files
+Run by the beat schedule of the finalizer (finalizer.sweep_storage)
+"""
+
+import json
+import os
+import time
+from datetime import datetime, timedelta
+
+import redis
+import service
+from config import (BROKER_TRANSPORT_OPTIONS, CACHE_PREFIX, GZIP_EXT,
+                    INDEX_EXT, LARGE_QUEUE, ORPHAN_GRACE, PDF_EXT,
+                    PDF_FOLDER_PATH, RETENTION_DAYS, SMALL_QUEUE,
+                    STORAGE_QUOTA_MB, SWEEP_BATCH_SIZE, TEMP_PDF_TTL, TXT_EXT,
+                    TXT_FOLDER_PATH)
+
+# The states of an extraction task being run by a worker (task_track_started, PROGRESS of balthworker/tasks.py)
+RUNNING_STATES = ('STARTED', 'PROGRESS', 'RETRY')
+
+
+def sweep(redis_client=None, celery_app=None, broker=None) -> dict[str, int]:
+    """Apply all the retention policies once
+    :param redis_client: (redis.Redis) To invalidate the results cached in redis, None if they are not
+    :param celery_app: (Celery) To read the states of the extraction tasks in the result backend
+    :param broker: (redis.Redis) The broker, to find the extraction tasks still waiting in the queues
+    :return: (dict) The number of files or documents deleted by policy
+    """
+    return {
+        'temp_pdfs': sweep_temp_pdfs(celery_app=celery_app, broker=broker),
+        'expired': purge_expired(redis_client),
+        'quota': enforce_quota(redis_client),
+        'orphan_texts': sweep_orphan_texts(),
+    }
+
+
+def sweep_temp_pdfs(ttl: int = TEMP_PDF_TTL, celery_app=None, broker=None) -> int:
+    """Remove the PDF left in the temp folder by abandoned or failed extractions,
+    not the ones of the extractions still queued behind a backlog or running
+    :param ttl: (int) The age in seconds from which a temp PDF is abandoned
+    :param celery_app: (Celery) To read the states of the extraction tasks, None to keep every pending PDF
+    :param broker: (redis.Redis) To find the extraction tasks still in the queues, None to keep every pending PDF
+    :return: (int) The number of PDF removed
+    """
+    removed = 0
+    queued_ids = None
+    for batch in _batches(_old_entries(PDF_FOLDER_PATH, ttl)):
+        pending = {pdf.id: pdf.task_id for pdf in service.db_get_pdf_infos(
+            pdf_ids=[_uid(entry.name) for entry in batch], pending=True)}
+        if pending:
+            live_ids = _live_task_ids(celery_app, broker, list(pending.values()), queued_ids)
+            if live_ids is None:
+                # The queues cannot be read: a pending extraction may still come, keep its PDF
+                batch = [entry for entry in batch if _uid(entry.name) not in pending]
+            else:
+                live_ids, queued_ids = live_ids
+                batch = [entry for entry in batch if pending.get(_uid(entry.name)) not in live_ids]
+        if not batch:
+            continue
+        # No worker will ever read them: their extraction is over for the customer too
+        service.db_fail_pending_pdfs([_uid(entry.name) for entry in batch])
+        removed += _remove_files(entry.path for entry in batch)
+    return removed
+
+
+def purge_expired(redis_client=None, days: int = RETENTION_DAYS) -> int:
+    """Purge the documents uploaded more than a number of days ago
+    :param redis_client: (redis.Redis) To invalidate the cached results
+    :param days: (int) The retention in days, 0 to keep everything
+    :return: (int) The number of documents purged
+    """
+    if days <= 0:
+        return 0
+    created_before = datetime.utcnow() - timedelta(days=days)
+    purged = 0
+    while True:
+        pdf_ids = service.db_get_oldest_pdf_ids(SWEEP_BATCH_SIZE, created_before=created_before)
+        if not pdf_ids or not purge(pdf_ids, redis_client):
+            return purged
+        purged += len(pdf_ids)
+
+
+def enforce_quota(redis_client=None, quota_mb: int = STORAGE_QUOTA_MB) -> int:
+    """Purge the oldest finished documents while the texts take more than the quota
+    :param redis_client: (redis.Redis) To invalidate the cached results
+    :param quota_mb: (int) The maximum size of the text folder in MB, 0 for no quota
+    :return: (int) The number of documents purged
+    """
+    if quota_mb <= 0:
+        return 0
+    quota = quota_mb * 1024 * 1024
+    # One pass on the folder, the purged sizes are subtracted afterwards
+    usage = sum(entry.stat().st_size for entry in _entries(TXT_FOLDER_PATH))
+    purged = 0
+    while usage > quota:
+        pdf_ids = service.db_get_oldest_pdf_ids(SWEEP_BATCH_SIZE, terminal_only=True)
+        if not pdf_ids:
+            break
+        # Stop at the first document which brings the usage under the quota
+        to_purge = []
+        for pdf_id in pdf_ids:
+            to_purge.append(pdf_id)
+            usage -= sum(_size(path) for path in _txt_paths([pdf_id]))
+            if usage <= quota:
+                break
+        if not purge(to_purge, redis_client):
+            break
+        purged += len(to_purge)
+    return purged
+
+
+def sweep_orphan_texts(grace: int = ORPHAN_GRACE) -> int:
+    """Remove the text files whose document is not in the db anymore, and the parts of aborted chunked extractions
+    :param grace: (int) The age in seconds from which a text without entry is not being finalized
+    :return: (int) The number of files removed
+    """
+    removed = 0
+    for batch in _batches(_old_entries(TXT_FOLDER_PATH, grace)):
+        known_ids = service.db_get_existing_pdf_ids([_uid(entry.name) for entry in batch])
+        removed += _remove_files(entry.path for entry in batch
+                                 if _uid(entry.name) not in known_ids
+                                 or (_is_part(entry.name) and _age(entry) > TEMP_PDF_TTL))
+    return removed
+
+
+def purge(pdf_ids: list[str], redis_client=None) -> bool:
+    """Delete documents: their entries in one statement, their files and their cached results
+    :param pdf_ids: (list) The PDF uuids
+    :param redis_client: (redis.Redis) To invalidate the cached results
+    :return: (bool) False if the entries could not be deleted
+    """
+    if not service.db_delete_pdfs(pdf_ids):
+        return False
+    _remove_files(_txt_paths(pdf_ids))
+    _remove_files(os.path.join(PDF_FOLDER_PATH, pdf_id + PDF_EXT) for pdf_id in pdf_ids)
+    if redis_client is not None:
+        # The API processes keep their own copy for CACHE_TTL seconds at most
+        try:
+            redis_client.delete(*[CACHE_PREFIX + pdf_id for pdf_id in pdf_ids])
+        except redis.RedisError:
+            pass
+    return True
+
+
+# --------------------------------------- TASKS ----------------------------------------
+def _live_task_ids(celery_app, broker, task_ids: list[str], queued_ids: set = None):
+    """Find the extraction tasks which will still read their PDF: running by a worker or waiting in a queue
+    :param celery_app: (Celery) To read the states of the tasks in the result backend
+    :param broker: (redis.Redis) To read the messages waiting in the queues
+    :param task_ids: (list) The Celery task ids of pending extractions
+    :param queued_ids: (set) The task ids in the queues, already read during this sweep
+    :return: (tuple) The live task ids among task_ids and the task ids in the queues, None if they cannot be read
+    """
+    if celery_app is None or broker is None:
+        return None
+    try:
+        backend = celery_app.backend
+        values = backend.mget([backend.get_key_for_task(task_id) for task_id in task_ids])
+        live_ids = {task_id for task_id, value in zip(task_ids, values)
+                    if value and backend.decode_result(value)['status'] in RUNNING_STATES}
+        if queued_ids is None:
+            queued_ids = _queued_task_ids(broker)
+    except Exception:
+        return None
+    return live_ids | (queued_ids & set(task_ids)), queued_ids
+
+
+def _queued_task_ids(broker) -> set[str]:
+    # The redis broker keeps one list by queue and priority (<queue>, <queue>:1, ...), read by slices,
+    # and the messages sent to a worker but not yet started in the hash of the unacknowledged ones
+    sep = BROKER_TRANSPORT_OPTIONS['sep']
+    task_ids = set()
+    for queue in (SMALL_QUEUE, LARGE_QUEUE):
+        for priority in BROKER_TRANSPORT_OPTIONS['priority_steps']:
+            name = f'{queue}{sep}{priority}' if priority else queue
+            start = 0
+            while messages := broker.lrange(name, start, start + SWEEP_BATCH_SIZE - 1):
+                task_ids.update(_message_task_id(message) for message in messages)
+                start += len(messages)
+    for _, delivery in broker.hscan_iter('unacked', count=SWEEP_BATCH_SIZE):
+        task_ids.add(_message_task_id(delivery))
+    task_ids.discard(None)
+    return task_ids
+
+
+def _message_task_id(message):
+    # A message of a queue, or an unacknowledged delivery: [message, exchange, routing key]
+    try:
+        message = json.loads(message)
+        if isinstance(message, list):
+            message = message[0]
+        return message['headers']['id']
+    except (ValueError, KeyError, TypeError, IndexError):
+        return None
+
+
+# --------------------------------------- FILES ----------------------------------------
+def _entries(folder: str):
+    # scandir streams the entries and knows their type without a stat call each,
+    # the sub-folders of the texts (ab/cd/) are walked depth first
+    if not os.path.isdir(folder):
+        return
+    with os.scandir(folder) as entries:
+        for entry in entries:
+            if entry.name.startswith('.'):
+                continue
+            if entry.is_dir(follow_symlinks=False):
+                yield from _entries(entry.path)
+            elif entry.is_file():
+                yield entry
+
+
+def _txt_paths(pdf_ids: list[str]):
+    # The text of a document, plain or compressed, and the index of its pages,
+    # in its sub-folder or at the root of the folder if it was not migrated
+    for pdf_id in pdf_ids:
+        for txt_name in (pdf_id + TXT_EXT, pdf_id + TXT_EXT + GZIP_EXT, pdf_id + TXT_EXT + INDEX_EXT):
+            yield os.path.join(TXT_FOLDER_PATH, service.fs_shard_name(txt_name))
+            yield os.path.join(TXT_FOLDER_PATH, txt_name)
+
+
+def _old_entries(folder: str, age: int):
+    deadline = time.time() - age
+    return (entry for entry in _entries(folder) if entry.stat().st_mtime < deadline)
+
+
+def _age(entry) -> float:
+    return time.time() - entry.stat().st_mtime
+
+
+def _uid(filename: str) -> str:
+    # <uid>.pdf, <uid>.txt, <uid>.txt.gz, <uid>.txt.idx, or the part <uid>.txt.<first page> and its index
+    return filename.split('.', 1)[0]
+
+
+def _is_part(filename: str) -> bool:
+    # <uid>.txt.<first page> or <uid>.txt.<first page>.idx
+    parts = filename.split('.')
+    return len(parts) > 2 and parts[2].isdigit()
+
+
+def _size(path: str) -> int:
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return 0
+
+
+def _remove_files(paths) -> int:
+    removed = 0
+    for path in paths:
+        try:
+            os.remove(path)
+            removed += 1
+        except FileNotFoundError:
+            pass
+    return removed
+
+
+def _batches(entries, size: int = SWEEP_BATCH_SIZE):
+    # Bounded lists of entries, so that a folder of millions of files is never held in memory
+    batch = []
+    for entry in entries:
+        batch.append(entry)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
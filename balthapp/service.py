@@ -5,25 +5,102 @@ Created on January 20th, 2023
 @version: 2.1
 # Put extraction function in balthworker/tasks.py
 # Add a service to update metadata and text link in the db
+# The worker writes the extracted text in the storage itself
+# Close every db session and update an entry in one statement
+# Stream the uploads to the storage, checking the size and hashing on the way
+# Time the db sessions
+# Add the queries of the retention sweeper
+# Shard the stored texts in ab/cd/ sub-folders
+# Find the texts stored with gzip and read their size
+# Read a range of pages of a text from the offsets indexed by the worker
+# Index the text of the pages for the full-text search (SQLite FTS5) and search it
+# Normalize the main metadata in typed columns, list the documents with a keyset pagination
+# Search with PostgreSQL as well (tsvector)
+# Quarantine the poison contents
+# Find the pages published by the workers during an extraction
 @author: Balthazar Méhus
 @society: CentraleSupélec
 @abstract: Python PDF extraction and storage - Database access and computing services
 """
+import gzip
+import hashlib
+import json
 import os
+import re
+import zipfile
+import zlib
+from contextlib import contextmanager
+from datetime import datetime, timedelta
 
 import model
 # pip install mimetypes-magic
 from magic import Magic
-from sqlalchemy import create_engine, delete, update
-from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker
+from metrics import registry
+from migrations import TEXT_SEARCH_CONFIG
+from sqlalchemy import (DateTime, String, delete, exists, insert, or_, select,
+                        text, tuple_, type_coerce, update)
+from sqlalchemy.exc import OperationalError
+from werkzeug.datastructures import FileStorage
+
+
+# The number of bytes read at once from an upload
+CHUNK_SIZE = 64 * 1024
+# The number of bytes enough to recognize the type of a file
+MIMETYPE_SNIFF_SIZE = 2048
+# The number of pages inserted at once in the search index
+INDEX_BATCH_SIZE = 500
+
+# The metadata of the PDF normalized in the columns of the metadata table
+METADATA_COLUMNS = {'Title': 'title', 'Author': 'author', 'Producer': 'producer', 'Creator': 'creator'}
+# D:YYYYMMDDHHmmSSOHH'mm', every part after the year being optional (PDF 32000-1, 7.9.4)
+_PDF_DATE = re.compile(r"(?:D:)?(\d{4})(\d{2})?(\d{2})?(\d{2})?(\d{2})?(\d{2})?(?:([Zz+-])(\d{2})?'?(\d{2})?'?)?")
+
+# The pages matching a full-text query, best first, by dialect of the db
+_SEARCH_QUERIES = {
+    # bm25 is negative, lower is better
+    'sqlite': text(
+        "SELECT p.pdf_id, m.name, p.page, "
+        "snippet(text_pages_fts, 0, :mark_open, :mark_close, '…', :snippet_words) AS snippet, "
+        "-bm25(text_pages_fts) AS score "
+        "FROM text_pages_fts "
+        "JOIN text_pages AS p ON p.id = text_pages_fts.rowid "
+        "JOIN metadata AS m ON m.id = p.pdf_id "
+        "WHERE text_pages_fts MATCH :query "
+        "ORDER BY score DESC, p.pdf_id, p.page LIMIT :limit OFFSET :offset"),
+    # The headlines are only computed for the pages of the result
+    'postgresql': text(
+        "SELECT r.pdf_id, m.name, r.page, "
+        f"ts_headline('{TEXT_SEARCH_CONFIG}', r.content, websearch_to_tsquery('{TEXT_SEARCH_CONFIG}', :query), "
+        "format('StartSel=%s, StopSel=%s, MaxWords=%s, MinWords=%s', "
+        "CAST(:mark_open AS text), CAST(:mark_close AS text), CAST(:snippet_words AS integer), "
+        "CAST(:snippet_words AS integer) / 2)) AS snippet, "
+        "r.score "
+        "FROM (SELECT p.pdf_id, p.page, p.content, "
+        f"ts_rank_cd(to_tsvector('{TEXT_SEARCH_CONFIG}', p.content), q) AS score "
+        f"FROM text_pages AS p, websearch_to_tsquery('{TEXT_SEARCH_CONFIG}', :query) AS q "
+        f"WHERE to_tsvector('{TEXT_SEARCH_CONFIG}', p.content) @@ q "
+        "ORDER BY score DESC, p.pdf_id, p.page LIMIT :limit OFFSET :offset) AS r "
+        "JOIN metadata AS m ON m.id = r.pdf_id "
+        "ORDER BY r.score DESC, r.pdf_id, r.page"),
+}
+
 
 # ----------------------------------- DB ---------------------------------------------
-# Connects to SQLAlchemy DB
-__DB_NAME = 'storage/db/pdf_infos.db'
-engine = create_engine('sqlite:///' + __DB_NAME, echo=True)
-Session = sessionmaker(bind=engine)
-Base = declarative_base()
+@contextmanager
+def session_scope():
+    """Provide a session on the shared engine, committed on success and always closed
+    :return: (Session) The SQLAlchemy session
+    """
+    session = model.Session()
+    try:
+        with registry.timer('balth_db_seconds'):
+            yield session
+            session.commit()
+    except Exception:
+        session.rollback()
+        raise
+    finally:
+        session.close()
 
 
 def db_insert_pdf_info(data: dict) -> bool:
@@ -33,10 +110,21 @@ def db_insert_pdf_info(data: dict) -> bool:
     """
     # Adding new PDF entry
     try:
-        session = Session()
-        new_pdf = model.PdfData(**data)
-        session.add(new_pdf)
-        session.commit()
+        with session_scope() as session:
+            session.add(model.PdfData(**data))
+        return True
+    except Exception:
+        return False
+
+
+def db_insert_pdf_infos(data_list: list[dict]) -> bool:
+    """Adding several new PDF entries in the DB, in one transaction
+    :param data_list: (list) The key-value pairs of the metadata table, for each PDF
+    :return: bool
+    """
+    try:
+        with session_scope() as session:
+            session.add_all([model.PdfData(**data) for data in data_list])
         return True
     except Exception:
         return False
@@ -47,69 +135,380 @@ def db_get_pdf_info(pdf_id: str):
     :param pdf_id: (str) The PDF uuid received previously from balthapp
     :return: One pdf_infos/metadata object or None
     """
-    session = Session()
-    return session.query(model.PdfData).get(pdf_id)
+    with session_scope() as session:
+        return session.get(model.PdfData, pdf_id)
 
 
-def db_update_pdf_task_state(pdf_id: str, state: str) -> bool:
-    """Update in the db the task state of one pdf processing
-    :param pdf_id: (str) The PDF uuid received previously from balthapp
-    :param state: (str) The new state (PENDING, STARTED, SUCCESS or FAILURE)
+def db_get_pdf_infos(pdf_ids: list[str] = None, batch_id: str = None, task_state: str = None,
+                     pending: bool = False) -> list:
+    """Get in the db the data about many pdf with one SELECT
+    :param pdf_ids: (list) The PDF uuids, the ones of the batch are also returned
+    :param batch_id: (str) The uuid of a batch upload
+    :param task_state: (str) Only the pdf in this state (SUCCESS or FAILURE)
+    :param pending: (bool) Only the pdf which are not in a terminal state
+    :return: (list) The pdf_infos/metadata objects found
+    """
+    criteria = []
+    if pdf_ids:
+        criteria.append(model.PdfData.id.in_(pdf_ids))
+    if batch_id:
+        criteria.append(model.PdfData.batch_id == batch_id)
+    with session_scope() as session:
+        query = session.query(model.PdfData).filter(or_(*criteria))
+        if task_state:
+            query = query.filter(model.PdfData.task_state == task_state)
+        if pending:
+            query = query.filter(model.PdfData.task_state.notin_(('SUCCESS', 'FAILURE')))
+        return query.all()
+
+
+def db_get_pdf_by_hash(content_hash: str):
+    """Get in the db the latest pdf uploaded with the same content, unless its processing failed
+    :param content_hash: (str) The SHA-256 hex digest of the uploaded file
+    :return: One pdf_infos/metadata object or None
+    """
+    with session_scope() as session:
+        return session.query(model.PdfData) \
+            .filter(model.PdfData.content_hash == content_hash, model.PdfData.task_state != 'FAILURE') \
+            .order_by(model.PdfData.created_at.desc()) \
+            .first()
+
+
+def db_get_pdf_ids_by_hashes(content_hashes: list[str]) -> dict[str, str]:
+    """Get in the db the pdf already uploaded with the same contents, unless their processing failed
+    :param content_hashes: (list) The SHA-256 hex digests of the uploaded files
+    :return: (dict) The pdf uuid by content hash, for the known ones
+    """
+    if not content_hashes:
+        return {}
+    with session_scope() as session:
+        rows = session.query(model.PdfData.content_hash, model.PdfData.id) \
+            .filter(model.PdfData.content_hash.in_(set(content_hashes)), model.PdfData.task_state != 'FAILURE') \
+            .order_by(model.PdfData.created_at)
+        # The latest upload wins
+        return {content_hash: pdf_id for content_hash, pdf_id in rows}
+
+
+def db_get_oldest_pdf_ids(limit: int, created_before: datetime = None, terminal_only: bool = False) -> list[str]:
+    """Get in the db the uuids of the oldest pdf
+    :param limit: (int) The maximum number of uuids
+    :param created_before: (datetime) Only the pdf uploaded before this UTC date
+    :param terminal_only: (bool) Only the pdf whose processing is over (SUCCESS or FAILURE)
+    :return: (list) The uuids, oldest first
+    """
+    with session_scope() as session:
+        query = session.query(model.PdfData.id)
+        if created_before is not None:
+            query = query.filter(model.PdfData.created_at < created_before)
+        if terminal_only:
+            query = query.filter(model.PdfData.task_state.in_(('SUCCESS', 'FAILURE')))
+        return [pdf_id for pdf_id, in query.order_by(model.PdfData.created_at).limit(limit)]
+
+
+def db_get_existing_pdf_ids(pdf_ids: list[str]) -> set[str]:
+    """Tell which pdf are still in the db, with one SELECT on the primary key
+    :param pdf_ids: (list) The PDF uuids
+    :return: (set) The uuids found
+    """
+    if not pdf_ids:
+        return set()
+    with session_scope() as session:
+        return {pdf_id for pdf_id, in session.query(model.PdfData.id).filter(model.PdfData.id.in_(pdf_ids))}
+
+
+def db_fail_pending_pdfs(pdf_ids: list[str]) -> bool:
+    """Mark as failed the pdf which are not in a terminal state, in one statement
+    :param pdf_ids: (list) The PDF uuids
     :return: bool
     """
     try:
-        session = Session()
-        session.execute(update(model.PdfData).where(model.PdfData.id == pdf_id).values(task_state=state))
-        session.commit()
+        with session_scope() as session:
+            session.execute(update(model.PdfData)
+                            .where(model.PdfData.id.in_(pdf_ids),
+                                   model.PdfData.task_state.notin_(('SUCCESS', 'FAILURE')))
+                            .values(task_state='FAILURE'))
         return True
     except Exception:
         return False
 
 
-def db_update_pdf_metadata(pdf_id: str, metadata: dict):
-    """Update in the db, extracted metadata of one pdf
+def db_update_pdf(pdf_id: str, values: dict) -> bool:
+    """Update in the db several fields of one pdf with a single statement
     :param pdf_id: (str) The PDF uuid received previously from balthapp
-    :param metadata: (dict) Extracted metadata
+    :param values: (dict) The new values by column (task_state, data, link...)
     :return: bool
     """
     try:
-        session = Session()
-        session.execute(update(model.PdfData).where(model.PdfData.id == pdf_id).values(data=metadata))
-        session.commit()
+        with session_scope() as session:
+            session.execute(update(model.PdfData).where(model.PdfData.id == pdf_id).values(**values))
         return True
     except Exception:
         return False
 
 
-def db_update_link(pdf_id: str, txt_link: str) -> bool:
-    """Update in the db, the link to the text file extracted from the pdf file
+def db_delete_pdf(pdf_id: str) -> bool:
+    """Delete an entry of the pdf_infos.db/metadata
     :param pdf_id: (str) The PDF uuid received previously from balthapp
-    :param txt_link: (str) The link
-    :return:
+    :return: bool
     """
     try:
-        session = Session()
-        session.execute(update(model.PdfData).where(model.PdfData.id == pdf_id).values(link=txt_link))
-        session.commit()
+        with session_scope() as session:
+            session.execute(delete(model.PdfData).where(model.PdfData.id == pdf_id))
+            session.execute(delete(model.TextPage).where(model.TextPage.pdf_id == pdf_id))
         return True
     except Exception:
         return False
 
 
-def db_delete_pdf(pdf_id: str) -> bool:
-    """Delete an entry of the pdf_infos.db/metadata
-    :param pdf_id: (str) The PDF uuid received previously from balthapp
+def db_delete_pdfs(pdf_ids: list[str]) -> bool:
+    """Delete several entries of the pdf_infos.db/metadata in one statement, and their pages in the search index
+    :param pdf_ids: (list) The PDF uuids
+    :return: bool
+    """
+    try:
+        with session_scope() as session:
+            session.execute(delete(model.PdfData).where(model.PdfData.id.in_(pdf_ids)))
+            session.execute(delete(model.TextPage).where(model.TextPage.pdf_id.in_(pdf_ids)))
+        return True
+    except Exception:
+        return False
+
+
+def db_count_failures(content_hash: str) -> int:
+    """Count in the db the failed extractions of a content
+    :param content_hash: (str) The SHA-256 hex digest of the uploaded file
+    :return: (int) The number of uploads of this content whose processing failed
+    """
+    with session_scope() as session:
+        return session.query(model.PdfData.id) \
+            .filter(model.PdfData.content_hash == content_hash, model.PdfData.task_state == 'FAILURE') \
+            .count()
+
+
+def db_quarantine(content_hash: str, reason: str) -> bool:
+    """Quarantine a content: its next uploads are refused
+    :param content_hash: (str) The SHA-256 hex digest of the uploaded file
+    :param reason: (str) The name of the error which failed its extraction
+    :return: bool
+    """
+    try:
+        with session_scope() as session:
+            # A content quarantined again keeps its date and gets the last reason
+            session.merge(model.Quarantine(content_hash=content_hash, reason=reason[:255]))
+        return True
+    except Exception:
+        return False
+
+
+def db_get_quarantined_hashes(content_hashes: list[str]) -> set[str]:
+    """Tell which contents are quarantined, with one SELECT on the primary key
+    :param content_hashes: (list) The SHA-256 hex digests of the uploaded files
+    :return: (set) The quarantined ones
+    """
+    if not content_hashes:
+        return set()
+    with session_scope() as session:
+        return {content_hash for content_hash, in session.query(model.Quarantine.content_hash)
+                .filter(model.Quarantine.content_hash.in_(set(content_hashes)))}
+
+
+def db_get_quarantine() -> list:
+    """Get in the db the quarantined contents
+    :return: (list) The quarantine objects, oldest first
+    """
+    with session_scope() as session:
+        return session.query(model.Quarantine).order_by(model.Quarantine.created_at).all()
+
+
+def db_release_quarantine(content_hash: str) -> bool:
+    """Release a content from the quarantine: it can be uploaded again
+    :param content_hash: (str) The SHA-256 hex digest of the uploaded file
+    :return: (bool) False if the content was not quarantined
+    """
+    with session_scope() as session:
+        return session.execute(delete(model.Quarantine)
+                               .where(model.Quarantine.content_hash == content_hash)).rowcount > 0
+
+
+def db_index_pages(pdf_id: str, pages) -> bool:
+    """Replace the pages of a pdf in the search index, in one transaction
+    :param pdf_id: (str) The PDF uuid
+    :param pages: (iterable) The (number, text) of the pages, read lazily by batches
     :return: bool
     """
     try:
-        session = Session()
-        session.execute(delete(model.PdfData).where(model.PdfData.id == pdf_id))
-        session.commit()
+        with session_scope() as session:
+            # An extraction finalized twice is indexed once
+            session.execute(delete(model.TextPage).where(model.TextPage.pdf_id == pdf_id))
+            batch = []
+            for number, content in pages:
+                # PostgreSQL refuses the NUL characters in a text
+                batch.append({'pdf_id': pdf_id, 'page': number, 'content': content.replace('\x00', '')})
+                if len(batch) == INDEX_BATCH_SIZE:
+                    session.execute(insert(model.TextPage), batch)
+                    batch = []
+            if batch:
+                session.execute(insert(model.TextPage), batch)
         return True
     except Exception:
         return False
 
 
+def db_search_pages(query: str, limit: int, offset: int = 0, snippet_words: int = 16,
+                    highlight: tuple[str, str] = ('<mark>', '</mark>')) -> list[dict] | None:
+    """Search the pages of the extracted texts, ranked by relevance (bm25)
+    :param query: (str) With SQLite, the FTS5 query: words, "phrases", prefix*, AND, OR, NOT, NEAR(...)
+    with PostgreSQL, the web search syntax: words, "phrases", or, -word
+    :param limit: (int) The maximum number of pages
+    :param offset: (int) The number of pages to skip
+    :param snippet_words: (int) The number of words in the snippets (64 at most)
+    :param highlight: (tuple) The marks put before and after the matches in the snippets
+    :return: (list) The pages found (_id, name, page, snippet, score, higher is better), None if the query is invalid
+    """
+    try:
+        params = {'query': query, 'limit': limit, 'offset': offset, 'snippet_words': snippet_words,
+                  'mark_open': highlight[0], 'mark_close': highlight[1]}
+        with session_scope() as session:
+            rows = session.execute(_SEARCH_QUERIES[model.engine.dialect.name], params)
+            return [{'_id': pdf_id, 'name': name, 'page': page, 'snippet': snippet, 'score': round(score, 4)}
+                    for pdf_id, name, page, snippet, score in rows]
+    except OperationalError:
+        # A syntax error of the query (fts5: syntax error near ...)
+        return None
+
+
+def db_get_unindexed_pdf_ids(limit: int, after: str = '') -> list[str]:
+    """Get in the db the uuids of extracted pdf without any page in the search index
+    :param limit: (int) The maximum number of uuids
+    :param after: (str) Only the uuids following this one, to walk through all of them
+    :return: (list) The uuids, in order
+    """
+    with session_scope() as session:
+        query = session.query(model.PdfData.id) \
+            .filter(model.PdfData.id > after, model.PdfData.task_state == 'SUCCESS',
+                    ~exists(select(model.TextPage.id).where(model.TextPage.pdf_id == model.PdfData.id)))
+        return [pdf_id for pdf_id, in query.order_by(model.PdfData.id).limit(limit)]
+
+
+def db_list_pdfs(filters: dict, sort: str = 'created_at', descending: bool = True, limit: int = 50,
+                 after: tuple = None) -> list[tuple]:
+    """List the pdf of the db filtered and sorted on indexed columns, page after page (keyset pagination)
+    :param filters: (dict) The values of the columns (author, task_state...), and the bounds of the columns
+    prefixed by min_ or max_ (ex: {"author": "Balthazar", "min_page_count": 10})
+    :param sort: (str) The column to sort by
+    :param descending: (bool) Sort in the descending order
+    :param limit: (int) The maximum number of pdf
+    :param after: (tuple) The sort key and the id of the last pdf of the previous page, None for the first page
+    :return: (list) The (pdf_infos/metadata object, sort key) pairs
+    """
+    column = getattr(model.PdfData, sort)
+    key = column
+    if isinstance(column.type, DateTime):
+        if model.engine.dialect.name == 'sqlite':
+            # The dates are compared as they are stored: the server default of created_at has no microseconds
+            key = type_coerce(column, String)
+        elif after is not None and after[0] is not None:
+            after = (datetime.fromisoformat(after[0]), after[1])
+    criteria = []
+    for name, value in filters.items():
+        if name.startswith('min_'):
+            criteria.append(getattr(model.PdfData, name[4:]) >= value)
+        elif name.startswith('max_'):
+            criteria.append(getattr(model.PdfData, name[4:]) <= value)
+        else:
+            criteria.append(getattr(model.PdfData, name) == value)
+    if descending:
+        order = (key.desc(), model.PdfData.id.desc())
+        # SQLite puts the NULL keys last in the descending order
+        segments = (False, True)
+    else:
+        order = (key.asc(), model.PdfData.id.asc())
+        segments = (True, False)
+    # The keys NULL and not NULL are read apart, so that each read is a range of the index (sort column, id):
+    # an OR of both would sort all the matching rows, whatever the page
+    if after is not None:
+        segments = segments[segments.index(after[0] is None):]
+    rows = []
+    with session_scope() as session:
+        for null_keys in segments:
+            query = session.query(model.PdfData, key).filter(*criteria)
+            query = query.filter(key.is_(None) if null_keys else key.isnot(None))
+            if after is not None and null_keys == (after[0] is None):
+                query = query.filter(_keyset_after(key, *after, descending))
+            rows += query.order_by(*order).limit(limit - len(rows)).all()
+            if len(rows) >= limit:
+                break
+    # The keys are given back in the cursors of the API
+    return [(pdf, value.isoformat() if isinstance(value, datetime) else value) for pdf, value in rows]
+
+
+def _keyset_after(key, value, last_id: str, descending: bool):
+    # The pdf following (value, last_id) in the order of the list, among the ones with a key NULL or not as value
+    if value is None:
+        return model.PdfData.id < last_id if descending else model.PdfData.id > last_id
+    if descending:
+        return tuple_(key, model.PdfData.id) < tuple_(value, last_id)
+    return tuple_(key, model.PdfData.id) > tuple_(value, last_id)
+
+
+def db_get_extracted_pdfs(limit: int, after: str = '') -> list:
+    """Get in the db the pdf whose extraction succeeded, in the order of their uuid
+    :param limit: (int) The maximum number of pdf
+    :param after: (str) Only the uuids following this one, to walk through all of them
+    :return: (list) The pdf_infos/metadata objects
+    """
+    with session_scope() as session:
+        return session.query(model.PdfData) \
+            .filter(model.PdfData.id > after, model.PdfData.task_state == 'SUCCESS') \
+            .order_by(model.PdfData.id).limit(limit).all()
+
+
+# --------------------------------------- METADATA ----------------------------------------
+def metadata_columns(data: dict, page_count: int = None) -> dict:
+    """Normalize the main metadata extracted by the worker into the typed columns of the metadata table
+    :param data: (dict) The metadata of the PDF (ex: {"Title": "...", "CreationDate": "D:20230131134645+01'00'"})
+    :param page_count: (int) The number of pages, left out if unknown
+    :return: (dict) The values by column, None for the metadata missing in the PDF
+    """
+    columns = {column: _text_value(data.get(key)) for key, column in METADATA_COLUMNS.items()}
+    columns['creation_date'] = pdf_date(data.get('CreationDate'))
+    if page_count:
+        columns['page_count'] = page_count
+    return columns
+
+
+def pdf_date(value) -> datetime | None:
+    """Read a date written in the PDF format
+    :param value: (str) The date (ex: D:20230131134645+01'00')
+    :return: (datetime) The date in UTC, without time zone, None if it cannot be read
+    """
+    if not isinstance(value, str):
+        return None
+    match = _PDF_DATE.match(value.strip())
+    if not match:
+        return None
+    year, month, day, hour, minute, second, sign, tz_hour, tz_minute = match.groups()
+    try:
+        date = datetime(int(year), int(month or 1), int(day or 1), int(hour or 0), int(minute or 0),
+                        int(second or 0))
+    except ValueError:
+        return None
+    # Without a time zone, the local time of the author is taken as UTC
+    offset = timedelta(hours=int(tz_hour or 0), minutes=int(tz_minute or 0))
+    if sign == '+':
+        date -= offset
+    elif sign == '-':
+        date += offset
+    return date
+
+
+def _text_value(value) -> str | None:
+    # The columns are String(255): the full value stays in data
+    if not isinstance(value, str) or not value.strip():
+        return None
+    return value.strip()[:255]
+
+
 # --------------------------------------- CHECKIN ----------------------------------------
 def file_provided(file) -> bool:
     """Is there a file in this Post request ?
@@ -129,8 +528,9 @@ def file_valid_mimetype(file, mimetype: str) -> bool:
     """
     # Put the cursor at the beginning of the file
     file.seek(0)
+    # The magic numbers are at the beginning: do not load the whole file
     with Magic() as m:
-        file_type = m.id_buffer(file.read())
+        file_type = m.id_buffer(file.read(MIMETYPE_SNIFF_SIZE))
     # Put the cursor at the beginning of the file
     file.seek(0)
     # Verify that the received file has the PDF MIMETYPE
@@ -151,16 +551,149 @@ def file_valid_extension(file, ext: str) -> bool:
 
 
 def file_valid_size(file, max_size: int) -> bool:
-    """Verify that the file is not too big
+    """Verify that the file is not declared too big (fs_save_temp_pdf checks the real size)
     :param file: (file object) The file object provide by the request
     :param max_size: (int) The maximum size in MB (about 10MB here)
     :return: bool
     """
+    # The length is 0 when it is not declared, as with chunked uploads
     if file.content_length > max_size:
         return False
     return True
 
 
+def zip_members(archive) -> list:
+    """List the files of an uploaded zip archive as uploaded files
+    :param archive: (file object) The zip file object provide by the request
+    :return: (list) One file object by file in the archive
+    """
+    zip_file = zipfile.ZipFile(archive)
+    return [FileStorage(stream=zip_file.open(member),
+                        filename=os.path.basename(member.filename),
+                        content_length=member.file_size)
+            for member in zip_file.infolist() if not member.is_dir()]
+
+
+def fs_shard_name(filename: str) -> str:
+    """Give the path of a stored file in its folder: the name abcd-... is stored in ab/cd/abcd-...
+    The names start with a random uuid, which spreads the files evenly in 65536 sub-folders
+    :param filename: (str) The name of the file
+    :return: (str) The path relative to the storage folder
+    """
+    return os.path.join(filename[0:2], filename[2:4], filename)
+
+
+def fs_find_file(folder: str, filename: str) -> str | None:
+    """Find a stored file in its sub-folder, or at the root of the folder if it was not migrated yet
+    :param folder: (str) The storage folder
+    :param filename: (str) The name of the file
+    :return: (str) The path relative to the folder, None if the file is not stored
+    """
+    for name in (fs_shard_name(filename), filename):
+        if os.path.isfile(os.path.join(folder, name)):
+            return name
+    return None
+
+
+def fs_find_text(folder: str, txt_name: str, compressed_ext: str) -> str | None:
+    """Find a stored text, plain or compressed
+    :param folder: (str) The storage folder of the texts
+    :param txt_name: (str) The name of the text file
+    :param compressed_ext: (str) The extension added to the compressed texts
+    :return: (str) The path relative to the folder, None if the text is not stored
+    """
+    return fs_find_file(folder, txt_name) or fs_find_file(folder, txt_name + compressed_ext)
+
+
+def fs_find_part_indexes(folder: str, txt_name: str, index_ext: str) -> list[str]:
+    """Find the indexes of the parts of a text extracted in parallel, published by the workers until the merge
+    :param folder: (str) The storage folder of the texts
+    :param txt_name: (str) The name of the text file
+    :param index_ext: (str) The extension of the index files
+    :return: (list) The paths to the indexes of the parts (<uuid>.txt.<first page>.idx), relative to the folder
+    """
+    shard = os.path.dirname(fs_shard_name(txt_name))
+    try:
+        with os.scandir(os.path.join(folder, shard)) as entries:
+            return [os.path.join(shard, entry.name) for entry in entries
+                    if entry.name.startswith(txt_name + '.') and entry.name.endswith(index_ext)
+                    and entry.name[len(txt_name) + 1:-len(index_ext)].isdigit()]
+    except FileNotFoundError:
+        return []
+
+
+def fs_gzip_size(file_path: str) -> int:
+    """Read the size of a text compressed with gzip from the trailer of the file, without decompressing it
+    :param file_path: (str) The path to the compressed file, of one gzip member under 4 GB
+    :return: (int) The size of the text in bytes
+    """
+    with open(file_path, 'rb') as file:
+        file.seek(-4, os.SEEK_END)
+        return int.from_bytes(file.read(4), 'little')
+
+
+def fs_load_index(file_path: str) -> dict | None:
+    """Load the offsets of the pages of a text, written next to it by the worker (<uuid>.txt.idx)
+    :param file_path: (str) The path to the index file
+    :return: (dict) {"compressed": bool, "text": [...], "stored": [...]}, the offsets of the page starts
+    and of the end in the text and in the stored file, None if the index is missing or unreadable
+    """
+    try:
+        with open(file_path, 'rb') as index_file:
+            return json.load(index_file)
+    except (OSError, ValueError):
+        return None
+
+
+def fs_read_pages(file_path: str, start: int, end: int, compressed: bool):
+    """Read the bytes [start, end[ of a stored text, seeking to them without reading what comes before
+    :param file_path: (str) The path to the stored text
+    :param start: (int) The stored offset of the first page
+    :param end: (int) The stored offset following the last page
+    :param compressed: (bool) The text is stored with gzip: the pages start on a full flush of the deflate stream
+    :return: (generator) The text of the pages, chunk by chunk
+    :raise FileNotFoundError: The text is not stored anymore, raised by the call rather than during the response
+    """
+    # Opened now: a file removed once the response is streaming (merged parts) is still read through its descriptor
+    txt_file = open(file_path, 'rb')
+    return _read_range(txt_file, start, end, compressed)
+
+
+def _read_range(txt_file, start: int, end: int, compressed: bool):
+    # A raw deflate stream, since a full flush needs neither the gzip header nor the previous pages
+    decompressor = zlib.decompressobj(-zlib.MAX_WBITS) if compressed else None
+    with txt_file:
+        txt_file.seek(start)
+        remaining = end - start
+        while remaining > 0:
+            chunk = txt_file.read(min(CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield decompressor.decompress(chunk) if compressed else chunk
+    if compressed:
+        yield decompressor.flush()
+
+
+def fs_iter_pages(file_path: str, compressed: bool):
+    """Read a stored text page by page, each page ended by a form feed
+    :param file_path: (str) The path to the stored text
+    :param compressed: (bool) The text is stored with gzip
+    :return: (generator) The (number from 1, text) of the pages which are not blank
+    """
+    opener = gzip.open if compressed else open
+    with opener(file_path, 'rt', encoding='utf-8', errors='replace', newline='') as txt_file:
+        number, rest = 1, ''
+        for chunk in iter(lambda: txt_file.read(CHUNK_SIZE), ''):
+            *pages, rest = (rest + chunk).split('\f')
+            for page in pages:
+                if page.strip():
+                    yield number, page
+                number += 1
+        if rest.strip():
+            yield number, rest
+
+
 def file_exists(file_path: str) -> bool:
     """Verify that the provided uuid refers a stored file by the name
     :param file_path: (str) The attend file path
@@ -175,24 +708,35 @@ def file_exists(file_path: str) -> bool:
         return False
 
 
-def fs_save_temp_pdf(file, pdf_path):
-    """Store the uploaded PDF file temporary to be processed
+def fs_save_temp_pdf(file, pdf_path, max_size: int) -> str | None:
+    """Store the uploaded PDF file temporary to be processed, chunk by chunk, hashing its content
     :param file: (file object) The file object provide by the request
     :param pdf_path: (str) The path to the temp folder in the storage
-    :return: None
-    """
-    file.save(pdf_path)
-    return None
-
-def fs_save_text(txt, txt_path):
-    """Store the extracted text
-    :param txt: (str) The extracted text to store
-    :param txt_path: (str) The path to the text files folder in the storage
-    :return: None
+    :param max_size: (int) The maximum size in bytes, the file is not stored beyond
+    :return: (str) The SHA-256 hex digest of the file, None if it is too big
     """
-    with open(txt_path, "w") as file:
-        file.write(txt)
-    return None
+    sha256 = hashlib.sha256()
+    size = 0
+    # Put the cursor at the beginning of the file
+    file.seek(0)
+    try:
+        with open(pdf_path, 'wb') as pdf_file:
+            for chunk in iter(lambda: file.read(CHUNK_SIZE), b''):
+                size += len(chunk)
+                if size > max_size:
+                    break
+                sha256.update(chunk)
+                pdf_file.write(chunk)
+    except Exception:
+        # Do not leave a partly written file in the temp folder (disk full, client disconnected)
+        if os.path.exists(pdf_path):
+            os.remove(pdf_path)
+        raise
+    if size > max_size:
+        # Reject it without reading the rest
+        os.remove(pdf_path)
+        return None
+    return sha256.hexdigest()
 
 
 def fs_remove_temp_pdf(pdf_path):
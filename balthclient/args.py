@@ -5,6 +5,8 @@ Created on January 20th, 2023
 @title: Balth App
 @version: 2.1
 # Add details in help string
+# Add the --wait parameter
+# Add the bulk mode parameters (--postdir, --output, --concurrency)
 @author: Balthazar Méhus
 @society: CentraleSupélec
 @abstract: Python PDF extraction and storage - Easy client to request on Balthapp
@@ -28,6 +30,20 @@ class Args:
         )
         self._group = self._parser.add_mutually_exclusive_group()
         self._add_args(self._group)
+        self._parser.add_argument("-o",
+                                  "--output",
+                                  dest="output_dir",
+                                  type=str,
+                                  default="output",
+                                  help="With --postdir only, the folder where are written "
+                                       "the extracted metadata (.json) and texts (.txt). Default: output")
+        self._parser.add_argument("-c",
+                                  "--concurrency",
+                                  dest="concurrency",
+                                  type=int,
+                                  default=8,
+                                  help="With --postdir only, the number of files processed at the same time. "
+                                       "Default: 8")
         self._parser.add_argument("-dc",
                                   "--downloadcontract",
                                   dest="downloadAPIcontract",
@@ -38,7 +54,8 @@ class Args:
     def _add_args(self, group):
         """ Create a mutually exclusive required CLI parameters for our client app
         :param group:
-        :return: one of the 3 available parameters : postfile_pdfpath, getmetadata_uuid, gettext_uuid
+        :return: one of the 5 available parameters : postfile_pdfpath, postdir_source, getmetadata_uuid, wait_uuid,
+        gettext_uuid
         """
         group.add_argument("-pf",
                            "--postfile",
@@ -47,6 +64,14 @@ class Args:
                            help="Firstly, by providing only one local path, "
                                 "post a PDF file to the API. Returning the job ID.")
 
+        group.add_argument("-pd",
+                           "--postdir",
+                           dest="postdir_source",
+                           type=str,
+                           help="Bulk mode, by providing a local folder or a glob pattern (ex: 'invoices/**/*.pdf'), "
+                                "post all the PDF files concurrently, wait for their extraction "
+                                "and download their metadata and text in the --output folder.")
+
         group.add_argument("-gm",
                            "--getmetadata",
                            dest="getmetadata_uuid",
@@ -55,6 +80,14 @@ class Args:
                                 "(UUID, ex:76310ab9-01d9-49c3-927c-1bafaa0a52a8), "
                                 "get a the extracted metadata from the corresponding posted PDF.")
 
+        group.add_argument("-w",
+                           "--wait",
+                           dest="wait_uuid",
+                           type=str,
+                           help="Instead of --getmetadata, by providing the received job ID, "
+                                "wait until the extraction is over (30 seconds at most), "
+                                "then get the extracted metadata.")
+
         group.add_argument("-gt",
                            "--gettext",
                            dest="gettext_uuid",
@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+# coding: utf-8
+"""
+Created on January 20th, 2023
+@title: Balth App
+@version: 2.1
+@author: Balthazar Méhus
+@society: CentraleSupélec
+@abstract: Python PDF extraction and storage - Bulk mode of the client: concurrent uploads over pooled connections
+"""
+
+import glob
+import json
+import os
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+
+# The number of files processed at the same time
+CONCURRENCY = 8
+# Backoff on 429 (too many requests) when the API does not give a Retry-After
+MAX_RETRIES = 8
+BACKOFF_BASE = 1
+BACKOFF_MAX = 60
+# Seconds the API holds a wait request before answering 202
+WAIT_TIMEOUT = 30
+# The maximum number of seconds to wait for one extraction
+MAX_WAIT = 3600
+
+
+def list_pdf_files(source: str) -> list[str]:
+    """ List the PDF files of a folder, or the files matching a glob pattern
+    :param source: (string) A folder path or a glob pattern (ex: 'invoices/**/*.pdf')
+    :return: (list) The sorted file paths
+    """
+    if os.path.isdir(source):
+        source = os.path.join(source, '*.pdf')
+    return sorted(path for path in glob.glob(source, recursive=True) if os.path.isfile(path))
+
+
+def output_names(pdf_paths: list[str]) -> dict[str, str]:
+    """ Name the outputs of the PDF files after their path relative to the root of the input, so that the files of
+    the same name in different folders do not overwrite each other (invoices/a.pdf -> invoices/a.json)
+    :param pdf_paths: (list) The PDF file paths
+    :return: (dict) The output name, without extension, by PDF file path
+    """
+    if not pdf_paths:
+        return {}
+    root = os.path.commonpath([os.path.dirname(os.path.abspath(pdf_path)) for pdf_path in pdf_paths])
+    return {pdf_path: os.path.splitext(os.path.relpath(os.path.abspath(pdf_path), root))[0] for pdf_path in pdf_paths}
+
+
+def make_session(concurrency: int = CONCURRENCY) -> requests.Session:
+    """ Create a session reusing up to one connection by concurrent job
+    :param concurrency: (int) The number of concurrent jobs
+    :return: (requests.Session)
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=concurrency)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def _request(session: requests.Session, method: str, url: str, **kwargs) -> requests.Response:
+    """ Send a request, retrying with a backoff while the API answers 429
+    :return: (requests.Response) The first response which is not a 429, or the last one
+    """
+    for attempt in range(MAX_RETRIES + 1):
+        # The file must be read from its beginning again on a retry
+        for file in (kwargs.get('files') or {}).values():
+            file.seek(0)
+        response = session.request(method, url, **kwargs)
+        if response.status_code != 429 or attempt == MAX_RETRIES:
+            return response
+        retry_after = response.headers.get('Retry-After')
+        if retry_after and retry_after.isdigit():
+            delay = int(retry_after)
+        else:
+            delay = min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt) * random.uniform(0.5, 1)
+        time.sleep(delay)
+    return response
+
+
+def process_file(session: requests.Session, api_url: str, pdf_path: str, output_dir: str,
+                 name: str = None) -> dict[str, str]:
+    """ Upload one PDF file, wait for its extraction, then download its metadata and text in the output folder
+    :param session: (requests.Session) The shared session
+    :param api_url: (string) The root url of the API
+    :param pdf_path: (string) The PDF file path
+    :param output_dir: (string) The folder where are written <name>.json and <name>.txt
+    :param name: (string) The output name, relative to the output folder (output_names), the file name by default
+    :return: (dict) The report of the file: path, _id, task_state or error
+    """
+    report = {"path": pdf_path}
+    try:
+        with open(pdf_path, 'rb') as pdf_file:
+            response = _request(session, 'POST', f'{api_url}/documents', files={'pdf_file': pdf_file})
+        if response.status_code not in (200, 201):
+            report["error"] = response.json().get("error", str(response.status_code))
+            return report
+        pdf_id = response.json()["_id"]
+        report["_id"] = pdf_id
+
+        # One idle connection by job until the API is notified of the end of the extraction
+        deadline = time.monotonic() + MAX_WAIT
+        while True:
+            response = _request(session, 'GET', f'{api_url}/wait/{pdf_id}',
+                                params={'timeout': WAIT_TIMEOUT}, timeout=WAIT_TIMEOUT + 10)
+            if response.status_code != 202 or time.monotonic() > deadline:
+                break
+        metadata = response.json()
+        report["task_state"] = metadata.get("task_state", "")
+        if response.status_code != 200:
+            report["error"] = metadata.get("error", str(response.status_code))
+            return report
+
+        if name is None:
+            name = os.path.splitext(os.path.basename(pdf_path))[0]
+        os.makedirs(os.path.dirname(os.path.join(output_dir, name)), exist_ok=True)
+        with open(os.path.join(output_dir, name + '.json'), 'w') as json_file:
+            json.dump(metadata, json_file, indent=2)
+        if report["task_state"] == "SUCCESS":
+            response = _request(session, 'GET', f'{api_url}/text/{pdf_id}', stream=True)
+            if response.status_code == 200:
+                with open(os.path.join(output_dir, name + '.txt'), 'wb') as txt_file:
+                    for chunk in response.iter_content(chunk_size=64 * 1024):
+                        txt_file.write(chunk)
+            else:
+                report["error"] = "Text not downloaded (" + str(response.status_code) + ")."
+    except (OSError, ValueError, requests.exceptions.RequestException) as err:
+        report["error"] = str(err)
+    return report
+
+
+def run_bulk(source: str, api_url: str, output_dir: str, concurrency: int = CONCURRENCY) -> list[dict[str, str]]:
+    """ Process all the PDF files of a folder or a glob pattern, a bounded number at the same time
+    :param source: (string) A folder path or a glob pattern
+    :param api_url: (string) The root url of the API
+    :param output_dir: (string) The folder where are written the metadata and the texts
+    :param concurrency: (int) The number of files processed at the same time
+    :return: (list) The report of each file
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    pdf_paths = list_pdf_files(source)
+    names = output_names(pdf_paths)
+    # Names differing by the case only (a.pdf, a.PDF) would share their outputs on a case-insensitive file system
+    paths_by_name = {}
+    for pdf_path, name in names.items():
+        paths_by_name.setdefault(name.lower(), []).append(pdf_path)
+    collisions = {pdf_path: paths for paths in paths_by_name.values() if len(paths) > 1 for pdf_path in paths}
+
+    def process(pdf_path: str) -> dict[str, str]:
+        if pdf_path in collisions:
+            others = [other for other in collisions[pdf_path] if other != pdf_path]
+            return {"path": pdf_path, "error": "Output name collision with " + ", ".join(others) + "."}
+        return process_file(session, api_url, pdf_path, output_dir, names[pdf_path])
+
+    with make_session(concurrency) as session, ThreadPoolExecutor(max_workers=concurrency) as executor:
+        return list(executor.map(process, pdf_paths))
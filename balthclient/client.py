@@ -4,18 +4,23 @@
 Created on January 20th, 2023
 @title: Balth App
 @version: 2.1
+# Wait for the end of an extraction with one long-poll request
+# Add the bulk mode (bulk.py)
 @author: Balthazar Méhus
 @society: CentraleSupélec
 @abstract: Python PDF extraction and storage - Easy client to request on Balthapp
 """
 
 
+import bulk
 import requests
 from args import Args
 
 # Set the constants
 PDF_PATH = "pdf_source/test-text.pdf"
 API_URL = "http://127.0.0.1:5000"
+# Seconds the API holds a wait request before answering 202
+WAIT_TIMEOUT = 30
 
 '''
 200 : « Everything is OK ». Il s’agit du code qui est délivré lorsqu’une page web ou une ressource se comporte exactement comme prévu.
@@ -55,6 +60,20 @@ def get_info(pdf_id: str) -> tuple[dict[str, str], int]:
         return {"error": str(err)}, 0
 
 
+def wait_info(pdf_id: str, timeout: float = WAIT_TIMEOUT) -> tuple[dict[str, str], int]:
+    """ Wait for the end of the extraction of the PDF file, then get its metadata
+    :param pdf_id: (string) The PDF uuid received previously from baltapp
+    :param timeout: (float) The maximum number of seconds the API waits before answering 202
+    :return: ({metadata} | {"error": str}, status_code: int)
+    """
+    try:
+        # One idle connection until the API is notified, a margin for the network
+        response = requests.get(f'{API_URL}/wait/{pdf_id}', params={'timeout': timeout}, timeout=timeout + 10)
+        return response.json(), response.status_code
+    except Exception as err:
+        return {"error": str(err)}, 0
+
+
 def get_text(pdf_id: str) -> tuple[bytes, int] | tuple[dict[str, str], int]:
     """ Get the text of the PDF file
     :param pdf_id: (string) The PDF uuid received previously from baltapp
@@ -68,15 +87,19 @@ def get_text(pdf_id: str) -> tuple[bytes, int] | tuple[dict[str, str], int]:
 
 
 # --------------------------------------- MANAGE ARGS AND RUN ----------------------------------------
-def _run(client_arg) -> tuple[dict[str, str], int] | tuple[bytes, int]:
+def _run(client_arg) -> tuple[dict[str, str], int] | tuple[bytes, int] | list[dict[str, str]]:
     """ Run the client thanks to argue passed in CLI.
     :param client_arg: (argparse object) The argues passed by the user
-    :return: Flask API response: (b.text | data: dict, status_code: int)
+    :return: Flask API response: (b.text | data: dict, status_code: int), or the report of each file in bulk mode
     """
     if client_arg.postfile_pdfpath:
         return upload_pdf(client_arg.postfile_pdfpath)
+    if client_arg.postdir_source:
+        return bulk.run_bulk(client_arg.postdir_source, API_URL, client_arg.output_dir, client_arg.concurrency)
     if client_arg.getmetadata_uuid:
         return get_info(client_arg.getmetadata_uuid)
+    if client_arg.wait_uuid:
+        return wait_info(client_arg.wait_uuid)
     if client_arg.gettext_uuid:
         return get_text(client_arg.gettext_uuid)
 
@@ -3,36 +3,470 @@
 Created on January 20th, 2023
 @title: Balth App
 @version: 2.1
+# Split large documents in page ranges extracted in parallel
+# Stream the extracted text to the storage instead of returning it through the result backend
+# Report the STARTED state and expire the results once persisted by the balthapp finalizer
+# Return the timings of each stage, recorded in the metrics by the finalizer
+# Parse each PDF once for its pages, text and metadata (JSON), without pdfrw
+# Consume separate queues for the small and the large documents, by priority
+# Write the texts in sub-folders: storage/files/ab/cd/<uuid>.txt
+# Optionally compress the stored texts with gzip (<uuid>.txt.gz)
+# Index the offsets of the pages next to each text, to read a range of pages without the whole text
+# Limit the wall time, CPU time and memory of each task, recycle the worker processes, retry the broker errors
+# Publish the progress (PROGRESS state) and the pages already extracted while a document is being extracted
 @author: Balthazar Méhus
 @society: CentraleSupélec
 @abstract: Python PDF extraction and storage - Celery asynchronous tasks
 """
 
+import gzip
+import json
+import math
 import os
+import resource
+import signal
+import threading
+import time
+import zlib
 
-import pdfminer.high_level
-from celery import Celery
+from celery import Celery, chord
+from celery.signals import task_postrun, task_prerun, worker_process_init
 from celery.utils.log import get_task_logger
-from pdfrw import PdfReader
+from kombu import Queue
+from kombu.exceptions import OperationalError
+from pdfminer.converter import TextConverter
+from pdfminer.layout import LAParams
+from pdfminer.pdfdocument import PDFDocument
+from pdfminer.pdfinterp import PDFPageInterpreter, PDFResourceManager
+from pdfminer.pdfpage import PDFPage
+from pdfminer.pdfparser import PDFParser
+from pdfminer.pdftypes import PDFObjRef, resolve1
+from pdfminer.psparser import PSLiteral
+from pdfminer.utils import decode_text
 
 # The path to the folder where are uploaded the PDFs
 PDF_FOLDER_PATH = "../balthapp/storage/temp"
+# The path to the folder where are stored the extracted texts
+TXT_FOLDER_PATH = "../balthapp/storage/files"
+TXT_EXT = '.txt'
+# Store the texts compressed (<uuid>.txt.gz), the API decompresses them for the clients which do not accept gzip
+TXT_COMPRESSION = os.environ.get('BALTH_TXT_COMPRESSION', '') == 'gzip'
+GZIP_EXT = '.gz'
+# The offsets of the pages, stored next to each text (<uuid>.txt.idx)
+INDEX_EXT = '.idx'
+# Fast enough to keep up with pdfminer, for most of the gain of the level 9
+GZIP_LEVEL = 6
+# Documents from this number of pages are split in chunks extracted in parallel
+PARALLEL_MIN_PAGES = 40
+# The number of pages extracted by one chunk task
+PAGES_PER_CHUNK = 20
+# The queues where the API routes the documents by size (balthapp/config.py)
+SMALL_QUEUE = os.environ.get('BALTH_SMALL_QUEUE', 'extract_small')
+LARGE_QUEUE = os.environ.get('BALTH_LARGE_QUEUE', 'extract_large')
+MAX_PRIORITY = 9
+# Seconds of wall time before SoftTimeLimitExceeded is raised in a task, then before its process is killed
+TASK_SOFT_TIME_LIMIT = int(os.environ.get('BALTH_TASK_SOFT_TIME_LIMIT', 300))
+TASK_TIME_LIMIT = int(os.environ.get('BALTH_TASK_TIME_LIMIT', 360))
+# Seconds of CPU time before CpuTimeLimitExceeded is raised in a task, 0 for no limit
+TASK_CPU_LIMIT = int(os.environ.get('BALTH_TASK_CPU_LIMIT', 240))
+# The address space of each worker process in MB: beyond, the allocations raise MemoryError, 0 for no limit
+TASK_MEMORY_LIMIT_MB = int(os.environ.get('BALTH_TASK_MEMORY_LIMIT_MB', 2048))
+# A worker process is replaced after this number of tasks, or after a task leaving it above this resident memory
+WORKER_MAX_TASKS = int(os.environ.get('BALTH_WORKER_MAX_TASKS', 200))
+WORKER_MAX_RSS_MB = int(os.environ.get('BALTH_WORKER_MAX_RSS_MB', 512))
+# The broker errors are retried, never the extraction errors: the same PDF would fail the same way
+TASK_MAX_RETRIES = int(os.environ.get('BALTH_TASK_MAX_RETRIES', 3))
+# Seconds between two publications of the pages extracted so far, 0 to publish only the whole text
+PROGRESS_INTERVAL = float(os.environ.get('BALTH_PROGRESS_INTERVAL', 1))
+# The number of pages extracted by the chunks of a document, added up in the result backend
+PROGRESS_PREFIX = 'balth:progress:'
+# The ids of the chunks of a document: the finalizer reads the error of the failed one (balthapp/config.py)
+CHUNKS_PREFIX = 'balth:chunks:'
 
 logger = get_task_logger(__name__)
 
 celery_app = Celery('tasks',
                     broker='redis://127.0.0.1:6379',
                     backend='redis://127.0.0.1:6379/0')
+# The API tells a started task from a queued one
+celery_app.conf.task_track_started = True
+# The results are persisted in the db by the finalizer as soon as they are ready
+celery_app.conf.result_expires = 3600
+# Without -Q a worker consumes both queues; dedicated pools use -Q extract_small or -Q extract_large
+celery_app.conf.task_queues = (Queue(SMALL_QUEUE), Queue(LARGE_QUEUE))
+celery_app.conf.task_default_queue = SMALL_QUEUE
+# Only large documents are split: their chunks stay in the pool of the large documents
+celery_app.conf.task_routes = {'tasks.extract_pages': {'queue': LARGE_QUEUE},
+                               'tasks.merge_pages': {'queue': LARGE_QUEUE}}
+# Same priority lists as the API, and one task reserved at a time so that the priorities apply
+celery_app.conf.broker_transport_options = {'queue_order_strategy': 'priority',
+                                            'priority_steps': list(range(MAX_PRIORITY + 1)), 'sep': ':'}
+celery_app.conf.worker_prefetch_multiplier = 1
+# The limits apply with the prefork pool (the default): a stuck or leaking extraction never blocks a worker.
+# The tasks are acknowledged when they start, a process killed by a limit does not get its PDF redelivered
+celery_app.conf.task_soft_time_limit = TASK_SOFT_TIME_LIMIT
+celery_app.conf.task_time_limit = TASK_TIME_LIMIT
+celery_app.conf.task_acks_late = False
+celery_app.conf.worker_max_tasks_per_child = WORKER_MAX_TASKS
+# In KB
+celery_app.conf.worker_max_memory_per_child = WORKER_MAX_RSS_MB * 1024
 
 
-@celery_app.task()
-def extract_data(pdf_name: str) -> dict[str, str]:
+class CpuTimeLimitExceeded(Exception):
+    """The task used more than TASK_CPU_LIMIT seconds of CPU time"""
+
+
+def _raise_cpu_limit(signum, frame):
+    raise CpuTimeLimitExceeded(f'CPU time limit ({TASK_CPU_LIMIT}s) exceeded')
+
+
+@worker_process_init.connect
+def _limit_memory(**kwargs) -> None:
+    # In each process of the pool: pdfminer fails with MemoryError instead of the host swapping or killing
+    if not TASK_MEMORY_LIMIT_MB:
+        return
+    limit = TASK_MEMORY_LIMIT_MB * 1024 * 1024
+    _, hard = resource.getrlimit(resource.RLIMIT_AS)
+    if hard != resource.RLIM_INFINITY:
+        limit = min(limit, hard)
+    resource.setrlimit(resource.RLIMIT_AS, (limit, hard))
+
+
+@task_prerun.connect
+def _start_cpu_limit(**kwargs) -> None:
+    # The kernel sends SIGXCPU once the process used the CPU time of the previous tasks plus the limit.
+    # Signals are only handled in the main thread: the prefork processes, not the threads pools
+    if not TASK_CPU_LIMIT or threading.current_thread() is not threading.main_thread():
+        return
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    _, hard = resource.getrlimit(resource.RLIMIT_CPU)
+    soft = math.ceil(usage.ru_utime + usage.ru_stime) + TASK_CPU_LIMIT
+    if hard != resource.RLIM_INFINITY:
+        soft = min(soft, hard)
+    signal.signal(signal.SIGXCPU, _raise_cpu_limit)
+    resource.setrlimit(resource.RLIMIT_CPU, (soft, hard))
+
+
+@task_postrun.connect
+def _stop_cpu_limit(**kwargs) -> None:
+    if not TASK_CPU_LIMIT or threading.current_thread() is not threading.main_thread():
+        return
+    _, hard = resource.getrlimit(resource.RLIMIT_CPU)
+    resource.setrlimit(resource.RLIMIT_CPU, (hard, hard))
+
+
+def _count_pages(document: PDFDocument) -> int:
+    """Read the number of pages in the page tree, without parsing the pages themselves
+    :param document: (PDFDocument) The parsed PDF
+    :return: (int) The number of pages, 0 if it cannot be read
+    """
+    try:
+        return int(resolve1(resolve1(document.catalog['Pages'])['Count']))
+    except Exception:
+        return 0
+
+
+def _txt_name(pdf_name: str) -> str:
+    return os.path.splitext(pdf_name)[0] + TXT_EXT
+
+
+def _txt_path(txt_name: str, compressed: bool = False) -> str:
+    """Give the path where a text is stored, creating its sub-folder: abcd-... goes to ab/cd/ (balthapp/service.py)
+    :param txt_name: (str) The name of the text file
+    :param compressed: (bool) The text is stored with gzip
+    :return: (str) The path to the text file
+    """
+    folder = os.path.join(TXT_FOLDER_PATH, txt_name[0:2], txt_name[2:4])
+    os.makedirs(folder, exist_ok=True)
+    return os.path.join(folder, txt_name + GZIP_EXT if compressed else txt_name)
+
+
+class _PagedText:
+    """The binary output of pdfminer, which records where each page starts in the text and in the stored file"""
+
+    def __init__(self, txt_file, compressed: bool = False):
+        self._file = txt_file
+        # One gzip member for the whole text: a full flush between the pages resets the compressor,
+        # so that the API inflates a page from its stored offset without the previous ones
+        self._gzip = None
+        if compressed:
+            self._gzip = gzip.GzipFile(fileobj=txt_file, mode='wb', compresslevel=GZIP_LEVEL, mtime=0)
+        self.size = 0
+        self.index = {'compressed': compressed, 'text': [0], 'stored': [txt_file.tell()]}
+
+    def write(self, data: bytes) -> int:
+        if self._gzip is not None:
+            self._gzip.write(data)
+        else:
+            self._file.write(data)
+        self.size += len(data)
+        return len(data)
+
+    def end_page(self) -> None:
+        if self._gzip is not None:
+            self._gzip.flush(zlib.Z_FULL_FLUSH)
+        self.index['text'].append(self.size)
+        self.index['stored'].append(self._file.tell())
+
+    @property
+    def pages(self) -> int:
+        return len(self.index['text']) - 1
+
+    def flush(self) -> None:
+        # The pages of the index are on disk before the index is published
+        if not self._file.closed:
+            self._file.flush()
+
+    def close(self) -> None:
+        # Writes the gzip trailer, the file itself is closed by its owner
+        if self._gzip is not None:
+            self._gzip.close()
+
+
+class _Progress:
+    """Publish the pages extracted so far, every PROGRESS_INTERVAL seconds at most: their index next to the text,
+    read by GET /text/<pdf_id>/pages, and the PROGRESS state of the extraction task, read by GET /metadata/<pdf_id>"""
+
+    def __init__(self, task, task_id: str, index_path: str, page_count: int, first: int = 0, chunked: bool = False):
+        self._task = task
+        self._task_id = task_id
+        self.index_path = index_path
+        self._page_count = page_count
+        # The index of the first page of the text in the document (from 0), for the parts of the chunks
+        self._first = first
+        # The chunks run in parallel: they add their pages to a counter shared by the document
+        self._chunked = chunked
+        self._reported = 0
+        self._published_at = time.monotonic()
+
+    def __call__(self, text: _PagedText) -> None:
+        if not PROGRESS_INTERVAL or time.monotonic() - self._published_at < PROGRESS_INTERVAL:
+            return
+        self.publish(text)
+
+    def publish(self, text: _PagedText) -> None:
+        self._published_at = time.monotonic()
+        text.flush()
+        _write_index(self.index_path, dict(text.index, first=self._first, pages=self._page_count))
+        self._report(text.pages)
+
+    def _report(self, pages: int) -> None:
+        # An eager task (benchmarks) has no result backend to report to
+        if self._task.request.is_eager or not self._task_id:
+            return
+        try:
+            pages_done = pages
+            if self._chunked:
+                key = PROGRESS_PREFIX + self._task_id
+                pages_done = self._task.backend.client.incrby(key, pages - self._reported)
+                self._task.backend.client.expire(key, celery_app.conf.result_expires)
+            self._reported = pages
+            self._task.update_state(task_id=self._task_id, state='PROGRESS',
+                                    meta={'pages_done': pages_done, 'pages': self._page_count})
+        except Exception as err:
+            # The progress is for the clients, the extraction goes on without it
+            logger.warning('Cannot report the progress of %s: %s', self._task_id, err)
+
+
+def _extract_text_to_file(document: PDFDocument, txt_path: str, page_numbers=None,
+                          compressed: bool = False, progress: _Progress = None) -> _PagedText:
+    """Write the text of a parsed PDF in a file, page after page, without holding it in memory
+    :param document: (PDFDocument) The parsed PDF
+    :param txt_path: (str) The path to the text file to write
+    :param page_numbers: (range) The indexes of the pages to extract (from 0), all of them if None
+    :param compressed: (bool) Write the text with gzip
+    :param progress: (_Progress) Publishes the pages extracted so far, None to publish nothing
+    :return: (_PagedText) The size of the text before compression, and the offsets of its pages
+    """
+    try:
+        with open(txt_path, 'wb') as txt_file:
+            text = _PagedText(txt_file, compressed)
+            resource_manager = PDFResourceManager()
+            # Same layout analysis as pdfminer.high_level.extract_text
+            device = TextConverter(resource_manager, text, codec='utf-8', laparams=LAParams())
+            interpreter = PDFPageInterpreter(resource_manager, device)
+            for index, page in enumerate(PDFPage.create_pages(document)):
+                if page_numbers is not None:
+                    if index >= page_numbers.stop:
+                        break
+                    if index not in page_numbers:
+                        continue
+                # The layout of a page, ended by a form feed, is written when it is processed
+                interpreter.process_page(page)
+                text.end_page()
+                if progress is not None:
+                    progress(text)
+            device.close()
+            text.close()
+            return text
+    except Exception:
+        # Do not leave a truncated text in the storage, nor the index of its pages
+        for path in (txt_path, progress.index_path if progress is not None else None):
+            if path and os.path.exists(path):
+                os.remove(path)
+        raise
+
+
+def _index_path(txt_name: str) -> str:
+    # ab/cd/<uuid>.txt.idx, for the plain and the compressed texts
+    return _txt_path(txt_name) + INDEX_EXT
+
+
+def _write_index(index_path: str, index: dict) -> None:
+    """Store the offsets of the pages next to the text (ab/cd/<uuid>.txt.idx), read by GET /text/<pdf_id>/pages
+    :param index_path: (str) The path to the index file
+    :param index: (dict) The offsets of the pages, in the text and in the stored file, and the compression
+    :return: None
+    """
+    with open(index_path + '.tmp', 'w') as index_file:
+        json.dump(index, index_file, separators=(',', ':'))
+    # The API never reads a partial index
+    os.replace(index_path + '.tmp', index_path)
+
+
+@celery_app.task(bind=True, autoretry_for=(OperationalError,), max_retries=TASK_MAX_RETRIES, retry_backoff=True)
+def extract_data(self, pdf_name: str) -> dict:
     logger.info('Go Request - Work is starting ')
+    # Wall clock time, compared by the finalizer to the enqueue time of the API
+    started_at = time.time()
     pdf_url = os.path.join(PDF_FOLDER_PATH, pdf_name)
-    # Extract the text from a PDF
-    text = pdfminer.high_level.extract_text(pdf_url)
-    # Extract metadata from a PDF
-    reader = PdfReader(pdf_url)
-    metadata = reader.Info
-    logger.info('Work is finished')
-    return {'data': str(metadata), 'text': str(text)}
+    # The xref table and the trailer are parsed once for the pages, the metadata and the text
+    with open(pdf_url, 'rb') as pdf_file:
+        document = PDFDocument(PDFParser(pdf_file))
+        page_count = _count_pages(document)
+        start = time.perf_counter()
+        data = _extract_metadata(document)
+        metadata_seconds = time.perf_counter() - start
+        if page_count >= PARALLEL_MIN_PAGES:
+            # Fan out the page ranges, then stitch the texts back in order under this task id
+            logger.info('Splitting %s pages in chunks of %s', page_count, PAGES_PER_CHUNK)
+            chunks = [extract_pages.s(pdf_name, first, min(first + PAGES_PER_CHUNK, page_count),
+                                      progress_id=self.request.id, page_count=page_count)
+                      for first in range(0, page_count, PAGES_PER_CHUNK)]
+            _record_chunks(self, [chunk.freeze().id for chunk in chunks])
+            timings = {'started_at': started_at, 'metadata_seconds': metadata_seconds, 'pages': page_count}
+            return self.replace(chord(chunks, merge_pages.s(pdf_name, data, timings)))
+        # Extract the text from a PDF straight to the storage
+        txt_name = _txt_name(pdf_name)
+        start = time.perf_counter()
+        progress = _Progress(self, self.request.id, _index_path(txt_name), page_count)
+        text = _extract_text_to_file(document, _txt_path(txt_name, TXT_COMPRESSION), compressed=TXT_COMPRESSION,
+                                     progress=progress)
+        text_seconds = time.perf_counter() - start
+    _write_index(_index_path(txt_name), text.index)
+    return _result(data, txt_name, text.size,
+                   {'started_at': started_at, 'text_seconds': text_seconds, 'metadata_seconds': metadata_seconds,
+                    'pages': page_count})
+
+
+@celery_app.task(bind=True)
+def extract_pages(self, pdf_name: str, first: int, last: int, progress_id: str = None, page_count: int = 0) -> dict:
+    """Extract the text of the pages [first, last[ of a PDF in a part file
+    :param pdf_name: (str) The name of the PDF file in the temp folder
+    :param first: (int) The index of the first page (from 0)
+    :param last: (int) The index following the last page
+    :param progress_id: (str) The id of the extraction task of the document, whose progress is reported
+    :param page_count: (int) The number of pages of the document
+    :return: (dict) The path to the part file, the offsets of its pages and the extraction time in seconds
+    """
+    pdf_url = os.path.join(PDF_FOLDER_PATH, pdf_name)
+    part_path = _txt_path(_txt_name(pdf_name)) + '.' + str(first)
+    # The pages of the part are readable until the merge (ab/cd/<uuid>.txt.<first>.idx)
+    progress = _Progress(self, progress_id, part_path + INDEX_EXT, page_count, first=first, chunked=True)
+    start = time.perf_counter()
+    with open(pdf_url, 'rb') as pdf_file:
+        text = _extract_text_to_file(PDFDocument(PDFParser(pdf_file)), part_path, page_numbers=range(first, last),
+                                     progress=progress)
+    if PROGRESS_INTERVAL:
+        progress.publish(text)
+    return {'part_path': part_path, 'offsets': text.index['text'], 'seconds': time.perf_counter() - start}
+
+
+@celery_app.task()
+def merge_pages(parts: list[dict], pdf_name: str, data: dict, timings: dict) -> dict:
+    """Stitch the part files of the chunks, received in the order of the pages
+    :param parts: (list) The results of each chunk
+    :param pdf_name: (str) The name of the PDF file in the temp folder
+    :param data: (dict) The metadata, read by extract_data
+    :param timings: (dict) The timings of extract_data (started_at, metadata_seconds, pages)
+    :return: (dict) The same result as a single extract_data
+    """
+    txt_name = _txt_name(pdf_name)
+    # The parts are plain texts, copied page by page to index them in the whole text
+    with open(_txt_path(txt_name, TXT_COMPRESSION), 'wb') as txt_file:
+        text = _PagedText(txt_file, TXT_COMPRESSION)
+        for part in parts:
+            with open(part['part_path'], 'rb') as part_file:
+                for start, end in zip(part['offsets'], part['offsets'][1:]):
+                    text.write(part_file.read(end - start))
+                    text.end_page()
+        text.close()
+    _write_index(_index_path(txt_name), text.index)
+    # The parts are served until the whole text is indexed
+    for part in parts:
+        for path in (part['part_path'], part['part_path'] + INDEX_EXT):
+            if os.path.exists(path):
+                os.remove(path)
+    # The time spent by all the chunks, not the elapsed time
+    timings = dict(timings, text_seconds=sum(part['seconds'] for part in parts))
+    return _result(data, txt_name, text.size, timings)
+
+
+def _record_chunks(task, chunk_ids: list[str]) -> None:
+    """Keep the ids of the chunks of a document in the result backend, under the id of its extraction task:
+    a failed chunk fails the chord with a ChordError, the finalizer reads the error of the chunk itself
+    :param task: (Task) The extraction task of the document
+    :param chunk_ids: (list) The task ids of the chunks
+    :return: None
+    """
+    if task.request.is_eager:
+        return
+    try:
+        task.backend.client.set(CHUNKS_PREFIX + task.request.id, json.dumps(chunk_ids),
+                                ex=celery_app.conf.result_expires)
+    except Exception as err:
+        logger.warning('Cannot record the chunks of %s: %s', task.request.id, err)
+
+
+def _result(data: dict, txt_name: str, size: int, timings: dict) -> dict:
+    """Build the descriptor sent to the finalizer
+    :return: (dict) The metadata, the name and the size of the text file, and the timings of the extraction
+    """
+    logger.info('Work is finished: %s pages, %s bytes of text in %.3fs (metadata %.3fs)',
+                timings['pages'], size, timings['text_seconds'], timings['metadata_seconds'])
+    return {'data': data, 'txt_name': txt_name, 'size': size, 'timings': timings}
+
+
+def _extract_metadata(document: PDFDocument) -> dict:
+    """Read the Info dictionary from the trailer of a parsed PDF
+    :param document: (PDFDocument) The parsed PDF
+    :return: (dict) The metadata, with JSON values (ex: {"Title": "...", "Author": "..."})
+    """
+    metadata = {}
+    # The trailers come from the latest update to the original file: the latest values win
+    for info in reversed(document.info):
+        metadata.update({key: _json_value(value) for key, value in info.items()})
+    return metadata
+
+
+def _json_value(value, depth: int = 0):
+    """Convert a PDF object to a JSON value: strings are decoded, names lose their slash
+    :param value: The PDF object
+    :param depth: (int) The nesting level, to stop on cyclic references
+    :return: A str, number, bool, list, dict or None
+    """
+    if depth > 8:
+        return None
+    if isinstance(value, PDFObjRef):
+        value = resolve1(value)
+    if isinstance(value, bytes):
+        return decode_text(value)
+    if isinstance(value, PSLiteral):
+        return value.name if isinstance(value.name, str) else decode_text(value.name)
+    if isinstance(value, (bool, int, float, str)) or value is None:
+        return value
+    if isinstance(value, (list, tuple)):
+        return [_json_value(item, depth + 1) for item in value]
+    if isinstance(value, dict):
+        return {str(key): _json_value(item, depth + 1) for key, item in value.items()}
+    return str(value)
@@ -0,0 +1,225 @@
+#!/usr/bin/env python3
+# coding: utf-8
+"""
+Created on January 20th, 2023
+@title: Balth App
+@version: 2.1
+@author: Balthazar Méhus
+@society: CentraleSupélec
+@abstract: Python PDF extraction and storage - Benchmark of the upload -> extract -> retrieve pipeline
+Run it from the project folder: python benchmarks/bench_pipeline.py --docs 50 --pages 1,10,100
+The API, the worker and the finalizer run in this process: Celery is in eager mode and the storage
+lives in a temporary folder, so neither redis nor a worker is needed.
+"""
+
+import argparse
+import io
+import json
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+ROOT_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+# --------------------------------------- SYNTHETIC PDF ----------------------------------------
+def make_pdf(pages: int, lines_per_page: int, line_length: int, seed: int) -> bytes:
+    """ Build a PDF of text pages, unique by its seed (the API deduplicates identical uploads)
+    :param pages: (int) The number of pages
+    :param lines_per_page: (int) The number of text lines on each page
+    :param line_length: (int) The number of characters by line
+    :param seed: (int) Written in the text to make the document unique
+    :return: (bytes) The PDF file
+    """
+    words = "lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod tempor "
+    objects = [b"<< /Type /Catalog /Pages 2 0 R >>",
+               None,
+               b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>"]
+    kids = []
+    for page in range(pages):
+        lines = []
+        for line in range(lines_per_page):
+            text = f"doc {seed} page {page + 1} line {line + 1} " + words * (line_length // len(words) + 1)
+            lines.append("(" + text[:line_length] + ") Tj T*")
+        content = ("BT /F1 9 Tf 11 TL 40 800 Td " + " ".join(lines) + " ET").encode('latin-1')
+        objects.append(b"<< /Length " + str(len(content)).encode() + b" >>\nstream\n" + content + b"\nendstream")
+        content_ref = len(objects)
+        objects.append(b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 595 842] /Resources << /Font << /F1 3 0 R >> >> "
+                       b"/Contents " + str(content_ref).encode() + b" 0 R >>")
+        kids.append(str(len(objects)).encode() + b" 0 R")
+    objects[1] = b"<< /Type /Pages /Kids [" + b" ".join(kids) + b"] /Count " + str(pages).encode() + b" >>"
+    objects.append(b"<< /Title (Benchmark " + str(seed).encode() + b") /Author (bench_pipeline) "
+                   b"/Producer (balthapp benchmarks) >>")
+    info_ref = len(objects)
+
+    pdf = bytearray(b"%PDF-1.4\n")
+    offsets = []
+    for number, body in enumerate(objects, start=1):
+        offsets.append(len(pdf))
+        pdf += str(number).encode() + b" 0 obj\n" + body + b"\nendobj\n"
+    xref_offset = len(pdf)
+    pdf += b"xref\n0 " + str(len(objects) + 1).encode() + b"\n0000000000 65535 f \n"
+    for offset in offsets:
+        pdf += b"%010d 00000 n \n" % offset
+    pdf += (b"trailer\n<< /Size " + str(len(objects) + 1).encode() + b" /Root 1 0 R /Info "
+            + str(info_ref).encode() + b" 0 R >>\nstartxref\n" + str(xref_offset).encode() + b"\n%%EOF\n")
+    return bytes(pdf)
+
+
+# --------------------------------------- PIPELINE ----------------------------------------
+def setup_pipeline(work_dir: str):
+    """ Import the API, the worker and the finalizer on a temporary storage, wired by an eager Celery app
+    :param work_dir: (str) The temporary folder which replaces the project folder
+    :return: (Flask app, extract task) The API and the extraction task of the worker
+    """
+    for folder in ('temp', 'files', 'db'):
+        os.makedirs(os.path.join(work_dir, 'balthapp', 'storage', folder))
+    os.makedirs(os.path.join(work_dir, 'balthworker'))
+    # The modules use paths relative to the folder they are run from
+    os.chdir(os.path.join(work_dir, 'balthapp'))
+    sys.path[:0] = [os.path.join(ROOT_PATH, 'balthapp'), os.path.join(ROOT_PATH, 'balthworker')]
+
+    import balthapp
+    import finalizer
+    import tasks
+
+    # One in-process app runs the tasks when they are sent, then their linked finalizer callbacks
+    celery_app = tasks.celery_app
+    celery_app.conf.update(task_always_eager=True, task_eager_propagates=False,
+                           broker_url='memory://', result_backend='cache+memory://')
+    celery_app.task(name=finalizer.finalize_extraction.name, ignore_result=True)(finalizer.finalize_extraction.run)
+
+    # An error callback registered in the same app is called with the failed request
+    @celery_app.task(name=finalizer.finalize_failure.name, ignore_result=True)
+    def finalize_failure(request, exc, traceback, pdf_id, client=None):
+        finalizer.finalize_failure.run(request.id, pdf_id, client)
+
+    # Eager Celery cannot replace a task by a chord: the page chunks need real workers to run in parallel
+    tasks.PARALLEL_MIN_PAGES = sys.maxsize
+    balthapp.celery_app = celery_app
+    balthapp.limiter.enabled = False
+    balthapp.flask_app.root_path = os.getcwd()
+    return balthapp.flask_app, tasks.extract_data
+
+
+def percentile(values: list[float], rank: float) -> float:
+    """ The nearest-rank percentile of a list of durations
+    :param values: (list) The durations
+    :param rank: (float) The percentile (0-100)
+    :return: (float) The value, 0 for an empty list
+    """
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, int(round(rank / 100 * len(ordered) + 0.5)) - 1))]
+
+
+def run_scenario(flask_app, extract_task, docs: int, pages: int, lines_per_page: int, line_length: int,
+                 seed: int) -> dict:
+    """ Upload, extract and read back a number of synthetic PDFs of the same shape
+    :return: (dict) The throughput, the latency percentiles by stage, the CPU time and the peak RSS
+    """
+    from celery.signals import task_postrun, task_prerun
+
+    timings = {'upload': [], 'extract': [], 'metadata': [], 'text': []}
+    started = {}
+
+    def on_prerun(task_id=None, task=None, **kwargs):
+        if task.name == extract_task.name:
+            started[task_id] = time.perf_counter()
+
+    def on_postrun(task_id=None, task=None, **kwargs):
+        if task_id in started:
+            timings['extract'].append(time.perf_counter() - started.pop(task_id))
+
+    task_prerun.connect(on_prerun, weak=False)
+    task_postrun.connect(on_postrun, weak=False)
+    pdfs = [make_pdf(pages, lines_per_page, line_length, seed + index) for index in range(docs)]
+    bytes_processed = sum(len(pdf) for pdf in pdfs)
+    failures = 0
+    usage_before = resource.getrusage(resource.RUSAGE_SELF)
+    wall_start = time.perf_counter()
+    client = flask_app.test_client()
+    for index, pdf in enumerate(pdfs):
+        start = time.perf_counter()
+        # In eager mode the upload runs the extraction and the finalizer before answering
+        response = client.post('/documents', data={'pdf_file': (io.BytesIO(pdf), f'bench-{seed + index}.pdf')})
+        timings['upload'].append(time.perf_counter() - start)
+        if response.status_code not in (200, 201):
+            failures += 1
+            continue
+        pdf_id = response.get_json()['_id']
+        start = time.perf_counter()
+        response = client.get(f'/metadata/{pdf_id}')
+        timings['metadata'].append(time.perf_counter() - start)
+        if response.get_json().get('task_state') != 'SUCCESS':
+            failures += 1
+            continue
+        start = time.perf_counter()
+        response = client.get(f'/text/{pdf_id}')
+        response.get_data()
+        timings['text'].append(time.perf_counter() - start)
+    wall_time = time.perf_counter() - wall_start
+    usage_after = resource.getrusage(resource.RUSAGE_SELF)
+    task_prerun.disconnect(on_prerun)
+    task_postrun.disconnect(on_postrun)
+
+    return {
+        'docs': docs,
+        'pages': pages,
+        'bytes': bytes_processed,
+        'failures': failures,
+        'wall_s': round(wall_time, 3),
+        'docs_per_s': round(docs / wall_time, 2),
+        'pages_per_s': round(docs * pages / wall_time, 2),
+        'cpu_s': round((usage_after.ru_utime - usage_before.ru_utime)
+                       + (usage_after.ru_stime - usage_before.ru_stime), 3),
+        # ru_maxrss is in kilobytes on Linux
+        'peak_rss_mb': round(usage_after.ru_maxrss / 1024, 1),
+        'latency_ms': {stage: {'p50': round(percentile(values, 50) * 1000, 2),
+                               'p95': round(percentile(values, 95) * 1000, 2),
+                               'p99': round(percentile(values, 99) * 1000, 2)}
+                       for stage, values in timings.items()},
+    }
+
+
+def print_report(results: list[dict]) -> None:
+    for result in results:
+        print(f"\n{result['docs']} docs x {result['pages']} pages ({result['bytes'] / 1024 / 1024:.1f} MB), "
+              f"{result['failures']} failures")
+        print(f"  throughput: {result['docs_per_s']} docs/s, {result['pages_per_s']} pages/s "
+              f"({result['wall_s']} s wall, {result['cpu_s']} s CPU, peak RSS {result['peak_rss_mb']} MB)")
+        print(f"  {'stage':<10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+        for stage, latency in result['latency_ms'].items():
+            print(f"  {stage:<10}{latency['p50']:>10}{latency['p95']:>10}{latency['p99']:>10}")
+
+
+def _parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark of the balthapp upload -> extract -> retrieve pipeline.")
+    parser.add_argument("--docs", type=int, default=20, help="The number of documents by scenario. Default: 20")
+    parser.add_argument("--pages", type=str, default="1,10",
+                        help="The page counts to benchmark, comma separated (one scenario each). Default: 1,10")
+    parser.add_argument("--lines-per-page", type=int, default=50, help="Text lines on each page. Default: 50")
+    parser.add_argument("--line-length", type=int, default=90, help="Characters by line. Default: 90")
+    parser.add_argument("--json", dest="json_output", action="store_true", help="Print the results as JSON")
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = _parse_args()
+    work_dir = tempfile.mkdtemp(prefix='balth-bench-')
+    try:
+        app, extract_data = setup_pipeline(work_dir)
+        bench_results = [run_scenario(app, extract_data, args.docs, int(pages), args.lines_per_page,
+                                      args.line_length, seed=index * args.docs)
+                         for index, pages in enumerate(args.pages.split(','))]
+    finally:
+        os.chdir(ROOT_PATH)
+        shutil.rmtree(work_dir, ignore_errors=True)
+    if args.json_output:
+        print(json.dumps(bench_results, indent=2))
+    else:
+        print_report(bench_results)
@@ -1,14 +1,42 @@
 # coding:utf-8
 
+import gzip
+import hashlib
+import io
+import json
 import os
 import sys
+import tempfile
 import unittest
+from datetime import datetime
 from unittest.mock import MagicMock, patch
 from flask import Flask, request
 from flask_testing import TestCase
 
-sys.path.append("..")
+# The modules of balthapp import each other by name, whatever the folder pytest is run from
+TESTS_PATH = os.path.dirname(os.path.abspath(__file__))
+ROOT_PATH = os.path.dirname(TESTS_PATH)
+sys.path[:0] = [os.path.join(ROOT_PATH, "balthapp"), os.path.join(ROOT_PATH, "balthworker"),
+                os.path.join(ROOT_PATH, "balthclient"), ROOT_PATH]
+# A throwaway db, migrated when balthapp is imported, instead of the relative storage/db/pdf_infos.db
+TMP_PATH = tempfile.mkdtemp(prefix="balth-tests-")
+os.environ.setdefault("BALTH_DB_URL", "sqlite:///" + os.path.join(TMP_PATH, "pdf_infos.db"))
 from balthapp import *
+import balthapp
+from cache import TTLCache
+import finalizer
+import manage
+import migrations
+import retention
+from metrics import Metrics
+import tasks
+import bulk
+from celery.exceptions import ChordError, SoftTimeLimitExceeded
+from pdfminer.pdfdocument import PDFDocument
+from pdfminer.pdfparser import PDFParser
+from pdfminer.psparser import PSLiteral
+from sqlalchemy import create_engine, inspect
+from config import CHUNKS_PREFIX, FINALIZED_CHANNEL, INFLIGHT_PREFIX, INFLIGHT_TTL
 
 
 class TestUploadPDF(unittest.TestCase):
@@ -68,3 +96,875 @@ class TestUploadPDF(unittest.TestCase):
 
     if __name__ == '__main__':
         unittest.main()
+
+
+class TestTTLCache(unittest.TestCase):
+
+    def test_get_missing_key(self):
+        cache = TTLCache(max_size=2, ttl=60)
+        self.assertIsNone(cache.get('missing'))
+
+    def test_evict_least_recently_used(self):
+        # Test case when the cache is full: the least recently read entry is evicted
+        cache = TTLCache(max_size=2, ttl=60)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+        self.assertEqual(cache.get('a'), 1)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('c'), 3)
+        self.assertEqual(len(cache), 2)
+
+    @patch('cache.time.monotonic')
+    def test_expire_after_ttl(self, monotonic_mock):
+        # Test case when an entry is read after its time to live
+        monotonic_mock.return_value = 100
+        cache = TTLCache(max_size=2, ttl=60)
+        cache.set('a', 1)
+        monotonic_mock.return_value = 161
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(len(cache), 0)
+
+
+class TestBulkMetadata(unittest.TestCase):
+
+    def setUp(self):
+        limiter.enabled = False
+        self.client = flask_app.test_client()
+        self.batch_id = str(uuid4())
+        self.ids = {state: str(uuid4()) for state in ('SUCCESS', 'PENDING')}
+        service.db_insert_pdf_infos([{'id': pdf_id, 'name': 'test.pdf', 'task_id': str(uuid4()),
+                                      'task_state': state, 'batch_id': self.batch_id}
+                                     for state, pdf_id in self.ids.items()])
+
+    def tearDown(self):
+        service.db_delete_pdfs(list(self.ids.values()))
+
+    @patch('balthapp._live_task_states', return_value={})
+    def test_filtered_ids_are_not_missing(self, live_states_mock):
+        # Test case when an existing document is only filtered out by its state
+        response = self.client.post('/metadata', json={'ids': [self.ids['SUCCESS'], self.ids['PENDING'], 'zz'],
+                                                       'task_state': 'SUCCESS'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([document['_id'] for document in response.get_json()['documents']], [self.ids['SUCCESS']])
+        self.assertEqual(response.get_json()['missing'], ['zz'])
+
+    def test_filter_on_the_live_state(self):
+        # Test case when the worker started a document still PENDING in the db
+        with patch('balthapp._live_task_states') as live_states_mock:
+            live_states_mock.side_effect = lambda task_ids: {task_id: 'STARTED' for task_id in task_ids}
+            response = self.client.post('/metadata', json={'batch_id': self.batch_id, 'task_state': 'STARTED'})
+        self.assertEqual([document['_id'] for document in response.get_json()['documents']], [self.ids['PENDING']])
+        self.assertEqual(response.get_json()['missing'], [])
+
+    def test_reject_a_batch_id_not_string(self):
+        # Test case when the batch_id is not a string: rejected before the lookup
+        for batch_id in ([1], {'id': 1}, 1):
+            self.assertEqual(self.client.post('/metadata', json={'batch_id': batch_id}).status_code, 422)
+
+
+class TestFailureReason(unittest.TestCase):
+
+    def setUp(self):
+        patcher = patch('finalizer.celery_app')
+        self.celery_mock = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.results = {'c1': MagicMock(state='SUCCESS', result={}),
+                        'c2': MagicMock(state='FAILURE', result=ValueError()),
+                        'c3': MagicMock(state='FAILURE', result=SoftTimeLimitExceeded())}
+        self.celery_mock.AsyncResult.side_effect = lambda task_id: self.results[task_id]
+        self.celery_mock.backend.client.get.return_value = json.dumps(['c1', 'c2', 'c3'])
+
+    def test_single_task_error(self):
+        # Test case when the extraction task of a small document failed itself
+        self.results['root'] = MagicMock(result=MemoryError())
+        self.celery_mock.backend.client.get.return_value = None
+        self.assertEqual(finalizer._failure_reason('root'), 'MemoryError')
+
+    def test_chunk_error_before_the_chord_error(self):
+        # Test case when the chord calls the error callback before storing its ChordError
+        self.results['root'] = MagicMock(state='PROGRESS', result={'pages_done': 20, 'pages': 60})
+        self.assertEqual(finalizer._failure_reason('root'), 'SoftTimeLimitExceeded')
+        self.celery_mock.backend.client.get.assert_called_with(CHUNKS_PREFIX + 'root')
+
+    def test_chunk_error_behind_the_chord_error(self):
+        # Test case when the ChordError of the chunked document is already stored
+        self.results['root'] = MagicMock(state='FAILURE', result=ChordError('Dependency c3 raised ...'))
+        self.assertEqual(finalizer._failure_reason('root'), 'SoftTimeLimitExceeded')
+
+    @patch('finalizer._notify')
+    @patch('finalizer._release_client')
+    def test_quarantine_a_chunked_document_at_once(self, release_mock, notify_mock):
+        # Test case when a chunk of a large document broke a limit: its content is quarantined at the first failure
+        self.results['root'] = MagicMock(state='PROGRESS', result={'pages_done': 20, 'pages': 60})
+        pdf_id, content_hash = str(uuid4()), uuid4().hex
+        service.db_insert_pdf_info({'id': pdf_id, 'name': 'test.pdf', 'task_id': 'root',
+                                    'content_hash': content_hash})
+        self.addCleanup(service.db_release_quarantine, content_hash)
+        self.addCleanup(service.db_delete_pdf, pdf_id)
+        finalizer.finalize_failure.run('root', pdf_id)
+        self.assertEqual(service.db_get_quarantined_hashes([content_hash]), {content_hash})
+
+
+class TestFinalizeRetry(unittest.TestCase):
+
+    @patch('finalizer.service.db_update_pdf', return_value=False)
+    def test_lost_update_is_retried(self, update_mock):
+        # Test case when the result cannot be written in the db: the callback fails to be retried
+        result = {'data': {}, 'txt_name': 'x.txt', 'size': 0}
+        with self.assertRaises(finalizer.PersistError):
+            finalizer.finalize_extraction.run(result, str(uuid4()), 'http://localhost/')
+        with self.assertRaises(finalizer.PersistError):
+            finalizer.finalize_failure.run('root', str(uuid4()))
+        self.assertIn(finalizer.PersistError, finalizer.finalize_extraction.autoretry_for)
+
+
+class TestSweepTempPdfs(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp(dir=TMP_PATH)
+        patcher = patch('retention.PDF_FOLDER_PATH', self.folder)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        # queued behind a backlog, running on a worker, lost
+        self.pdf_ids = {state: str(uuid4()) for state in ('queued', 'running', 'lost')}
+        for state, pdf_id in self.pdf_ids.items():
+            service.db_insert_pdf_info({'id': pdf_id, 'name': 'test.pdf', 'task_id': 'task-' + state})
+            self.addCleanup(service.db_delete_pdf, pdf_id)
+            path = os.path.join(self.folder, pdf_id + '.pdf')
+            open(path, 'wb').close()
+            os.utime(path, (0, 0))
+        self.celery_mock = MagicMock()
+        self.celery_mock.backend.get_key_for_task.side_effect = lambda task_id: task_id
+        self.celery_mock.backend.mget.side_effect = lambda keys: [
+            json.dumps({'status': 'PROGRESS'}) if key == 'task-running' else None for key in keys]
+        self.celery_mock.backend.decode_result.side_effect = json.loads
+        self.broker_mock = MagicMock()
+        self.broker_mock.lrange.side_effect = lambda name, start, end: (
+            [json.dumps({'headers': {'id': 'task-queued'}})] if name == 'extract_small:3' and start == 0 else [])
+        self.broker_mock.hscan_iter.return_value = []
+
+    def test_keep_the_queued_and_running_extractions(self):
+        # Test case when the PDF of a backlog are older than the TTL: only the lost extraction is failed
+        removed = retention.sweep_temp_pdfs(celery_app=self.celery_mock, broker=self.broker_mock)
+        self.assertEqual(removed, 1)
+        self.assertEqual(sorted(os.listdir(self.folder)),
+                         sorted([self.pdf_ids['queued'] + '.pdf', self.pdf_ids['running'] + '.pdf']))
+        states = {pdf.id: pdf.task_state for pdf in service.db_get_pdf_infos(pdf_ids=list(self.pdf_ids.values()))}
+        self.assertEqual(states[self.pdf_ids['lost']], 'FAILURE')
+        self.assertNotEqual(states[self.pdf_ids['queued']], 'FAILURE')
+
+    def test_keep_the_pending_extractions_without_broker(self):
+        # Test case when the queues cannot be read: no pending PDF is removed
+        self.broker_mock.lrange.side_effect = ConnectionError()
+        self.assertEqual(retention.sweep_temp_pdfs(celery_app=self.celery_mock, broker=self.broker_mock), 0)
+        self.assertEqual(retention.sweep_temp_pdfs(), 0)
+        self.assertEqual(len(os.listdir(self.folder)), 3)
+
+
+class TestMetrics(unittest.TestCase):
+
+    def test_aggregated_until_flushed(self):
+        # Test case when the hot path records metrics: redis is only called by the flush, in one round-trip
+        redis_mock = MagicMock()
+        metrics = Metrics(redis_mock, flush_interval=3600)
+        metrics.inc('balth_extractions_total', labels={'state': 'SUCCESS'})
+        metrics.inc('balth_extractions_total', labels={'state': 'SUCCESS'})
+        metrics.observe('balth_db_seconds', 0.02)
+        redis_mock.pipeline.assert_not_called()
+        metrics.flush()
+        pipeline = redis_mock.pipeline.return_value
+        pipeline.hincrbyfloat.assert_any_call('balth:metrics:counters', 'balth_extractions_total{state="SUCCESS"}', 2)
+        pipeline.hincrbyfloat.assert_any_call('balth:metrics:histograms', 'balth_db_seconds|0.05', 1)
+        pipeline.hincrbyfloat.assert_any_call('balth:metrics:histograms', 'balth_db_seconds|+Inf', 1)
+        self.assertEqual(pipeline.execute.call_count, 1)
+        metrics.flush()
+        self.assertEqual(pipeline.execute.call_count, 1)
+
+
+class TestPageIndex(unittest.TestCase):
+    pages = [b'first page\n\x0c', b'second page \xc3\xa9\n\x0c', b'third page\n\x0c']
+
+    def write_text(self, compressed: bool) -> tuple[str, dict]:
+        # The text written page by page by the worker, with the offsets of its pages
+        path = os.path.join(TMP_PATH, str(uuid4()) + '.txt')
+        with open(path, 'wb') as txt_file:
+            text = tasks._PagedText(txt_file, compressed)
+            for page in self.pages:
+                text.write(page)
+                text.end_page()
+            text.close()
+        return path, text.index
+
+    def read_pages(self, path: str, index: dict, first: int, last: int) -> bytes:
+        return b''.join(service.fs_read_pages(path, index['stored'][first - 1], index['stored'][last],
+                                              index['compressed']))
+
+    def test_plain_pages(self):
+        # Test case when the pages of a plain text are read from their offsets
+        path, index = self.write_text(compressed=False)
+        self.assertEqual(index['text'], index['stored'])
+        self.assertEqual(self.read_pages(path, index, 2, 2), self.pages[1])
+        self.assertEqual(self.read_pages(path, index, 2, 3), self.pages[1] + self.pages[2])
+
+    def test_gzip_pages_from_a_full_flush(self):
+        # Test case when a page of a compressed text is inflated alone, from the full flush before it
+        path, index = self.write_text(compressed=True)
+        with open(path, 'rb') as txt_file:
+            self.assertEqual(gzip.decompress(txt_file.read()), b''.join(self.pages))
+        self.assertEqual(index['text'][-1], len(b''.join(self.pages)))
+        for first, last in ((1, 1), (2, 2), (3, 3), (2, 3), (1, 3)):
+            self.assertEqual(self.read_pages(path, index, first, last), b''.join(self.pages[first - 1:last]))
+        # The length announced by the API is the one of the text, not of the stored bytes
+        self.assertEqual(index['text'][2] - index['text'][1], len(self.pages[1]))
+
+
+class TestSearch(unittest.TestCase):
+
+    def setUp(self):
+        limiter.enabled = False
+        self.client = flask_app.test_client()
+        self.pdf_id = str(uuid4())
+        service.db_insert_pdf_info({'id': self.pdf_id, 'name': 'report.pdf', 'task_id': str(uuid4()),
+                                    'task_state': 'SUCCESS'})
+        self.addCleanup(service.db_delete_pdfs, [self.pdf_id])
+        service.db_index_pages(self.pdf_id, [(1, 'An introduction to nothing'),
+                                             (3, 'The zygomorphic flowers of the orchids\x00')])
+
+    def test_pages_found(self):
+        # Test case when a word is in one page of a document
+        response = self.client.get('/search', query_string={'q': 'zygomorphic'})
+        self.assertEqual(response.status_code, 200)
+        results = response.get_json()['results']
+        self.assertEqual([(result['_id'], result['page']) for result in results], [(self.pdf_id, 3)])
+        self.assertIn('<mark>zygomorphic</mark>', results[0]['snippet'])
+        self.assertTrue(results[0]['link'].endswith(f'text/{self.pdf_id}/pages?first=3'))
+        self.assertIsNone(response.get_json()['next_offset'])
+
+    def test_next_offset(self):
+        # Test case when there are more matching pages than the limit
+        response = self.client.get('/search', query_string={'q': 'the OR an', 'limit': 1})
+        self.assertEqual(len(response.get_json()['results']), 1)
+        self.assertEqual(response.get_json()['next_offset'], 1)
+
+    def test_invalid_query(self):
+        # Test case when the query is empty or is not a valid FTS5 query
+        for query in ('', '"zygomorphic', 'AND', 'NEAR(zygomorphic'):
+            response = self.client.get('/search', query_string={'q': query})
+            self.assertEqual(response.status_code, 400, query)
+            self.assertIn('error', response.get_json())
+
+
+class TestPdfDate(unittest.TestCase):
+
+    def test_dates_in_utc(self):
+        # Test case when the date has a time zone, or only some of its fields
+        self.assertEqual(service.pdf_date("D:20230131134645+01'00'"), datetime(2023, 1, 31, 12, 46, 45))
+        self.assertEqual(service.pdf_date("D:20230131134645-05'30'"), datetime(2023, 1, 31, 19, 16, 45))
+        self.assertEqual(service.pdf_date("D:20230131134645Z"), datetime(2023, 1, 31, 13, 46, 45))
+        self.assertEqual(service.pdf_date(" 20230131 "), datetime(2023, 1, 31))
+        self.assertEqual(service.pdf_date("D:2023"), datetime(2023, 1, 1))
+
+    def test_unreadable_dates(self):
+        # Test case when the value is not a date: the metadata keep it, the column stays empty
+        for value in (None, 20230131, '', 'yesterday', 'D:20231345', 'D:20230230'):
+            self.assertIsNone(service.pdf_date(value), value)
+
+
+@patch('balthapp._live_task_states', return_value={})
+class TestListDocuments(unittest.TestCase):
+    page_counts = (10, None, 5, None, 7)
+
+    def setUp(self):
+        limiter.enabled = False
+        self.client = flask_app.test_client()
+        self.batch_id = str(uuid4())
+        self.pages = {str(uuid4()): page_count for page_count in self.page_counts}
+        service.db_insert_pdf_infos([{'id': pdf_id, 'name': 'test.pdf', 'task_id': str(uuid4()),
+                                      'task_state': 'SUCCESS', 'batch_id': self.batch_id, 'page_count': page_count}
+                                     for pdf_id, page_count in self.pages.items()])
+        self.addCleanup(service.db_delete_pdfs, list(self.pages))
+
+    def walk(self, sort: str, limit: int = 2) -> list[str]:
+        # All the pages of the list, following the cursors
+        pdf_ids, cursor = [], None
+        while True:
+            query = {'batch_id': self.batch_id, 'sort': sort, 'limit': limit}
+            if cursor:
+                query['cursor'] = cursor
+            response = self.client.get('/documents', query_string=query)
+            self.assertEqual(response.status_code, 200)
+            self.assertLessEqual(len(response.get_json()['documents']), limit)
+            pdf_ids += [document['_id'] for document in response.get_json()['documents']]
+            cursor = response.get_json()['next_cursor']
+            if cursor is None:
+                return pdf_ids
+
+    def test_keyset_pages_with_null_keys(self, live_states_mock):
+        # Test case when the sort key is NULL for some documents: each one is listed once, NULL first ascending
+        ascending = self.walk('page_count')
+        self.assertEqual(sorted(ascending), sorted(self.pages))
+        nulls = sorted(pdf_id for pdf_id, page_count in self.pages.items() if page_count is None)
+        self.assertEqual(ascending[:2], nulls)
+        self.assertEqual([self.pages[pdf_id] for pdf_id in ascending[2:]], [5, 7, 10])
+        self.assertEqual(self.walk('-page_count'), ascending[::-1])
+        for limit in (1, 3, 5):
+            self.assertEqual(self.walk('page_count', limit), ascending)
+        # The dates of the cursors, and the creation dates which are all NULL
+        self.assertEqual(sorted(self.walk('-created_at', 1)), sorted(self.pages))
+        self.assertEqual(sorted(self.walk('creation_date', 2)), sorted(self.pages))
+
+    def test_invalid_cursor(self, live_states_mock):
+        # Test case when the cursor is forged, or was given by a list of another sort
+        response = self.client.get('/documents', query_string={'batch_id': self.batch_id, 'sort': 'page_count',
+                                                                'limit': 1})
+        cursor = response.get_json()['next_cursor']
+        for sort, cursor in (('-page_count', cursor), ('title', cursor), ('page_count', 'not-a-cursor')):
+            response = self.client.get('/documents', query_string={'sort': sort, 'cursor': cursor})
+            self.assertEqual(response.status_code, 400)
+
+
+class TestMigrations(unittest.TestCase):
+
+    def setUp(self):
+        self.engine = create_engine("sqlite:///" + os.path.join(TMP_PATH, str(uuid4()) + '.db'))
+        self.addCleanup(self.engine.dispose)
+
+    def test_upgrade_a_db_created_before_the_versions(self):
+        # Test case when the db was created by create_all() with the hash of the uploads, before schema_version
+        with self.engine.begin() as connection:
+            connection.exec_driver_sql("CREATE TABLE metadata (id VARCHAR(255) PRIMARY KEY, data VARCHAR NOT NULL, "
+                                       "name VARCHAR(255) NOT NULL, link VARCHAR NOT NULL, "
+                                       "task_id VARCHAR(255) NOT NULL, task_state VARCHAR(255) NOT NULL, "
+                                       "created_at DATETIME DEFAULT CURRENT_TIMESTAMP, content_hash VARCHAR(64))")
+            connection.exec_driver_sql("CREATE INDEX ix_metadata_content_hash ON metadata (content_hash)")
+            connection.exec_driver_sql("INSERT INTO metadata (id, data, name, link, task_id, task_state, "
+                                       "content_hash) VALUES ('old', '{}', 'old.pdf', '', 't', 'SUCCESS', 'h')")
+        self.assertEqual(migrations.current_version(self.engine), 0)
+        self.assertEqual(migrations.migrate(self.engine), [version for version, _, _ in migrations.MIGRATIONS])
+        self.assertEqual(migrations.current_version(self.engine), migrations.latest_version())
+        columns = {column['name'] for column in inspect(self.engine).get_columns('metadata')}
+        self.assertTrue({'content_hash', 'batch_id', 'title', 'creation_date', 'page_count'} <= columns)
+        self.assertTrue({'text_pages', 'text_pages_fts', 'quarantine'} <= set(inspect(self.engine).get_table_names()))
+        with self.engine.begin() as connection:
+            self.assertEqual(connection.exec_driver_sql("SELECT name, content_hash FROM metadata").all(),
+                             [('old.pdf', 'h')])
+            # The triggers keep the full-text index in sync with the pages
+            connection.exec_driver_sql("INSERT INTO text_pages (pdf_id, page, content) VALUES ('old', 1, 'héllo')")
+            self.assertEqual(connection.exec_driver_sql("SELECT rowid FROM text_pages_fts "
+                                                        "WHERE text_pages_fts MATCH 'hello'").all(), [(1,)])
+        # Nothing left to apply
+        self.assertEqual(migrations.migrate(self.engine), [])
+
+    def test_create_a_new_db(self):
+        # Test case when the db is empty
+        self.assertEqual(migrations.migrate(self.engine)[-1], migrations.latest_version())
+        self.assertEqual(migrations.migrate(self.engine), [])
+
+
+class TestDeduplication(unittest.TestCase):
+
+    def setUp(self):
+        self.content_hash = uuid4().hex
+        self.ids = {state: str(uuid4()) for state in ('SUCCESS', 'PENDING', 'FAILURE')}
+        # The failed extraction is the latest upload of the content
+        service.db_insert_pdf_infos([{'id': pdf_id, 'name': 'test.pdf', 'task_id': str(uuid4()), 'task_state': state,
+                                      'content_hash': self.content_hash, 'created_at': datetime(2023, 1, day)}
+                                     for day, (state, pdf_id) in enumerate(self.ids.items(), 1)])
+        self.addCleanup(service.db_delete_pdfs, list(self.ids.values()))
+
+    def test_failed_upload_is_not_reused(self):
+        # Test case when the latest upload of a content failed: the previous one is reused
+        self.assertEqual(service.db_get_pdf_by_hash(self.content_hash).id, self.ids['PENDING'])
+        self.assertEqual(service.db_get_pdf_ids_by_hashes([self.content_hash, 'unknown']),
+                         {self.content_hash: self.ids['PENDING']})
+
+    def test_only_failed_uploads(self):
+        # Test case when every upload of a content failed: it is extracted again
+        service.db_delete_pdfs([self.ids['SUCCESS'], self.ids['PENDING']])
+        self.assertIsNone(service.db_get_pdf_by_hash(self.content_hash))
+        self.assertEqual(service.db_get_pdf_ids_by_hashes([self.content_hash]), {})
+
+
+class TestPublishedPages(unittest.TestCase):
+
+    def setUp(self):
+        limiter.enabled = False
+        self.client = flask_app.test_client()
+        self.folder = tempfile.mkdtemp(dir=TMP_PATH)
+        patcher = patch('balthapp.TXT_FOLDER_PATH', self.folder)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.pdf_id = str(uuid4())
+        service.db_insert_pdf_info({'id': self.pdf_id, 'name': 'test.pdf', 'task_id': str(uuid4())})
+        self.addCleanup(service.db_delete_pdf, self.pdf_id)
+        # A document of 60 pages extracted by chunks of 20: the pages 1-5 and 21-25 are published so far
+        self.publish(TXT_EXT, first=0, pages=5)
+        self.publish(TXT_EXT + '.20', first=20, pages=5)
+
+    def publish(self, suffix: str, first: int, pages: int) -> None:
+        # A text being written by a worker, and the index of the pages written so far
+        txt_path = os.path.join(self.folder, service.fs_shard_name(self.pdf_id + suffix))
+        os.makedirs(os.path.dirname(txt_path), exist_ok=True)
+        with open(txt_path, 'wb') as txt_file:
+            text = tasks._PagedText(txt_file)
+            for number in range(first + 1, first + pages + 1):
+                text.write(f'page {number}\f'.encode())
+                text.end_page()
+        with open(txt_path + INDEX_EXT, 'w') as index_file:
+            json.dump(dict(text.index, first=first, pages=60), index_file)
+
+    def test_ranges(self):
+        # Test case when the range is in the text, in a part, beyond the pages published, or across two sources
+        found = balthapp._published_pages(self.pdf_id, 2, 4)
+        self.assertEqual((found[0], found[2]), (service.fs_shard_name(self.pdf_id + TXT_EXT), 4))
+        found = balthapp._published_pages(self.pdf_id, 21, 25)
+        self.assertEqual((found[0], found[1]['first'], found[2]),
+                         (service.fs_shard_name(self.pdf_id + '.txt.20'), 20, 25))
+        for first, last in ((5, 6), (6, 6), (20, 21), (25, 26), (61, 61)):
+            self.assertIsNone(balthapp._published_pages(self.pdf_id, first, last), (first, last))
+
+    @patch('balthapp.celery_app')
+    def test_pages_of_a_running_extraction(self, celery_mock):
+        # Test case when the pages are asked while the document is being extracted
+        celery_mock.AsyncResult.return_value = MagicMock(state='PROGRESS', info={'pages_done': 10, 'pages': 60})
+        response = self.client.get(f'/text/{self.pdf_id}/pages', query_string={'first': 22, 'last': 23})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data, b'page 22\fpage 23\f')
+        self.assertEqual(response.headers['X-Page-Count'], '60')
+        self.assertIn('no-store', response.headers['Cache-Control'])
+        response = self.client.get(f'/text/{self.pdf_id}/pages', query_string={'first': 6})
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(response.get_json()['progress'], {'pages_done': 10, 'pages': 60})
+
+    def merge(self):
+        # The worker merges the parts: the whole text and its index, then the parts are removed
+        self.publish(TXT_EXT, first=0, pages=60)
+        for suffix in (TXT_EXT + '.20', TXT_EXT + '.20' + INDEX_EXT):
+            os.remove(os.path.join(self.folder, service.fs_shard_name(self.pdf_id + suffix)))
+
+    @patch('balthapp.celery_app')
+    def test_part_merged_before_the_read(self, celery_mock):
+        # Test case when the part is found, then removed by the merge before it is opened
+        celery_mock.AsyncResult.return_value = MagicMock(state='STARTED', info=None)
+        pages_response = balthapp._pages_response
+
+        def merge_then_read(*args):
+            if '.txt.20' in args[0]:
+                self.merge()
+            return pages_response(*args)
+
+        with patch('balthapp._pages_response', side_effect=merge_then_read):
+            response = self.client.get(f'/text/{self.pdf_id}/pages', query_string={'first': 22, 'last': 23})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data, b'page 22\fpage 23\f')
+
+    @patch('balthapp.celery_app')
+    def test_part_removed_without_text(self, celery_mock):
+        # Test case when the part is removed and the whole text is not published: the pages are not ready
+        celery_mock.AsyncResult.return_value = MagicMock(state='STARTED', info=None)
+        with patch('service.fs_read_pages', side_effect=FileNotFoundError):
+            response = self.client.get(f'/text/{self.pdf_id}/pages', query_string={'first': 22})
+        self.assertEqual(response.status_code, 202)
+
+    def test_file_removed_while_streaming(self):
+        # Test case when the part is removed once the response started: it is read through its descriptor
+        pages = service.fs_read_pages(os.path.join(self.folder, service.fs_shard_name(self.pdf_id + '.txt.20')),
+                                      0, 16, False)
+        self.merge()
+        self.assertEqual(b''.join(pages), b'page 21\fpage 22\f')
+
+
+class TestMaxContentLength(unittest.TestCase):
+
+    def setUp(self):
+        limiter.enabled = False
+        self.client = flask_app.test_client()
+
+    @patch.dict(flask_app.config, {'MAX_CONTENT_LENGTH': 1024})
+    def test_body_too_large(self):
+        # Test case when the body of an upload is beyond the limit: refused before its file is read
+        with patch('service.fs_save_temp_pdf') as save_mock:
+            response = self.client.post('/documents', data={'pdf_file': (io.BytesIO(b'%PDF' + b'0' * 2048),
+                                                                         'test.pdf')})
+        self.assertEqual(response.status_code, 413)
+        self.assertIn('error', response.get_json())
+        save_mock.assert_not_called()
+
+    @patch.dict(flask_app.config, {'MAX_CONTENT_LENGTH': 1024})
+    def test_batch_limit(self):
+        # Test case when the body of a batch upload is beyond the limit of one file, under the one of a batch
+        data = {'pdf_files': (io.BytesIO(b'0' * 2048), 'notes.txt')}
+        response = self.client.post('/documents/batch', data=data)
+        self.assertNotEqual(response.status_code, 413)
+        with patch('balthapp.MAX_BATCH_SIZE', 1024):
+            response = self.client.post('/documents/batch', data={'pdf_files': (io.BytesIO(b'0' * 2048), 'notes.txt')})
+        self.assertEqual(response.status_code, 413)
+        self.assertIn('Batch size', response.get_json()['error'])
+
+
+class TestBulkOutputNames(unittest.TestCase):
+
+    def setUp(self):
+        self.source = tempfile.mkdtemp(dir=TMP_PATH)
+        for pdf_name in ('2023/a.pdf', '2024/a.pdf', '2024/b.pdf', '2024/B.pdf'):
+            os.makedirs(os.path.join(self.source, os.path.dirname(pdf_name)), exist_ok=True)
+            open(os.path.join(self.source, pdf_name), 'wb').close()
+
+    def test_names_relative_to_the_input(self):
+        # Test case when files of the same name are in different folders
+        pdf_paths = bulk.list_pdf_files(os.path.join(self.source, '**', '*.pdf'))
+        names = bulk.output_names(pdf_paths)
+        self.assertEqual(sorted(names.values()), ['2023/a', '2024/B', '2024/a', '2024/b'])
+        self.assertEqual(bulk.output_names([os.path.join(self.source, '2023/a.pdf')]), {
+            os.path.join(self.source, '2023/a.pdf'): 'a'})
+
+    @patch('bulk.process_file', side_effect=lambda session, api_url, pdf_path, output_dir, name: {'path': pdf_path,
+                                                                                                  'name': name})
+    def test_collisions_fail(self, process_mock):
+        # Test case when two outputs would differ by the case only: both files fail, the others are processed
+        reports = bulk.run_bulk(os.path.join(self.source, '**', '*.pdf'), 'http://localhost:5000',
+                                os.path.join(self.source, 'output'))
+        by_name = {os.path.relpath(report['path'], self.source): report for report in reports}
+        self.assertEqual(by_name['2023/a.pdf']['name'], '2023/a')
+        self.assertEqual(by_name['2024/a.pdf']['name'], '2024/a')
+        self.assertIn('collision', by_name['2024/b.pdf']['error'])
+        self.assertIn('collision', by_name['2024/B.pdf']['error'])
+        self.assertEqual(process_mock.call_count, 2)
+
+
+class TestInflightCount(unittest.TestCase):
+
+    def setUp(self):
+        limiter.enabled = False
+        self.client = flask_app.test_client()
+        patcher = patch('balthapp.redis_client')
+        self.redis_mock = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.redis_mock.pipeline.return_value.execute.return_value = [True, 1]
+        self.redis_mock.decrby.return_value = 0
+
+    def test_reserve_with_a_ttl_from_the_first_task(self):
+        # Test case when a client sends tasks: the count gets a time to live when it is created only
+        with flask_app.test_request_context():
+            self.assertEqual(balthapp._reserve_priorities(1), [0])
+        pipeline = self.redis_mock.pipeline.return_value
+        pipeline.set.assert_called_once_with(INFLIGHT_PREFIX + '127.0.0.1', 0, ex=INFLIGHT_TTL, nx=True)
+        pipeline.expire.assert_not_called()
+
+    @patch('balthapp._check_pdf_file', return_value=None)
+    @patch('balthapp._save_temp_pdf')
+    @patch('balthapp.group')
+    def test_release_when_the_send_fails(self, group_mock, save_mock, check_mock):
+        # Test case when the broker refuses the tasks of a batch: their slots are given back
+        save_mock.side_effect = lambda pdf_infos, pdf_file: (pdf_infos.set_content_hash(uuid4().hex),
+                                                             pdf_infos.set_size(0))[-1]
+        group_mock.return_value.apply_async.side_effect = ConnectionError('broker down')
+        files = [(io.BytesIO(b'%PDF'), f'{number}.pdf') for number in range(3)]
+        response = self.client.post('/documents/batch', data={'pdf_files': files})
+        self.assertEqual(response.status_code, 500)
+        self.redis_mock.decrby.assert_called_once_with(INFLIGHT_PREFIX + '127.0.0.1', 3)
+        self.redis_mock.delete.assert_called_once_with(INFLIGHT_PREFIX + '127.0.0.1')
+
+
+@patch('balthapp._check_pdf_file', return_value=None)
+class TestBatchCleaning(unittest.TestCase):
+
+    def setUp(self):
+        limiter.enabled = False
+        self.client = flask_app.test_client()
+        self.saved = []
+        patcher = patch('balthapp._save_temp_pdf', side_effect=self.save)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def save(self, pdf_infos, pdf_file):
+        # The temp PDF, written in the throwaway folder
+        pdf_infos.pdf_path = os.path.join(TMP_PATH, pdf_infos.uid + PDF_EXT)
+        with open(pdf_infos.pdf_path, 'wb') as temp_file:
+            temp_file.write(pdf_file.read())
+        pdf_infos.set_content_hash(uuid4().hex)
+        pdf_infos.set_size(os.path.getsize(pdf_infos.pdf_path))
+        self.saved.append(pdf_infos.pdf_path)
+
+    def post_batch(self):
+        files = [(io.BytesIO(b'%PDF'), f'{number}.pdf') for number in range(3)]
+        return self.client.post('/documents/batch', data={'pdf_files': files})
+
+    def test_insert_fails(self, check_mock):
+        # Test case when the entries of the batch cannot be stored
+        with patch('service.db_insert_pdf_infos', side_effect=RuntimeError('db down')):
+            self.assertEqual(self.post_batch().status_code, 500)
+        self.assertEqual(len(self.saved), 3)
+        self.assertFalse(any(os.path.exists(path) for path in self.saved))
+
+    def test_deduplication_fails(self, check_mock):
+        # Test case when the lookup of the known contents raises
+        with patch('service.db_get_pdf_ids_by_hashes', side_effect=RuntimeError('db down')):
+            self.assertEqual(self.post_batch().status_code, 500)
+        self.assertFalse(any(os.path.exists(path) for path in self.saved))
+
+    @patch('balthapp._reserve_priorities', side_effect=lambda count: [0] * count)
+    @patch('balthapp.group')
+    def test_send_fails(self, group_mock, reserve_mock, check_mock):
+        # Test case when the broker refuses the tasks: the entries and the PDF are removed
+        group_mock.return_value.apply_async.side_effect = ConnectionError('broker down')
+        with patch('balthapp._release_priorities'):
+            self.assertEqual(self.post_batch().status_code, 500)
+        self.assertFalse(any(os.path.exists(path) for path in self.saved))
+        self.assertEqual(service.db_get_existing_pdf_ids([os.path.basename(path)[:-4] for path in self.saved]), set())
+
+
+class TestSaveTempPdf(unittest.TestCase):
+
+    def test_remove_the_partial_file(self):
+        # Test case when the upload breaks mid-write: the partly written PDF is not left in the temp folder
+        pdf_path = os.path.join(TMP_PATH, str(uuid4()) + PDF_EXT)
+        file = MagicMock()
+        file.read.side_effect = [b'%PDF', OSError('connection reset')]
+        with self.assertRaises(OSError):
+            service.fs_save_temp_pdf(file, pdf_path, 1024)
+        self.assertFalse(os.path.exists(pdf_path))
+
+    def test_keep_the_complete_file(self):
+        # Test case when the upload is complete: the file is kept and its hash returned
+        pdf_path = os.path.join(TMP_PATH, str(uuid4()) + PDF_EXT)
+        self.addCleanup(os.remove, pdf_path)
+        self.assertEqual(service.fs_save_temp_pdf(io.BytesIO(b'%PDF'), pdf_path, 1024),
+                         hashlib.sha256(b'%PDF').hexdigest())
+        self.assertTrue(os.path.exists(pdf_path))
+
+class _StoredText:
+    """A finished document whose text is stored by the worker, plain or compressed, in a throwaway folder"""
+    compressed = False
+    pages = [b'The first page of the text\n\x0c', b'The second page, \xc3\xa9t\xc3\xa9 \n\x0c']
+
+    def setUp(self):
+        limiter.enabled = False
+        self.client = flask_app.test_client()
+        self.folder = tempfile.mkdtemp(dir=TMP_PATH)
+        patcher = patch('balthapp.TXT_FOLDER_PATH', self.folder)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.pdf_id = str(uuid4())
+        service.db_insert_pdf_info({'id': self.pdf_id, 'name': 'test.pdf', 'task_id': str(uuid4()),
+                                    'task_state': 'SUCCESS'})
+        self.addCleanup(service.db_delete_pdf, self.pdf_id)
+        self.text = b''.join(self.pages)
+        self.txt_path = os.path.join(self.folder, service.fs_shard_name(
+            self.pdf_id + TXT_EXT + (GZIP_EXT if self.compressed else '')))
+        os.makedirs(os.path.dirname(self.txt_path))
+        with open(self.txt_path, 'wb') as txt_file:
+            text = tasks._PagedText(txt_file, self.compressed)
+            for page in self.pages:
+                text.write(page)
+                text.end_page()
+            text.close()
+        # The two routes serving the stored text
+        self.urls = (f'/text/{self.pdf_id}', f'/storage/files/{self.pdf_id}{TXT_EXT}')
+
+
+class TestTextRanges(_StoredText, unittest.TestCase):
+
+    def test_partial_content(self):
+        # Test case when a part of the text is asked
+        for url in self.urls:
+            response = self.client.get(url, headers={'Range': 'bytes=4-12'})
+            self.assertEqual(response.status_code, 206, url)
+            self.assertEqual(response.headers['Content-Range'], f'bytes 4-12/{len(self.text)}')
+            self.assertEqual(response.data, self.text[4:13])
+            self.assertNotIn('Content-Encoding', response.headers)
+
+    def test_unsatisfiable_range(self):
+        # Test case when the range starts beyond the end of the text
+        for url in self.urls:
+            response = self.client.get(url, headers={'Range': f'bytes={len(self.text) + 10}-'})
+            self.assertEqual(response.status_code, 416, url)
+
+    def test_not_modified(self):
+        # Test case when the client already has the text: a matching ETag gets a 304 without the text
+        for url in self.urls:
+            etag = self.client.get(url).headers['ETag']
+            response = self.client.get(url, headers={'If-None-Match': etag})
+            self.assertEqual(response.status_code, 304, url)
+            self.assertEqual(response.data, b'')
+
+
+class TestCompressedTextRanges(TestTextRanges):
+    # The ranges and the ETag of the text decompressed on the fly
+    compressed = True
+
+
+class TestCompressedText(_StoredText, unittest.TestCase):
+    compressed = True
+
+    def test_size_from_the_trailer(self):
+        # Test case when the size of the text is read without decompressing it
+        self.assertEqual(service.fs_gzip_size(self.txt_path), len(self.text))
+
+    def test_compressed_bytes_sent_as_they_are(self):
+        # Test case when the client accepts gzip: the stored bytes are sent with their encoding
+        with open(self.txt_path, 'rb') as txt_file:
+            stored = txt_file.read()
+        for url in self.urls:
+            response = self.client.get(url, headers={'Accept-Encoding': 'gzip, deflate'})
+            self.assertEqual(response.status_code, 200, url)
+            self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+            self.assertIn('Accept-Encoding', response.headers['Vary'])
+            self.assertEqual(response.data, stored)
+            self.assertEqual(gzip.decompress(response.data), self.text)
+
+    def test_decompressed_on_the_fly(self):
+        # Test case when the client does not accept gzip, or refuses it explicitly
+        for headers in ({}, {'Accept-Encoding': 'identity'}, {'Accept-Encoding': 'gzip;q=0'}):
+            for url in self.urls:
+                response = self.client.get(url, headers=headers)
+                self.assertEqual(response.status_code, 200, (url, headers))
+                self.assertNotIn('Content-Encoding', response.headers)
+                self.assertIn('Accept-Encoding', response.headers['Vary'])
+                self.assertEqual(response.headers['Content-Length'], str(len(self.text)))
+                self.assertEqual(response.data, self.text)
+
+    def test_representations_have_their_own_etag(self):
+        # Test case when a cache keeps both representations: their ETags differ
+        compressed = self.client.get(self.urls[0], headers={'Accept-Encoding': 'gzip'})
+        decompressed = self.client.get(self.urls[0])
+        self.assertNotEqual(compressed.headers['ETag'], decompressed.headers['ETag'])
+
+
+class TestExtractMetadata(unittest.TestCase):
+
+    def extract(self, pdf_name: str) -> dict:
+        with open(os.path.join(ROOT_PATH, 'balthclient', 'pdf_source', pdf_name), 'rb') as pdf_file:
+            return tasks._extract_metadata(PDFDocument(PDFParser(pdf_file)))
+
+    def test_sample_pdfs(self):
+        # Test case when the metadata of the sample PDF are read from their Info dictionary
+        metadata = self.extract('test.pdf')
+        self.assertEqual(metadata['Author'], 'Jean-Eudes Méhus')
+        self.assertEqual(metadata['Title'], 'Balth Mehus DSI')
+        self.assertEqual(metadata['CreationDate'], "D:20230117212921+00'00'")
+        metadata = self.extract('test-text.pdf')
+        self.assertEqual(metadata['Title'], 'Microsoft Word - Software_design_guide.docx')
+        self.assertEqual(metadata['Creator'], 'Word')
+        # Stored as JSON by the finalizer
+        self.assertEqual(json.loads(json.dumps(metadata)), metadata)
+
+    def test_latest_update_wins(self):
+        # Test case when the PDF was updated: pdfminer gives the latest trailer first
+        document = MagicMock(info=[{'Title': b'Updated'}, {'Title': b'Original', 'Author': b'Balth'}])
+        self.assertEqual(tasks._extract_metadata(document), {'Title': 'Updated', 'Author': 'Balth'})
+
+    def test_json_values(self):
+        # Test case when the values are names, UTF-16 strings and nested objects
+        info = {'Trapped': PSLiteral('True'), 'Subtype': PSLiteral(b'Form'),
+                'Title': b'\xfe\xff' + 'Été'.encode('utf-16-be'), 'Version': 1.7, 'Marked': True, 'Empty': None,
+                'Nested': [1, [PSLiteral('A'), b'x'], {'Key': b'value'}], 'Other': object}
+        metadata = tasks._extract_metadata(MagicMock(info=[info]))
+        self.assertEqual(metadata['Trapped'], 'True')
+        self.assertEqual(metadata['Subtype'], 'Form')
+        self.assertEqual(metadata['Title'], 'Été')
+        self.assertEqual((metadata['Version'], metadata['Marked'], metadata['Empty']), (1.7, True, None))
+        self.assertEqual(metadata['Nested'], [1, ['A', 'x'], {'Key': 'value'}])
+        self.assertEqual(metadata['Other'], str(object))
+
+    def test_depth_cap(self):
+        # Test case when the objects are nested too deep, or reference themselves
+        deep = value = []
+        for _ in range(20):
+            value.append([])
+            value = value[0]
+        cyclic = []
+        cyclic.append(cyclic)
+        for converted in (tasks._json_value(deep), tasks._json_value(cyclic)):
+            for _ in range(8):
+                converted = converted[0]
+            self.assertEqual(converted, [None])
+
+
+@patch('balthapp.celery_app')
+@patch('balthapp.redis_client')
+class TestWait(unittest.TestCase):
+
+    def setUp(self):
+        limiter.enabled = False
+        self.client = flask_app.test_client()
+        self.pdf_id = str(uuid4())
+        service.db_insert_pdf_info({'id': self.pdf_id, 'name': 'test.pdf', 'task_id': str(uuid4())})
+        self.addCleanup(service.db_delete_pdf, self.pdf_id)
+
+    def test_already_terminal(self, redis_mock, celery_mock):
+        # Test case when the extraction is over before the call: no subscription
+        service.db_update_pdf(self.pdf_id, {'task_state': 'SUCCESS'})
+        response = self.client.get(f'/wait/{self.pdf_id}')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.get_json()['task_state'], 'SUCCESS')
+        redis_mock.pubsub.assert_not_called()
+
+    def test_timeout(self, redis_mock, celery_mock):
+        # Test case when the finalizer does not publish before the timeout: the current state is returned
+        celery_mock.AsyncResult.return_value = MagicMock(state='STARTED')
+        redis_mock.pubsub.return_value.get_message.return_value = None
+        response = self.client.get(f'/wait/{self.pdf_id}', query_string={'timeout': 0.05})
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(response.get_json()['task_state'], 'STARTED')
+        pubsub = redis_mock.pubsub.return_value
+        pubsub.subscribe.assert_called_once_with(FINALIZED_CHANNEL + self.pdf_id)
+        pubsub.close.assert_called_once()
+
+    def test_notified(self, redis_mock, celery_mock):
+        # Test case when the finalizer publishes the end of the extraction while the client waits
+        celery_mock.AsyncResult.return_value = MagicMock(state='STARTED')
+
+        def finalize(timeout):
+            service.db_update_pdf(self.pdf_id, {'task_state': 'FAILURE'})
+            return {'type': 'message', 'data': b'FAILURE'}
+
+        redis_mock.pubsub.return_value.get_message.side_effect = finalize
+        response = self.client.get(f'/wait/{self.pdf_id}', query_string={'timeout': 5})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.get_json()['task_state'], 'FAILURE')
+
+    def test_unknown_id(self, redis_mock, celery_mock):
+        # Test case when the id is not in the db
+        response = self.client.get(f'/wait/{uuid4()}')
+        self.assertEqual(response.status_code, 404)
+        redis_mock.pubsub.assert_not_called()
+
+
+class TestShardedStorage(unittest.TestCase):
+
+    def setUp(self):
+        # Texts of the flat layout, stored before the sub-folders
+        self.folder = tempfile.mkdtemp(dir=TMP_PATH)
+        self.pdf_id = str(uuid4())
+        self.names = (self.pdf_id + TXT_EXT, self.pdf_id + TXT_EXT + INDEX_EXT)
+        for name in self.names:
+            with open(os.path.join(self.folder, name), 'w') as flat_file:
+                flat_file.write(name)
+
+    def test_shard_name(self):
+        # Test case when the sub-folders are taken from the first characters of the uuid
+        self.assertEqual(service.fs_shard_name('abcdef.txt'), os.path.join('ab', 'cd', 'abcdef.txt'))
+
+    def test_dry_run_moves_nothing(self):
+        # Test case when the files to move are only counted
+        self.assertEqual(manage.migrate_storage(self.folder, dry_run=True), 2)
+        self.assertEqual(sorted(os.listdir(self.folder)), sorted(self.names))
+        for name in self.names:
+            self.assertEqual(service.fs_find_file(self.folder, name), name)
+
+    def test_migrate_to_the_sub_folders(self):
+        # Test case when the flat files are moved: they are found at the root before, in their sub-folder after
+        self.assertEqual(service.fs_find_text(self.folder, self.names[0], GZIP_EXT), self.names[0])
+        self.assertEqual(manage.migrate_storage(self.folder), 2)
+        for name in self.names:
+            found = service.fs_find_file(self.folder, name)
+            self.assertEqual(found, service.fs_shard_name(name))
+            with open(os.path.join(self.folder, found)) as sharded_file:
+                self.assertEqual(sharded_file.read(), name)
+        self.assertFalse(os.path.exists(os.path.join(self.folder, self.names[0])))
+        self.assertIsNone(service.fs_find_file(self.folder, str(uuid4()) + TXT_EXT))
+        # Nothing left to move, the sub-folders are skipped
+        self.assertEqual(manage.migrate_storage(self.folder), 0)